@@ -0,0 +1,271 @@
+"""Fake LLM server to benchmark the conversion without an API key."""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Deque, Dict, Optional
+
+# Marker after which the prompt holds the text to convert (see prompts.yaml)
+_TEXT_MARKER = "### Text to Transform"
+
+_HEADING = re.compile(r"^(=+)\s*(.*?)\s*=+\s*$", re.MULTILINE)
+
+
+class FakeLLMServer:
+    """
+    Local server mimicking the chat completions API of OpenRouter, for benchmarks.
+
+    A response takes ``latency`` seconds plus ``seconds_per_token`` per token
+    of the text it returns (about 4 characters per token), which is the text
+    of the prompt with its wiki headings turned into Markdown headings. A
+    fraction ``straggler_rate`` of the responses take ``straggler_latency``
+    more seconds, like the stragglers of a real provider. The server can also
+    fail a fraction of the requests with a 500, and answer
+    429, with a ``Retry-After`` header, when more than ``max_concurrency``
+    requests are in flight or more than ``requests_per_minute`` requests were
+    received in the last minute, like a rate-limited provider.
+
+    Example:
+        >>> with FakeLLMServer(latency=0.2, max_concurrency=32) as server:
+        ...     os.environ["OPENROUTER_API_BASE"] = server.base_url
+        ...     parallel_process_dataframe(data, ...)
+        >>> server.stats["rate_limited"]
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.05,
+        seconds_per_token: float = 0.0,
+        error_rate: float = 0.0,
+        straggler_rate: float = 0.0,
+        straggler_latency: float = 10.0,
+        max_concurrency: Optional[int] = None,
+        requests_per_minute: Optional[int] = None,
+        retry_after: float = 1.0,
+        seed: int = 0,
+    ):
+        """
+        Configure the server, which is started by ``start``.
+
+        Args:
+            host (str): Address to listen on (default: "127.0.0.1").
+            port (int): Port to listen on. 0 picks a free port (default: 0).
+            latency (float): Seconds before any response (default: 0.05).
+            seconds_per_token (float): Additional seconds per generated token
+                (default: 0).
+            error_rate (float): Fraction of the requests failing with a 500
+                (default: 0).
+            straggler_rate (float): Fraction of the responses delayed by
+                ``straggler_latency`` (default: 0).
+            straggler_latency (float): Additional seconds of the delayed
+                responses (default: 10).
+            max_concurrency (int, optional): Requests in flight above which
+                the server answers 429. Defaults to no limit.
+            requests_per_minute (int, optional): Requests per sliding minute
+                above which the server answers 429. Defaults to no limit.
+            retry_after (float): Value of the ``Retry-After`` header of the
+                429 responses, in seconds (default: 1).
+            seed (int): Seed of the random errors (default: 0).
+        """
+        self.latency = latency
+        self.seconds_per_token = seconds_per_token
+        self.error_rate = error_rate
+        self.straggler_rate = straggler_rate
+        self.straggler_latency = straggler_latency
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.retry_after = retry_after
+        self.stats: Dict[str, int] = {
+            "requests": 0,
+            "completed": 0,
+            "errors": 0,
+            "rate_limited": 0,
+            "stragglers": 0,
+            "in_flight": 0,
+            "max_in_flight": 0,
+        }
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._recent: Deque[float] = deque()
+        self._server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="fake-llm-server", daemon=True
+        )
+
+    @property
+    def base_url(self) -> str:
+        """Base URL of the API, for ``OPENROUTER_API_BASE``."""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "FakeLLMServer":
+        """Start serving from a background thread."""
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop serving and close the socket."""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeLLMServer":
+        """Start the server."""
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        """Stop the server."""
+        self.stop()
+
+    def _admit(self) -> Optional[int]:
+        """Count a request, returning the status of an immediate error if any."""
+        now = time.monotonic()
+        with self._lock:
+            self.stats["requests"] += 1
+            while self._recent and now - self._recent[0] > 60:
+                self._recent.popleft()
+            if (
+                self.max_concurrency is not None
+                and self.stats["in_flight"] >= self.max_concurrency
+            ) or (
+                self.requests_per_minute is not None
+                and len(self._recent) >= self.requests_per_minute
+            ):
+                self.stats["rate_limited"] += 1
+                return 429
+            self._recent.append(now)
+            if self._random.random() < self.error_rate:
+                self.stats["errors"] += 1
+                return 500
+            self.stats["in_flight"] += 1
+            self.stats["max_in_flight"] = max(
+                self.stats["max_in_flight"], self.stats["in_flight"]
+            )
+        return None
+
+    def _complete(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Build the completion of a request, sleeping like a real model."""
+        try:
+            prompt = request["messages"][-1]["content"]
+            text = prompt.rsplit(_TEXT_MARKER, 1)[-1].strip()
+            content = _HEADING.sub(
+                lambda match: "#" * len(match.group(1)) + " " + match.group(2), text
+            )
+            completion_tokens = len(content) // 4 + 1
+            delay = self.latency + self.seconds_per_token * completion_tokens
+            with self._lock:
+                if self._random.random() < self.straggler_rate:
+                    self.stats["stragglers"] += 1
+                    delay += self.straggler_latency
+            time.sleep(delay)
+            prompt_tokens = len(prompt) // 4 + 1
+            return {
+                "id": "chatcmpl-benchmark",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "benchmark"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            }
+        finally:
+            with self._lock:
+                self.stats["in_flight"] -= 1
+                self.stats["completed"] += 1
+
+
+def _make_handler(server: FakeLLMServer) -> type:
+    """Request handler class bound to a server."""
+
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-alive connections, like the API
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self) -> None:
+            with server._lock:
+                self._send(200, dict(server.stats))
+
+        def do_POST(self) -> None:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            status = server._admit()
+            if status == 429:
+                self._send(
+                    429,
+                    {"error": {"message": "Rate limit exceeded", "code": 429}},
+                    {"Retry-After": str(server.retry_after)},
+                )
+            elif status == 500:
+                self._send(500, {"error": {"message": "Internal error", "code": 500}})
+            else:
+                self._send(200, server._complete(request))
+
+        def _send(
+            self,
+            status: int,
+            body: Dict[str, Any],
+            headers: Optional[Dict[str, str]] = None,
+        ) -> None:
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    return Handler
+
+
+# Main block to run the server on its own, e.g. to run the pipeline against it
+# with OPENROUTER_API_BASE=http://127.0.0.1:8000/v1
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run a fake OpenAI-compatible chat completions server."
+    )
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--seconds-per-token", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--straggler-rate", type=float, default=0.0)
+    parser.add_argument("--straggler-latency", type=float, default=10.0)
+    parser.add_argument("--max-concurrency", type=int)
+    parser.add_argument("--requests-per-minute", type=int)
+    args = parser.parse_args()
+
+    with FakeLLMServer(
+        port=args.port,
+        latency=args.latency,
+        seconds_per_token=args.seconds_per_token,
+        error_rate=args.error_rate,
+        straggler_rate=args.straggler_rate,
+        straggler_latency=args.straggler_latency,
+        max_concurrency=args.max_concurrency,
+        requests_per_minute=args.requests_per_minute,
+    ) as server:
+        print(f"Serving on {server.base_url}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,466 @@
+"""Benchmarks of the stages of the pipeline, with a history of the results."""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import pandas as pd
+import yaml
+
+from benchmarks.fake_llm_server import FakeLLMServer
+from benchmarks.synthetic_dump import generate_dump
+from src.convert_to_markdown import MarkdownConverter
+from src.format_wiki_text import format_wiki_text, is_article, iter_dump_pages
+from src.utils.async_parallel import async_process_dataframe
+from src.utils.database import DatabaseWriter, initialize_db, insert_row
+from src.utils.dewiki import DEWIKI_ENGINES, dewiki
+from src.utils.parallel import parallel_process_dataframe
+from src.utils.tokenizer import count_tokens, count_tokens_batch
+
+BENCHMARK_FOLDER = Path(__file__).parent
+ROOT_FOLDER = BENCHMARK_FOLDER.parent
+
+# Generated dumps, Parquet files and tokenizers, reused across runs
+DATA_FOLDER = BENCHMARK_FOLDER / ".data"
+RESULTS_FOLDER = BENCHMARK_FOLDER / "results"
+HISTORY_FILE = RESULTS_FOLDER / "history.jsonl"
+
+
+class Context:
+    """Inputs shared by the benchmarks, prepared once per run."""
+
+    def __init__(self, args: argparse.Namespace):
+        """
+        Generate the synthetic dump of the run, and parse it if needed.
+
+        Args:
+            args (argparse.Namespace): Arguments of the run.
+        """
+        self.args = args
+        self.dump_file, self.index_file = generate_dump(
+            DATA_FOLDER,
+            num_articles=args.articles,
+            mean_words=args.mean_words,
+            distribution=args.distribution,
+            seed=args.seed,
+        )
+        self.parquet_file = self.dump_file.with_name(
+            self.dump_file.name.replace("-multistream.xml.bz2", ".parquet")
+        )
+        if not self.parquet_file.exists():
+            format_wiki_text(
+                self.dump_file, self.parquet_file, index_filename=self.index_file
+            )
+        self.data = pd.read_parquet(self.parquet_file)
+        self.raw_texts = [
+            page.text for page in iter_dump_pages(self.dump_file) if is_article(page)
+        ]
+        self._tokenizer = None
+
+    @property
+    def tokenizer(self):
+        """Byte-level BPE tokenizer trained on the articles, without any download."""
+        if self._tokenizer is None:
+            from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+            from tokenizers.trainers import BpeTrainer
+
+            tokenizer = Tokenizer(models.BPE())
+            tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+            tokenizer.decoder = decoders.ByteLevel()
+            tokenizer.train_from_iterator(
+                self.data["text"].tolist(),
+                BpeTrainer(
+                    vocab_size=8000,
+                    initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+                    show_progress=False,
+                ),
+            )
+            self._tokenizer = tokenizer
+        return self._tokenizer
+
+
+def bench_parse(context: Context) -> Dict[str, float]:
+    """Parse the synthetic dump serially and with a pool of processes."""
+    args = context.args
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        for name, num_workers in (("serial", 1), ("parallel", args.parse_workers)):
+            seconds = _best_of(
+                args.repeat,
+                lambda num_workers=num_workers: format_wiki_text(
+                    context.dump_file,
+                    Path(folder) / "data.parquet",
+                    num_workers=num_workers,
+                    index_filename=context.index_file,
+                    dewiki_engine=args.dewiki_engine,
+                ),
+            )
+            results[f"parse_{name}_seconds"] = seconds
+            results[f"parse_{name}_articles_per_second"] = len(context.data) / seconds
+    return results
+
+
+def bench_dewiki(context: Context) -> Dict[str, float]:
+    """Convert the wiki markup of the articles to plain text with every engine."""
+    num_bytes = sum(len(text.encode("utf-8")) for text in context.raw_texts)
+    results = {}
+    for engine in DEWIKI_ENGINES:
+        seconds = _best_of(
+            context.args.repeat,
+            lambda engine=engine: [dewiki(text, engine) for text in context.raw_texts],
+        )
+        results[f"dewiki_{engine}_seconds"] = seconds
+        results[f"dewiki_{engine}_articles_per_second"] = (
+            len(context.raw_texts) / seconds
+        )
+        results[f"dewiki_{engine}_mb_per_second"] = num_bytes / 1e6 / seconds
+    return results
+
+
+def bench_tokenize(context: Context) -> Dict[str, float]:
+    """Count the tokens of the articles one at a time and in a batch."""
+    tokenizer = context.tokenizer
+    texts = context.data["text"].tolist()
+    num_tokens = sum(count_tokens_batch(tokenizer, texts))
+    results = {"tokenize_tokens": num_tokens}
+    for name, count in (
+        ("single", lambda: [count_tokens(tokenizer, text) for text in texts]),
+        ("batch", lambda: count_tokens_batch(tokenizer, texts)),
+    ):
+        seconds = _best_of(context.args.repeat, count)
+        results[f"tokenize_{name}_seconds"] = seconds
+        results[f"tokenize_{name}_tokens_per_second"] = num_tokens / seconds
+    return results
+
+
+def bench_convert(context: Context) -> Dict[str, float]:
+    """Convert articles against the fake server with the ``--convert-engine``."""
+    args = context.args
+    data = context.data.head(args.convert_articles)
+    with open(ROOT_FOLDER / "prompts.yaml", "r") as file:
+        template = yaml.safe_load(file)["markdown_conversion"]
+
+    with (
+        FakeLLMServer(
+            latency=args.llm_latency,
+            seconds_per_token=args.llm_seconds_per_token,
+            error_rate=args.llm_error_rate,
+            straggler_rate=args.llm_straggler_rate,
+            straggler_latency=args.llm_straggler_latency,
+            max_concurrency=args.llm_max_concurrency,
+            retry_after=0.1,
+            seed=args.seed,
+        ) as server,
+        tempfile.TemporaryDirectory() as folder,
+    ):
+        environ = {
+            "OPENROUTER_API_BASE": server.base_url,
+            "OPENROUTER_API_KEY": "benchmark",
+        }
+        previous = {name: os.environ.get(name) for name in environ}
+        os.environ.update(environ)
+        try:
+            db_path = str(Path(folder) / "database.db")
+            initialize_db(db_path)
+            start = time.perf_counter()
+            if args.convert_engine == "async":
+                report = asyncio.run(
+                    async_process_dataframe(
+                        data,
+                        "benchmark/model",
+                        template,
+                        context.tokenizer,
+                        "benchmark/tokenizer",
+                        db_path,
+                        max_tokens=args.max_tokens,
+                        initial_concurrency=args.initial_concurrency,
+                        max_concurrency=args.convert_workers,
+                        hedge_quantile=args.hedge_quantile,
+                    )
+                )
+            else:
+                with MarkdownConverter(
+                    "benchmark/model",
+                    template,
+                    max_connections=args.convert_workers,
+                    hedge_quantile=args.hedge_quantile,
+                ) as converter:
+                    report = parallel_process_dataframe(
+                        data,
+                        "benchmark/model",
+                        template,
+                        context.tokenizer,
+                        "benchmark/tokenizer",
+                        db_path,
+                        max_tokens=args.max_tokens,
+                        max_workers=args.convert_workers,
+                        converter=converter,
+                    )
+            seconds = time.perf_counter() - start
+        finally:
+            for name, value in previous.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+    return {
+        "convert_seconds": seconds,
+        "convert_articles_per_second": len(data) / seconds,
+        "convert_predicted_makespan": report["predicted_makespan"],
+        "convert_requests": server.stats["requests"],
+        "convert_rate_limited": server.stats["rate_limited"],
+        "convert_server_errors": server.stats["errors"],
+        "convert_stragglers": server.stats["stragglers"],
+        "convert_max_in_flight": server.stats["max_in_flight"],
+    }
+
+
+def bench_database(context: Context) -> Dict[str, float]:
+    """Insert the articles one transaction at a time and with ``DatabaseWriter``."""
+    rows = [
+        (row.id, row.title, row.text, row.text, 0, 0, "benchmark")
+        for row in context.data.head(context.args.db_rows).itertuples()
+    ]
+
+    def insert_one_by_one(db_path: str) -> None:
+        for row in rows:
+            insert_row(db_path, *row)
+
+    def insert_with_writer(db_path: str) -> None:
+        with DatabaseWriter(db_path) as writer:
+            for row in rows:
+                writer.insert_row(*row)
+
+    results = {}
+    for name, insert in (
+        ("insert_row", insert_one_by_one),
+        ("writer", insert_with_writer),
+    ):
+        timings = []
+        for _ in range(context.args.repeat):
+            with tempfile.TemporaryDirectory() as folder:
+                db_path = str(Path(folder) / "database.db")
+                initialize_db(db_path)
+                start = time.perf_counter()
+                insert(db_path)
+                timings.append(time.perf_counter() - start)
+        results[f"db_{name}_seconds"] = min(timings)
+        results[f"db_{name}_rows_per_second"] = len(rows) / min(timings)
+    return results
+
+
+# Benchmarks of the run, in order
+BENCHMARKS: Dict[str, Callable[[Context], Dict[str, float]]] = {
+    "parse": bench_parse,
+    "dewiki": bench_dewiki,
+    "tokenize": bench_tokenize,
+    "convert": bench_convert,
+    "database": bench_database,
+}
+
+
+def run_benchmarks(
+    args: argparse.Namespace, benchmarks: Optional[List[str]] = None
+) -> Dict[str, Any]:
+    """
+    Run the benchmarks and save their results.
+
+    The results are saved in ``benchmarks/results/<time>-<commit>.json`` and
+    appended to ``benchmarks/results/history.jsonl``, then compared with the
+    last run with the same parameters on the same machine.
+
+    Args:
+        args (argparse.Namespace): Parameters of the run (see ``parse_args``).
+        benchmarks (List[str], optional): Benchmarks to run. Defaults to all
+            the ``BENCHMARKS``.
+
+    Returns:
+        Dict[str, Any]: The run: its commit, parameters and results.
+    """
+    params = {
+        name: value
+        for name, value in vars(args).items()
+        if name not in ("only", "threshold", "check")
+    }
+    params.update(
+        {
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+        }
+    )
+    commit, dirty = _git_commit()
+
+    context = Context(args)
+    results = {}
+    for name in benchmarks or BENCHMARKS:
+        print(f"Running the {name} benchmark...")
+        results[name] = BENCHMARKS[name](context)
+
+    run = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "dirty": dirty,
+        "params": params,
+        "results": results,
+    }
+    previous = _previous_run(params)
+
+    RESULTS_FOLDER.mkdir(parents=True, exist_ok=True)
+    result_file = RESULTS_FOLDER / (
+        f"{time.strftime('%Y%m%d-%H%M%S')}-{commit}{'-dirty' if dirty else ''}.json"
+    )
+    result_file.write_text(json.dumps(run, indent=4))
+    with open(HISTORY_FILE, "a") as file:
+        file.write(json.dumps(run) + "\n")
+    print(f"Results saved to {result_file}")
+
+    run["regressions"] = compare_runs(previous, run, args.threshold)
+    return run
+
+
+def compare_runs(
+    previous: Optional[Dict[str, Any]], current: Dict[str, Any], threshold: float
+) -> List[str]:
+    """
+    Print the results of a run next to those of a previous run.
+
+    Metrics ending in ``_seconds`` are better when lower, and those ending in
+    ``_per_second`` when higher. The other metrics are only printed.
+
+    Args:
+        previous (Dict[str, Any], optional): The previous run, if any.
+        current (Dict[str, Any]): The current run.
+        threshold (float): Relative change above which a metric that got worse
+            is reported as a regression, e.g. 0.1 for 10%.
+
+    Returns:
+        List[str]: Names of the metrics that regressed.
+    """
+    if previous is not None:
+        print(f"Compared with {previous['commit']} ({previous['created_at']}):")
+    regressions = []
+    for benchmark, metrics in current["results"].items():
+        before = (previous or {}).get("results", {}).get(benchmark, {})
+        for name, value in metrics.items():
+            line = f"  {name:<45} {value:>14.4f}"
+            if name in before and before[name]:
+                change = value / before[name] - 1
+                worse = (name.endswith("_per_second") and change < -threshold) or (
+                    name.endswith("_seconds") and change > threshold
+                )
+                line += f" {before[name]:>14.4f} {change:>+8.1%}"
+                if worse:
+                    line += "  REGRESSION"
+                    regressions.append(name)
+            print(line)
+    if regressions:
+        print(f"{len(regressions)} metrics regressed by more than {threshold:.0%}")
+    return regressions
+
+
+def _best_of(repeat: int, function: Callable[[], Any]) -> float:
+    """Shortest of ``repeat`` timings of a function, in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def _git_commit() -> tuple:
+    """Short hash of the current commit, and whether the tree has changes."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT_FOLDER,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=ROOT_FOLDER,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+    return commit, bool(status.strip())
+
+
+def _previous_run(params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Last run of the history with the same parameters."""
+    if not HISTORY_FILE.exists():
+        return None
+    previous = None
+    with open(HISTORY_FILE, "r") as file:
+        for line in file:
+            run = json.loads(line)
+            if run["params"] == params:
+                previous = run
+    return previous
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse the command line arguments of the benchmarks."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline offline on a synthetic dump."
+    )
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS))
+    parser.add_argument("--articles", type=int, default=2000)
+    parser.add_argument("--mean-words", type=int, default=300)
+    parser.add_argument(
+        "--distribution", choices=["fixed", "lognormal", "pareto"], default="lognormal"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--parse-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--dewiki-engine", default="wikitextparser")
+    parser.add_argument("--convert-articles", type=int, default=500)
+    parser.add_argument("--convert-workers", type=int, default=32)
+    parser.add_argument(
+        "--convert-engine", choices=["thread", "async"], default="thread"
+    )
+    parser.add_argument("--initial-concurrency", type=int, default=16)
+    parser.add_argument("--max-tokens", type=int, default=7000)
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--llm-seconds-per-token", type=float, default=0.0)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-straggler-rate", type=float, default=0.0)
+    parser.add_argument("--llm-straggler-latency", type=float, default=10.0)
+    parser.add_argument("--llm-max-concurrency", type=int)
+    parser.add_argument("--hedge-quantile", type=float)
+    parser.add_argument("--db-rows", type=int, default=2000)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative change reported as a regression (default: 0.1).",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Exit with an error if a metric regressed.",
+    )
+    return parser.parse_args(argv)
+
+
+# Main block to run the benchmarks, from the root of the repository:
+# python -m benchmarks.run_benchmarks
+if __name__ == "__main__":
+    args = parse_args()
+    run = run_benchmarks(args, args.only)
+    if args.check and run["regressions"]:
+        sys.exit(1)
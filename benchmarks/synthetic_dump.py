@@ -0,0 +1,206 @@
+"""Synthetic multistream dumps in the format of the Simple Wikipedia dumps."""
+
+import bz2
+import hashlib
+import math
+import random
+from pathlib import Path
+from typing import Tuple, Union
+from xml.sax.saxutils import escape
+
+# Vocabulary of the generated articles
+_WORDS = (
+    "the of and in to a is was for on as by with from that at his it an were "
+    "are which this be or has had first one their its new after who they two "
+    "her she also been other all but more than when there into most city river "
+    "music year people school film song album team war state world country "
+    "football church station village county family population water early "
+    "government named known became history born played university started"
+).split()
+
+_SITEINFO = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.11/" \
+version="0.11" xml:lang="en">
+  <siteinfo>
+    <sitename>Wikipedia</sitename>
+    <dbname>simplewiki</dbname>
+  </siteinfo>
+"""
+
+_PAGE = """  <page>
+    <title>{title}</title>
+    <ns>{ns}</ns>
+    <id>{id}</id>
+{redirect}    <revision>
+      <id>{revision_id}</id>
+      <model>wikitext</model>
+      <format>text/x-wiki</format>
+      <text bytes="{size}" xml:space="preserve">{text}</text>
+      <sha1>{sha1}</sha1>
+    </revision>
+  </page>
+"""
+
+# Length distributions of the articles, as functions of the mean number of words
+_DISTRIBUTIONS = {
+    "fixed": lambda rng, mean: mean,
+    # Most articles are stubs, with a long tail of long articles, as in Simple
+    # Wikipedia
+    "lognormal": lambda rng, mean: rng.lognormvariate(math.log(mean) - 0.72, 1.2),
+    "pareto": lambda rng, mean: mean / 3 * rng.paretovariate(1.5),
+}
+
+
+def generate_dump(
+    folder: Union[str, Path],
+    num_articles: int = 10_000,
+    mean_words: int = 300,
+    distribution: str = "lognormal",
+    pages_per_stream: int = 100,
+    seed: int = 0,
+) -> Tuple[Path, Path]:
+    """
+    Generate a synthetic multistream dump and its index.
+
+    The dump has the format of the Simple Wikipedia dumps, and its pages hold
+    the wiki markup found in real articles: sections, links, bold and italic
+    text, templates, references, lists, tables, files and categories.
+    Redirects, disambiguation pages and talk pages, which are not kept by
+    ``format_wiki_text``, are mixed in as well. The same arguments always
+    produce the same dump, so a dump already in ``folder`` is reused.
+
+    Example:
+        >>> dump_file, index_file = generate_dump("benchmarks/.data", 1000)
+        >>> format_wiki_text(dump_file, "data.parquet", 4, index_file)
+
+    Args:
+        folder (str | Path): Folder of the dump and index files.
+        num_articles (int): Number of pages (default: 10000).
+        mean_words (int): Mean number of words of an article (default: 300).
+        distribution (str): Distribution of the article lengths, one of
+            "fixed", "lognormal" and "pareto" (default: "lognormal").
+        pages_per_stream (int): Number of pages per bz2 stream (default: 100,
+            as in the Wikipedia dumps).
+        seed (int): Seed of the random generator (default: 0).
+
+    Returns:
+        Tuple[Path, Path]: Paths to the dump and to its index.
+    """
+    if distribution not in _DISTRIBUTIONS:
+        raise ValueError(
+            f"Unknown distribution: {distribution}. "
+            f"Available distributions: {', '.join(_DISTRIBUTIONS)}"
+        )
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    name = f"synthetic-{num_articles}-{mean_words}-{distribution}-{seed}"
+    dump_file = folder / f"{name}-multistream.xml.bz2"
+    index_file = folder / f"{name}-multistream-index.txt.bz2"
+    if dump_file.exists() and index_file.exists():
+        return dump_file, index_file
+
+    rng = random.Random(seed)
+    length = _DISTRIBUTIONS[distribution]
+    with open(dump_file, "wb") as dump, bz2.open(index_file, "wt") as index:
+        dump.write(bz2.compress(_SITEINFO.encode("utf-8")))
+        for first in range(1, num_articles + 1, pages_per_stream):
+            offset = dump.tell()
+            pages = []
+            for id in range(first, min(first + pages_per_stream, num_articles + 1)):
+                title, ns, text, redirect = _page(rng, id, length(rng, mean_words))
+                pages.append(
+                    _PAGE.format(
+                        title=escape(title),
+                        ns=ns,
+                        id=id,
+                        redirect=(
+                            '    <redirect title="Main Page" />\n' if redirect else ""
+                        ),
+                        revision_id=1_000_000 + id,
+                        size=len(text.encode("utf-8")),
+                        text=escape(text),
+                        sha1=hashlib.sha1(text.encode("utf-8")).hexdigest(),
+                    )
+                )
+                index.write(f"{offset}:{id}:{title}\n")
+            dump.write(bz2.compress("".join(pages).encode("utf-8")))
+        dump.write(bz2.compress(b"</mediawiki>\n"))
+
+    return dump_file, index_file
+
+
+def _page(rng: random.Random, id: int, num_words: float) -> Tuple[str, int, str, bool]:
+    """Generate the title, namespace, text and redirect flag of a page."""
+    title = f"{_sentence(rng, rng.randint(1, 3)).title()} {id}"
+    kind = rng.random()
+    if kind < 0.04:
+        return title, 0, "#REDIRECT [[Main Page]]", True
+    if kind < 0.06:
+        return f"Talk:{title}", 1, _paragraph(rng, 40), False
+    if kind < 0.07:
+        links = "\n".join(f"* [[{title} ({i})]]" for i in range(3))
+        return f"{title} (disambiguation)", 0, f"{links}\n{{{{disambiguation}}}}", False
+
+    blocks = [
+        (
+            f"{{{{Infobox settlement\n| name = {title}\n| population = "
+            f"{rng.randint(100, 10**6)}\n}}}}"
+            if rng.random() < 0.3
+            else ""
+        ),
+        _paragraph(rng, max(10, num_words * 0.3)),
+    ]
+    remaining = max(0.0, num_words * 0.7)
+    while remaining > 0:
+        level = rng.choice("==" * 3 + "===")
+        words = min(remaining, rng.randint(40, 400))
+        blocks.append(f"{level} {_sentence(rng, 2).title()} {level}")
+        choice = rng.random()
+        if choice < 0.15:
+            blocks.append(
+                "\n".join(f"* {_sentence(rng, 8)}" for _ in range(int(words / 8) + 1))
+            )
+        elif choice < 0.2:
+            rows = "\n|-\n".join(
+                f"| {_sentence(rng, 2)} || {rng.randint(1, 1000)}"
+                for _ in range(int(words / 6) + 1)
+            )
+            blocks.append(f'{{| class="wikitable"\n! Name !! Value\n|-\n{rows}\n|}}')
+        else:
+            blocks.append(_paragraph(rng, words))
+        remaining -= words
+
+    blocks.append("== References ==\n{{reflist}}")
+    blocks.append(f"[[Category:{_sentence(rng, 2).title()}]]")
+    return title, 0, "\n\n".join(block for block in blocks if block), False
+
+
+def _paragraph(rng: random.Random, num_words: float) -> str:
+    """Generate a paragraph of about ``num_words`` words with inline markup."""
+    sentences = []
+    words = 0
+    while words < num_words:
+        n = rng.randint(6, 24)
+        sentence = _sentence(rng, n).capitalize()
+        markup = rng.random()
+        if markup < 0.3:
+            target = _sentence(rng, 2)
+            sentence += f" [[{target.title()}|{target}]]"
+        elif markup < 0.4:
+            sentence += f" '''{_sentence(rng, 2)}'''"
+        elif markup < 0.45:
+            sentence += f" ''{_sentence(rng, 2)}''"
+        elif markup < 0.5:
+            sentence += (
+                f"<ref>{{{{cite web|url=https://example.org/{rng.randint(1, 10**6)}"
+                f"|title={_sentence(rng, 3)}}}}}</ref>"
+            )
+        elif markup < 0.52:
+            sentence = f"[[File:Example {rng.randint(1, 100)}.jpg|thumb|{sentence}]]"
+        sentences.append(sentence + ".")
+        words += n
+    return " ".join(sentences)
+
+
+def _sentence(rng: random.Random, num_words: int) -> str:
+    """Generate ``num_words`` random words."""
+    return " ".join(rng.choices(_WORDS, k=num_words))
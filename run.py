@@ -1,42 +1,733 @@
+import argparse
+import asyncio
+import os
+import time
+from contextlib import contextmanager
 from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Union,
+)
 
 import yaml
 from dotenv import load_dotenv
 
-from src.download_wiki_file import download_simplewiki_dump
-from src.format_wiki_text import format_wiki_text
+from src.utils.cache import ConversionCache
+from src.utils.metrics import METRICS, MetricsExporter
+from src.utils.pipeline import PipelineState, file_fingerprint, fingerprint
+from src.utils.retry import RetryPolicy
+from src.utils.tokenizer import TokenizerLike, load_tokenizer
+
+# The stages import pandas, pyarrow and the LLM clients, which take over a
+# second, so each function imports the modules of its stages when it runs
+if TYPE_CHECKING:
+    from src.sharding import ShardPlan
 
 # Load environment variables (e.g., API keys)
 load_dotenv()
 
+# Stages of the pipeline, in order
+STAGES = ["download", "parse", "tokenize", "dedupe", "convert", "export"]
+
+
+def run(stages: Optional[Iterable[str]] = None, force: bool = False):
+    """
+    Run the stages of the pipeline, skipping those that are up to date.
+
+    Every stage records the fingerprint of its inputs in
+    ``data/pipeline_state.json`` when it completes: the ``Last-Modified``,
+    ``ETag`` and size of the dump, the fingerprint of the previous stages,
+    the config values it uses and the hash of the prompt. A stage is skipped
+    when its inputs did not change and its output exists, so a run that
+    crashed goes straight back to the stage that did not complete. The
+    conversion also skips the articles already in the database.
+
+    The throughput, latencies and queue depths of the stages are written to
+    ``metrics_folder``, live as a Prometheus textfile and at the end as a JSON
+    report.
+
+    Args:
+        stages (Iterable[str], optional): Stages to run. The stages that are
+            not selected are neither run nor checked, and the fingerprints
+            they recorded are used. Defaults to all the stages.
+        force (bool): Run the selected stages even if they are up to date
+            (default: False).
+    """
+    config = _load_config()
+    with _export_metrics(config):
+        _run_stages(config, set(stages or STAGES), force)
+
+
+def run_shards(merge: bool = False, num_shards: Optional[int] = None):
+    """
+    Run the pipeline over several nodes that share the data folder.
+
+    The dump is split into ``num_shards`` shards (see ``src.sharding``). Every
+    node runs ``run_shards()``, which claims shards one at a time and parses,
+    tokenizes and converts them into their own folder, until all the shards
+    are done. A node that dies leaves its shard to the others once its claim
+    is ``shard_stale_after`` seconds old, and a shard with failed articles is
+    left to another node. The dump must be downloaded first, e.g. with
+    ``python run.py --only download``.
+
+    Then ``run_shards(merge=True)`` merges the shards into the database and
+    the Parquet file, checking for conflicts, and runs the export stage.
 
-def run():
-    # Load paths from the YAML file
+    Args:
+        merge (bool): Merge the shards instead of processing them
+            (default: False).
+        num_shards (int, optional): Number of shards. Defaults to the
+            ``num_shards`` of the config.
+    """
+    from src.download_wiki_file import DUMP_URL
+    from src.sharding import (
+        ShardClaims,
+        load_shard_plan,
+        merge_shards,
+        run_shard_worker,
+    )
+
+    config = _load_config()
+    shard_folder = Path(config["shard_folder"])
+    output_file = Path(config["processed_folder"]) / config["output_file"]
+    db_file = Path(config["data_folder"]) / config["db_file"]
+
+    if merge:
+        with _export_metrics(config):
+            merge_shards(
+                shard_folder,
+                db_file,
+                output_file,
+                row_group_size=config["parquet_row_group_size"],
+                compression=config["parquet_compression"],
+            )
+            _run_stages(config, {"export"}, force=False)
+        return
+
+    dump_file = Path(config["raw_folder"]) / DUMP_URL.split("/")[-1]
+    if not dump_file.exists():
+        raise FileNotFoundError(
+            f"{dump_file} does not exist, run `python run.py --only download` first"
+        )
+    num_shards = num_shards or config["num_shards"]
+    plan = load_shard_plan(shard_folder, dump_file, num_shards)
+    claims = ShardClaims(shard_folder, num_shards, config["shard_stale_after"])
+    tokenizers = []
+
+    def process_shard(index: int) -> bool:
+        if not tokenizers:
+            tokenizers.append(
+                load_tokenizer(config["model_hf"], config.get("tokenizer_file"))
+            )
+        return _run_shard(config, plan, index, dump_file, tokenizers[0])
+
+    # Every node keeps its own metrics
+    with _export_metrics(config, claims.owner):
+        completed = run_shard_worker(claims, process_shard)
+    print(f"All shards are done, {len(completed)} of them by this node.")
+
+
+def _load_config() -> Dict[str, Any]:
+    """Load the paths and parameters of ``run_config.yaml``."""
     config_path = Path(__file__).parent / "run_config.yaml"
     with open(config_path, "r") as file:
-        config = yaml.safe_load(file)
+        return yaml.safe_load(file)
+
+
+@contextmanager
+def _export_metrics(config: Dict[str, Any], subfolder: Optional[str] = None):
+    """Export the metrics to ``metrics_folder``, if set, while running."""
+    if not config.get("metrics_folder"):
+        yield
+        return
+    folder = Path(config["metrics_folder"]) / (subfolder or "")
+    # Throughput, latency and queue metrics of every stage, updated live
+    with MetricsExporter(folder, config["metrics_interval"]):
+        yield
+
+
+def _format_kwargs(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Arguments of ``format_wiki_text`` from the config."""
+    return {
+        "num_workers": config.get("parse_workers") or os.cpu_count() or 1,
+        "row_group_size": config["parquet_row_group_size"],
+        "compression": config["parquet_compression"],
+        "dewiki_engine": config["dewiki_engine"],
+    }
+
+
+def _load_template(config: Dict[str, Any]) -> str:
+    """Load the prompt of the conversion."""
+    with open(config["prompts_file"], "r") as file:
+        return yaml.safe_load(file)["markdown_conversion"]
+
+
+def _dedupe_key(config: Dict[str, Any], key: str) -> Optional[str]:
+    """Fingerprint of the inputs of the dedupe stage, None if it is disabled."""
+    if not config.get("near_duplicates"):
+        return None
+    return fingerprint(
+        key,
+        config["near_duplicate_threshold"],
+        config["minhash_num_perm"],
+        config["minhash_bands"],
+        config["shingle_size"],
+    )
+
+
+def _convert_key(
+    config: Dict[str, Any],
+    parse_key: str,
+    tokenize_key: Optional[str],
+    template: str,
+    dedupe_key: Optional[str] = None,
+) -> str:
+    """Fingerprint of the inputs of the convert stage."""
+    return fingerprint(
+        parse_key,
+        tokenize_key,
+        dedupe_key and config["near_duplicate_max_changed_ratio"],
+        dedupe_key,
+        config["model_hf"],
+        config["model_openrouter"],
+        fingerprint(template),
+        config["max_tokens"],
+        config["fast_path"] and config["fast_path_max_tokens"],
+        config["stub_tokens"],
+        config["pack_tokens"],
+    )
+
+
+def _convert(
+    config: Dict[str, Any],
+    parquet_file: Path,
+    db_file: Path,
+    tokenizer: TokenizerLike,
+    template: str,
+    cache_path: Optional[Union[str, Path]],
+) -> Dict[str, float]:
+    """Convert the articles of a Parquet file into a database."""
+    from src.convert_to_markdown import MarkdownConverter
+    from src.convert_with_rules import FastPathClassifier
+    from src.dedupe_wiki_text import convert_near_duplicates
+    from src.utils.async_parallel import async_stream_process_parquet
+    from src.utils.database import initialize_db
+    from src.utils.parallel import stream_process_parquet
+
+    print(f"Converting the articles with {config['model_openrouter']}...")
+    # Disable tokenizers parallelism to avoid warnings
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    initialize_db(str(db_file))
+    cache = ConversionCache(cache_path) if cache_path else None
+    fast_path = None
+    if config["fast_path"]:
+        fast_path = FastPathClassifier(max_tokens=config["fast_path_max_tokens"])
+    engine = config.get("convert_engine", "thread")
+    if engine not in ("thread", "async"):
+        raise ValueError(
+            f"Unknown convert engine '{engine}'. Available engines: thread, async"
+        )
+    converter = None
+    if engine == "thread":
+        converter = MarkdownConverter(
+            config["model_openrouter"],
+            template,
+            max_connections=config["convert_workers"],
+            cache=cache,
+            request_timeout=config["request_timeout"],
+            retry_policy=RetryPolicy(
+                max_attempts=config["max_attempts"],
+                base_delay=config["retry_base_delay"],
+                max_delay=config["retry_max_delay"],
+            ),
+            hedge_quantile=config["hedge_quantile"],
+        )
+
+    def convert(skip_duplicates: bool) -> Dict[str, float]:
+        if engine == "async":
+            # Each pass runs its own event loop, with its own converter
+            return asyncio.run(
+                async_stream_process_parquet(
+                    parquet_file,
+                    config["model_openrouter"],
+                    template,
+                    tokenizer,
+                    config["model_hf"],
+                    str(db_file),
+                    max_tokens=config["max_tokens"],
+                    batch_size=config["parquet_row_group_size"],
+                    initial_concurrency=config["initial_concurrency"],
+                    max_concurrency=config["max_concurrency"],
+                    tokens_per_minute=config["tokens_per_minute"],
+                    max_attempts=config["max_attempts"],
+                    request_timeout=config["request_timeout"],
+                    hedge_quantile=config["hedge_quantile"],
+                    cache=cache,
+                    stub_tokens=config["stub_tokens"],
+                    pack_tokens=config["pack_tokens"],
+                    fast_path=fast_path,
+                    skip_duplicates=skip_duplicates,
+                )
+            )
+        return stream_process_parquet(
+            parquet_file,
+            config["model_openrouter"],
+            template,
+            tokenizer,
+            config["model_hf"],
+            str(db_file),
+            max_tokens=config["max_tokens"],
+            max_workers=config["convert_workers"],
+            batch_size=config["parquet_row_group_size"],
+            converter=converter,
+            stub_tokens=config["stub_tokens"],
+            pack_tokens=config["pack_tokens"],
+            fast_path=fast_path,
+            skip_duplicates=skip_duplicates,
+        )
+
+    try:
+        # The exemplars first, then the near-duplicates from their conversion
+        report = convert(skip_duplicates=bool(config.get("near_duplicates")))
+        report["near_duplicates"] = 0
+        if report["duplicates"]:
+            print("Converting the near-duplicates from their exemplar...")
+            near = convert_near_duplicates(
+                parquet_file,
+                str(db_file),
+                tokenizer,
+                batch_size=config["parquet_row_group_size"],
+                max_changed_ratio=config["near_duplicate_max_changed_ratio"],
+                num_workers=config.get("parse_workers") or os.cpu_count() or 1,
+            )
+            # The near-duplicates too different from their exemplar go to the LLM
+            rest = convert(skip_duplicates=False)
+            report = {
+                **rest,
+                "processed": report["processed"] + rest["processed"],
+                "rule_based": report["rule_based"] + rest["rule_based"],
+                "skipped": report["skipped"],
+                "duplicates": report["duplicates"],
+                "actual_makespan": report["actual_makespan"] + rest["actual_makespan"],
+                "near_duplicates": near["converted"],
+            }
+    finally:
+        if converter is not None:
+            converter.close()
+        if cache is not None:
+            cache.close()
+    print(
+        f"Conversion complete! {report['processed']} articles converted, "
+        f"{report['rule_based']} with rules, {report['near_duplicates']} from "
+        f"their near-duplicate, {report['failed']} failed"
+    )
+    return report
+
+
+def _dedupe(config: Dict[str, Any], parquet_file: Path) -> Dict[str, float]:
+    """Flag the near-duplicate articles of a Parquet file."""
+    from src.dedupe_wiki_text import dedupe_wiki_text
+
+    print("Clustering the near-duplicate articles with MinHash and LSH...")
+    report = dedupe_wiki_text(
+        parquet_file,
+        threshold=config["near_duplicate_threshold"],
+        num_perm=config["minhash_num_perm"],
+        bands=config["minhash_bands"],
+        shingle_size=config["shingle_size"],
+        row_group_size=config["parquet_row_group_size"],
+        compression=config["parquet_compression"],
+    )
+    print(
+        f"Clustering complete! {report['near_duplicates']} near-duplicates of "
+        f"{report['articles']} articles, in {report['clusters']} clusters "
+        f"(largest: {report['largest_cluster']})"
+    )
+    return report
+
+
+def _run_shard(
+    config: Dict[str, Any],
+    plan: "ShardPlan",
+    index: int,
+    dump_file: Path,
+    tokenizer: TokenizerLike,
+) -> bool:
+    """
+    Parse, tokenize, dedupe and convert a shard into its folder.
+
+    The steps that are up to date are skipped, e.g. when taking over the shard
+    of a node that died. The near-duplicates are only looked for within the
+    shard.
+
+    Returns:
+        bool: Whether the shard is complete, i.e. no article failed.
+    """
+    from src.format_wiki_text import format_wiki_text
+    from src.sharding import SHARD_DB_FILE, SHARD_PARQUET_FILE
+    from src.tokenize_wiki_text import tokenize_wiki_text
+
+    shard_folder = plan.shard_folder(config["shard_folder"], index)
+    parquet_file = shard_folder / SHARD_PARQUET_FILE
+    db_file = shard_folder / SHARD_DB_FILE
+    state = PipelineState(shard_folder / "pipeline_state.json")
+    format_kwargs = _format_kwargs(config)
+
+    parse_key = fingerprint(
+        plan.dump_file,
+        plan.dump_size,
+        plan.ranges[index],
+        {name: value for name, value in format_kwargs.items() if name != "num_workers"},
+    )
+    if not state.is_up_to_date("parse", parse_key, [parquet_file]):
+        state.start("parse")
+        format_wiki_text(
+            dump_file, parquet_file, byte_range=plan.ranges[index], **format_kwargs
+        )
+        state.complete("parse", parse_key)
+
+    tokenize_key = None
+    if config.get("count_tokens"):
+        tokenize_key = fingerprint(parse_key, config["model_hf"])
+        if not state.is_up_to_date("tokenize", tokenize_key, [parquet_file]):
+            state.start("tokenize")
+            tokenize_wiki_text(
+                parquet_file,
+                tokenizer,
+                row_group_size=config["parquet_row_group_size"],
+                compression=config["parquet_compression"],
+            )
+            state.complete("tokenize", tokenize_key)
+
+    dedupe_key = _dedupe_key(config, tokenize_key or parse_key)
+    if dedupe_key and not state.is_up_to_date("dedupe", dedupe_key, [parquet_file]):
+        state.start("dedupe")
+        _dedupe(config, parquet_file)
+        state.complete("dedupe", dedupe_key)
+
+    template = _load_template(config)
+    convert_key = _convert_key(config, parse_key, tokenize_key, template, dedupe_key)
+    if state.is_up_to_date("convert", convert_key, [db_file]):
+        return True
+    state.start("convert")
+    # Every shard has its own cache, as SQLite is not safe on network file systems
+    cache_path = None
+    if config.get("conversion_cache"):
+        cache_path = shard_folder / Path(config["conversion_cache"]).name
+    report = _convert(config, parquet_file, db_file, tokenizer, template, cache_path)
+    if report["failed"]:
+        return False
+    state.complete("convert", convert_key)
+    return True
+
+
+class _StageRunner:
+    """Selected stages of ``run``, skipped when they are up to date."""
+
+    def __init__(self, state: PipelineState, stages: Set[str], force: bool):
+        """
+        Prepare the run of the selected stages.
+
+        Args:
+            state (PipelineState): State of the pipeline.
+            stages (Set[str]): Stages to run.
+            force (bool): Run the selected stages even if they are up to date.
+        """
+        self.state = state
+        self.stages = stages
+        self.force = force
+        self._started: Dict[str, float] = {}
+
+    def should_run(self, stage: str, key: str, outputs: List[Path]) -> bool:
+        """Start a stage if it is selected and not up to date."""
+        if stage not in self.stages:
+            return False
+        if not self.force and self.state.is_up_to_date(stage, key, outputs):
+            print(f"Stage {stage} is up to date, skipping it.")
+            return False
+        self.start(stage)
+        return True
+
+    def start(self, stage: str) -> None:
+        """Mark a stage as started."""
+        self.state.start(stage)
+        self._started[stage] = time.monotonic()
+
+    def complete(self, stage: str, key: str, **values: Any) -> None:
+        """Mark a stage as completed, and record its duration."""
+        self.state.complete(stage, key, **values)
+        METRICS.set_gauge(
+            "stage_seconds", time.monotonic() - self._started[stage], stage=stage
+        )
+
+
+def _run_stages(config: Dict[str, Any], stages: Set[str], force: bool):
+    """Run the selected stages of ``run``, in order."""
+    output_file = Path(config["processed_folder"]) / config["output_file"]
+    db_file = Path(config["data_folder"]) / config["db_file"]
+    state = PipelineState(Path(config["data_folder"]) / "pipeline_state.json")
+    runner = _StageRunner(state, stages, force)
+
+    tokenizers: List[TokenizerLike] = []
+
+    def get_tokenizer() -> TokenizerLike:
+        if not tokenizers:
+            tokenizers.append(
+                load_tokenizer(config["model_hf"], config.get("tokenizer_file"))
+            )
+        return tokenizers[0]
+
+    parse_key = _run_download_and_parse(config, runner, output_file, db_file)
+    tokenize_key = _run_tokenize(config, runner, output_file, parse_key, get_tokenizer)
+    dedupe_key = _run_dedupe(config, runner, output_file, tokenize_key or parse_key)
+    convert_key = _convert_key(
+        config, parse_key, tokenize_key, _load_template(config), dedupe_key
+    )
+    _run_convert(config, runner, output_file, db_file, convert_key, get_tokenizer)
+    _run_export(config, runner, db_file)
+
+
+def _run_download_and_parse(
+    config: Dict[str, Any], runner: _StageRunner, output_file: Path, db_file: Path
+) -> str:
+    """
+    Run the download and parse stages.
+
+    Returns:
+        str: Fingerprint of the inputs of the parse stage.
+    """
+    from src.download_wiki_file import DUMP_URL, get_dump_metadata
 
     raw_folder = config["raw_folder"]
-    processed_folder = config["processed_folder"]
-    output_file = Path(processed_folder) / config["output_file"]
+    state = runner.state
+    format_kwargs = _format_kwargs(config)
+    format_options = {
+        name: value for name, value in format_kwargs.items() if name != "num_workers"
+    }
+    # Articles kept from the previous file must have been parsed the same way
+    format_key = fingerprint(format_options)
+    incremental = (
+        config.get("incremental")
+        and output_file.exists()
+        and state.value("parse", "format_key") == format_key
+    )
+
+    # Step 1: Download the dump, unless the local copy is the latest one
+    dump_file = Path(raw_folder) / DUMP_URL.split("/")[-1]
+    if "download" in runner.stages:
+        remote = get_dump_metadata(DUMP_URL)
+        download_key = fingerprint(
+            remote["last_modified"], remote["etag"], remote["file_size"]
+        )
+    else:
+        download_key = state.key("download")
+    parse_key = fingerprint(download_key, format_options)
+    parse_stale = "parse" in runner.stages and (
+        runner.force or not state.is_up_to_date("parse", parse_key, [output_file])
+    )
 
-    # Download the dump file and get the metadata
-    print("Starting download of the Simple Wikipedia dump...")
-    file_path, dump_date, metadata_file = download_simplewiki_dump(raw_folder)
+    if runner.should_run("download", download_key, [dump_file]):
+        if config.get("download_while_parsing") and parse_stale and not incremental:
+            # Steps 1 and 2 at once: parse the dump while it is being downloaded
+            from src.download_and_format import download_and_format_wiki_text
 
-    print(f"Download complete! File saved to {file_path}")
-    print(f"Dump date: {dump_date}")
-    print(f"Metadata saved in: {metadata_file}")
+            print("Downloading and processing the Simple Wikipedia dump...")
+            runner.start("parse")
+            file_path, dump_date, metadata_file = download_and_format_wiki_text(
+                raw_folder, output_file, **format_kwargs
+            )
+            print(f"Download complete! File saved to {file_path}")
+            print(f"Dump date: {dump_date}")
+            print(f"Processing complete! Processed file saved as {output_file}")
+            runner.complete("parse", parse_key, format_key=format_key)
+        else:
+            from src.download_wiki_file import download_simplewiki_dump
+
+            print("Starting download of the Simple Wikipedia dump...")
+            file_path, dump_date, metadata_file = download_simplewiki_dump(
+                raw_folder, num_connections=config["download_connections"]
+            )
+            print(f"Download complete! File saved to {file_path}")
+            print(f"Dump date: {dump_date}")
+            print(f"Metadata saved in: {metadata_file}")
+        runner.complete("download", download_key)
 
     # Step 2: Process the downloaded file
-    print(f"Processing the dump file {file_path}...")
-    format_wiki_text(file_path, output_file)
-    print(f"Processing complete! Processed file saved as {output_file}")
+    if runner.should_run("parse", parse_key, [output_file]):
+        print(f"Processing the dump file {dump_file}...")
+        if incremental:
+            from src.incremental import update_wiki_text
+
+            # Only re-process the articles that changed since the previous dump
+            update_wiki_text(
+                dump_file,
+                output_file,
+                output_file,
+                db_path=db_file if db_file.exists() else None,
+                **format_kwargs,
+            )
+        else:
+            from src.format_wiki_text import format_wiki_text
+
+            format_wiki_text(dump_file, output_file, **format_kwargs)
+        print(f"Processing complete! Processed file saved as {output_file}")
+        runner.complete("parse", parse_key, format_key=format_key)
+    return parse_key
+
+
+def _run_tokenize(
+    config: Dict[str, Any],
+    runner: _StageRunner,
+    output_file: Path,
+    parse_key: str,
+    get_tokenizer: Callable[[], TokenizerLike],
+) -> Optional[str]:
+    """
+    Run the tokenize stage, if enabled.
+
+    Returns:
+        str, optional: Fingerprint of its inputs, or None if it is disabled.
+    """
+    if not config.get("count_tokens"):
+        return None
+    # Step 3: Count the tokens of every article (and of its sections)
+    tokenize_key = fingerprint(parse_key, config["model_hf"])
+    # The counts kept by an incremental update are valid for the same model
+    same_model = runner.state.value("tokenize", "model_hf") == config["model_hf"]
+    if runner.should_run("tokenize", tokenize_key, [output_file]):
+        from src.tokenize_wiki_text import tokenize_wiki_text
 
-    # Step 3: Iteratively transform articles' text into Markdown
+        print(f"Counting tokens with the {config['model_hf']} tokenizer...")
+        tokenize_wiki_text(
+            output_file,
+            get_tokenizer(),
+            row_group_size=config["parquet_row_group_size"],
+            compression=config["parquet_compression"],
+            keep_counts=same_model,
+        )
+        runner.complete("tokenize", tokenize_key, model_hf=config["model_hf"])
+    return tokenize_key
+
+
+def _run_dedupe(
+    config: Dict[str, Any], runner: _StageRunner, output_file: Path, key: str
+) -> Optional[str]:
+    """
+    Run the dedupe stage, if enabled.
+
+    Returns:
+        str, optional: Fingerprint of its inputs, or None if it is disabled.
+    """
+    # Step 4: Cluster the near-duplicate articles (e.g. generated from a
+    # template), so that only one article per cluster is sent to the LLM
+    dedupe_key = _dedupe_key(config, key)
+    if dedupe_key and runner.should_run("dedupe", dedupe_key, [output_file]):
+        _dedupe(config, output_file)
+        runner.complete("dedupe", dedupe_key)
+    return dedupe_key
+
+
+def _run_convert(
+    config: Dict[str, Any],
+    runner: _StageRunner,
+    output_file: Path,
+    db_file: Path,
+    convert_key: str,
+    get_tokenizer: Callable[[], TokenizerLike],
+):
+    """Run the convert stage, leaving it incomplete if any article failed."""
+    if not runner.should_run("convert", convert_key, [db_file]):
+        return
+    # Step 5: Iteratively transform articles' text into Markdown
     # and insert it into a SQLite DB
+    report = _convert(
+        config,
+        output_file,
+        db_file,
+        get_tokenizer(),
+        _load_template(config),
+        config.get("conversion_cache"),
+    )
+    # Articles that failed are retried by the next run
+    if not report["failed"]:
+        runner.complete("convert", convert_key)
+
+
+def _run_export(config: Dict[str, Any], runner: _StageRunner, db_file: Path):
+    """Run the export stage, if enabled."""
+    from src.export_dataset import MANIFEST_FILE, export_dataset
+
+    if not config.get("export_folder") or not db_file.exists():
+        return
+    # Step 6: Export the converted articles to Parquet shards
+    export_folder = Path(config["export_folder"])
+    export_key = fingerprint(
+        runner.state.key("convert"),
+        file_fingerprint(db_file),
+        file_fingerprint(f"{db_file}-wal"),
+        config["export_shard_size_mb"],
+        config["export_compression"],
+    )
+    if runner.should_run("export", export_key, [export_folder / MANIFEST_FILE]):
+        print(f"Exporting the articles of {db_file}...")
+        manifest_path = export_dataset(
+            db_file,
+            export_folder,
+            shard_size_bytes=config["export_shard_size_mb"] * 1024**2,
+            num_workers=config.get("export_workers"),
+            row_group_size=config["parquet_row_group_size"],
+            compression=config["export_compression"],
+        )
+        print(f"Export complete! Manifest saved as {manifest_path}")
+        runner.complete("export", export_key)
 
 
 # Main block to run the script
 if __name__ == "__main__":
-    run()
+    parser = argparse.ArgumentParser(
+        description="Build the Simple Wikipedia dataset, skipping up to date stages."
+    )
+    selection = parser.add_mutually_exclusive_group()
+    selection.add_argument(
+        "--from",
+        dest="from_stage",
+        choices=STAGES,
+        help="Run this stage and the following ones.",
+    )
+    selection.add_argument(
+        "--only", nargs="+", choices=STAGES, help="Run only these stages."
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Run the selected stages even if they are up to date.",
+    )
+    selection.add_argument(
+        "--shard-worker",
+        action="store_true",
+        help="Parse, tokenize and convert shards of the dump until all are done.",
+    )
+    selection.add_argument(
+        "--merge-shards",
+        action="store_true",
+        help="Merge the shards into the database, then export it.",
+    )
+    parser.add_argument(
+        "--num-shards", type=int, help="Number of shards (default: from the config)."
+    )
+    args = parser.parse_args()
+
+    if args.shard_worker or args.merge_shards:
+        run_shards(merge=args.merge_shards, num_shards=args.num_shards)
+    else:
+        stages = args.only
+        if args.from_stage:
+            stages = STAGES[STAGES.index(args.from_stage) :]
+        run(stages, force=args.force)
@@ -0,0 +1,269 @@
+"""Conversion of simple articles to Markdown without a language model."""
+
+import re
+import unicodedata
+from difflib import SequenceMatcher
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Value of the ``model`` column for articles converted without the LLM
+RULE_BASED_MODEL = "rule-based"
+# and for those converted by editing the conversion of a near-duplicate
+NEAR_DUPLICATE_MODEL = "near-duplicate"
+
+# Headings marked with `=` signs, e.g. "== Subtitle =="
+_HEADING = re.compile(r"^(={1,6})\s*([^=].*?)\s*={1,6}\s*$")
+
+# Lines that the LLM would turn into lists, tables or code blocks
+_LIST_LINE = re.compile(r"^\s*(?:[*#•\-–]|\d+[.)])\s")
+_CODE_LIKE = re.compile(r"[{}<>|`;\\]|^\s{4,}\S|\b(?:def|class|function|return)\b")
+
+_SPACES = re.compile(r"[ \t\u00a0]+")
+_SPACE_BEFORE_PUNCTUATION = re.compile(r"\s+([,.;:!?)])")
+_EMPTY_BRACKETS = re.compile(r"\(\s*[,;]?\s*\)")
+
+# Words and the whitespace between them, compared by transfer_markdown
+_TOKEN = re.compile(r"\s+|\S+")
+
+
+class FastPathClassifier:
+    r"""
+    Decide which articles ``convert_text_with_rules`` can convert instead of the LLM.
+
+    An article is eligible when it is short and only holds headings and plain
+    paragraphs, which is all that the ``markdown_conversion`` prompt changes in
+    such articles. Anything that the LLM would turn into lists, tables or code
+    blocks, or would have to clean up, goes to the LLM.
+
+    Example:
+        >>> classifier = FastPathClassifier(max_tokens=200)
+        >>> classifier.is_eligible("= April =\n\nApril is a month.", 8)
+        True
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 200,
+        max_sections: int = 3,
+        max_non_latin_ratio: float = 0.0,
+    ):
+        """
+        Set the limits of the eligible articles.
+
+        Args:
+            max_tokens (int): Maximum number of tokens of an eligible article
+                (default: 200).
+            max_sections (int): Maximum number of headings, including the title
+                (default: 3).
+            max_non_latin_ratio (float): Maximum share of letters from other
+                scripts than Latin, which the rules remove (default: 0).
+        """
+        self.max_tokens = max_tokens
+        self.max_sections = max_sections
+        self.max_non_latin_ratio = max_non_latin_ratio
+
+    def is_eligible(self, text: str, n_tokens: int) -> bool:
+        """
+        Check whether an article can be converted with the rules.
+
+        Args:
+            text (str): The article text.
+            n_tokens (int): Number of tokens of the text.
+
+        Returns:
+            bool: True if the rules give the same result as the LLM.
+        """
+        if n_tokens > self.max_tokens:
+            return False
+
+        lines = text.splitlines()
+        headings = sum(1 for line in lines if _HEADING.match(line))
+        if headings > self.max_sections:
+            return False
+        if any(_LIST_LINE.match(line) for line in lines):
+            return False
+        if any(_CODE_LIKE.search(line) for line in lines if not _HEADING.match(line)):
+            return False
+
+        letters = [char for char in text if char.isalpha()]
+        non_latin = sum(1 for char in letters if not _is_latin(char))
+        return non_latin <= self.max_non_latin_ratio * len(letters)
+
+    def split(
+        self, texts: Sequence[str], token_counts: Sequence[int]
+    ) -> Tuple[List[int], List[int]]:
+        """
+        Route articles to the rules or to the LLM.
+
+        Args:
+            texts (Sequence[str]): The article texts.
+            token_counts (Sequence[int]): Number of tokens of each text.
+
+        Returns:
+            Tuple[List[int], List[int]]: Positions of the articles to convert
+            with the rules, and with the LLM.
+        """
+        rules, llm = [], []
+        for position, (text, n_tokens) in enumerate(
+            zip(texts, token_counts, strict=True)
+        ):
+            if self.is_eligible(text, n_tokens):
+                rules.append(position)
+            else:
+                llm.append(position)
+        return rules, llm
+
+
+def convert_text_with_rules(raw_text: str) -> str:
+    """
+    Convert raw text into Markdown without a language model.
+
+    The mechanical rules of the ``markdown_conversion`` prompt are applied:
+
+    - Titles with `=` signs become Markdown headings of the same level.
+    - Every line of text is a paragraph, separated by a blank line (lines of
+      wiki markup are paragraphs, as a single line break is not rendered).
+    - Characters from other scripts than Latin are removed.
+    - Extra spaces and spaces before punctuation are removed.
+    - The "References" section is left out.
+
+    Args:
+        raw_text (str): The input text to be formatted.
+
+    Returns:
+        str: The formatted markdown text.
+    """
+    blocks: List[str] = []
+    skip_level: Optional[int] = None  # level of the section being left out
+
+    for line in raw_text.splitlines():
+        heading = _HEADING.match(line)
+        if heading:
+            level = len(heading.group(1))
+            title = _clean(heading.group(2))
+            if skip_level is not None and level <= skip_level:
+                skip_level = None
+            if title.lower() == "references":
+                skip_level = level
+            elif skip_level is None and title:
+                blocks.append(f"{'#' * level} {title}")
+            continue
+
+        line = _clean(line)
+        if line and skip_level is None:
+            blocks.append(line)
+
+    return "\n\n".join(blocks)
+
+
+def transfer_markdown(
+    exemplar_text: str,
+    exemplar_markdown: str,
+    raw_text: str,
+    max_changed_ratio: float = 0.25,
+) -> Optional[str]:
+    r"""
+    Convert a text from the conversion of a near-duplicate, the exemplar.
+
+    The differences of the text with the exemplar are applied to the
+    conversion of the exemplar, without a language model.
+
+    Template-generated articles (years, towns, species) differ in a few words,
+    which the conversion copies verbatim. The words of the exemplar are
+    aligned with its Markdown, and every word that differs between the
+    exemplar and the text is replaced in the Markdown. The transfer fails when
+    a difference touches a part of the exemplar that the conversion rewrote,
+    e.g. a line turned into a list item, as the result would then be a guess.
+
+    Example:
+        >>> transfer_markdown(
+        ...     "== Paris ==\nParis is a city.", "## Paris\n\nParis is a city.",
+        ...     "== Lyon ==\\nLyon is a city.",
+        ... )
+        '## Lyon\\n\\nLyon is a city.'
+
+    Args:
+        exemplar_text (str): Raw text of the exemplar.
+        exemplar_markdown (str): Conversion of the exemplar.
+        raw_text (str): The input text to be formatted.
+        max_changed_ratio (float): Maximum share of the words and spaces of
+            the text that may differ from the exemplar (default: 0.25).
+
+    Returns:
+        str, optional: The formatted markdown text, or None if it can not be
+        derived from the exemplar.
+    """
+    exemplar, markdown, alignment = _align_exemplar(exemplar_text, exemplar_markdown)
+    tokens = _TOKEN.findall(raw_text)
+
+    edits = [
+        opcode
+        for opcode in SequenceMatcher(
+            None, exemplar, tokens, autojunk=False
+        ).get_opcodes()
+        if opcode[0] != "equal"
+    ]
+    changed = sum(max(i2 - i1, j2 - j1) for _, i1, i2, j1, j2 in edits)
+    if changed > max_changed_ratio * len(tokens):
+        return None
+
+    # From the end, so that the positions of the earlier edits stay valid
+    result = list(markdown)
+    for _, i1, i2, j1, j2 in reversed(edits):
+        if i1 < i2:
+            # Replaced or deleted tokens, which must be contiguous in the Markdown
+            start = alignment.get(i1)
+            if start is None or any(
+                alignment.get(i) != start + i - i1 for i in range(i1, i2)
+            ):
+                return None
+            result[start : start + i2 - i1] = tokens[j1:j2]
+        else:
+            # Inserted tokens, between two tokens copied next to each other
+            before, after = alignment.get(i1 - 1), alignment.get(i1)
+            if i1 == 0 and after is not None:
+                start = after
+            elif i1 == len(exemplar) and before is not None:
+                start = before + 1
+            elif before is not None and after == before + 1:
+                start = after
+            else:
+                return None
+            result[start:start] = tokens[j1:j2]
+    return "".join(result)
+
+
+@lru_cache(maxsize=256)
+def _align_exemplar(
+    exemplar_text: str, exemplar_markdown: str
+) -> Tuple[List[str], List[str], Dict[int, int]]:
+    """
+    Tokenize an exemplar and its conversion, and align their tokens.
+
+    Returns the tokens of both, and the position in the conversion of each token
+    of the exemplar copied verbatim. Cached, as all the near-duplicates of a
+    cluster share their exemplar.
+    """
+    exemplar = _TOKEN.findall(exemplar_text)
+    markdown = _TOKEN.findall(exemplar_markdown)
+    alignment: Dict[int, int] = {}
+    for tag, i1, i2, j1, _ in SequenceMatcher(
+        None, exemplar, markdown, autojunk=False
+    ).get_opcodes():
+        if tag == "equal":
+            alignment.update((i1 + k, j1 + k) for k in range(i2 - i1))
+    return exemplar, markdown, alignment
+
+
+def _clean(text: str) -> str:
+    """Remove non Latin letters, extra spaces and leftover empty brackets."""
+    text = "".join(char for char in text if not char.isalpha() or _is_latin(char))
+    text = _EMPTY_BRACKETS.sub("", text)
+    text = _SPACES.sub(" ", text)
+    text = _SPACE_BEFORE_PUNCTUATION.sub(r"\1", text)
+    return text.strip()
+
+
+def _is_latin(char: str) -> bool:
+    """Whether a letter belongs to the Latin script (including accents)."""
+    return char.isascii() or unicodedata.name(char, "").startswith("LATIN")
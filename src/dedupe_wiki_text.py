@@ -0,0 +1,468 @@
+"""Detection and conversion of near-duplicate articles."""
+
+import re
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+from src.convert_with_rules import NEAR_DUPLICATE_MODEL, transfer_markdown
+from src.utils.database import DatabaseWriter, get_article_ids
+from src.utils.metrics import METRICS
+from src.utils.parquet_writer import ParquetStreamWriter
+from src.utils.tokenizer import TokenizerLike, count_tokens_batch
+
+# Column added by dedupe_wiki_text: id of the exemplar of the cluster of
+# near-duplicates of the article, or null for exemplars and unique articles
+DUPLICATE_OF_COLUMN = "duplicate_of"
+
+_WORD = re.compile(r"\w+")
+
+# Number of (shingle, permutation) hashes computed at once, to bound memory
+_HASH_CHUNK = 1 << 22
+
+# Multiplier combining hashes (the 64-bit FNV prime)
+_PRIME = np.uint64(0x100000001B3)
+
+
+def minhash_signatures(
+    texts: Sequence[str], num_perm: int = 128, shingle_size: int = 3, seed: int = 0
+) -> np.ndarray:
+    """
+    Compute the MinHash signatures of texts, with numpy.
+
+    The texts are lowercased and split into words, and their shingles (runs of
+    ``shingle_size`` words) are hashed. The words are hashed all at once with
+    ``pd.util.hash_array``, and so are the shingles, the permutations and the
+    minimums, so no Python code runs per word. Two signatures agree on a share
+    of their values that estimates the Jaccard similarity of the shingles of
+    the texts.
+
+    Args:
+        texts (Sequence[str]): The texts.
+        num_perm (int): Number of hash functions (default: 128).
+        shingle_size (int): Number of words per shingle (default: 3).
+        seed (int): Seed of the hash functions (default: 0). Signatures are
+            only comparable with the same seed.
+
+    Returns:
+        np.ndarray: Signature of each text, of shape ``(len(texts), num_perm)``
+        and type uint32. Texts without words have a signature of zeros.
+    """
+    # Permutations ``(a * x + b) >> 32`` of the 64-bit shingle hashes, with
+    # odd multipliers (multiply-shift hashing, wrapping around 2^64)
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, np.iinfo(np.uint64).max, num_perm, dtype=np.uint64)
+    a |= np.uint64(1)
+    b = rng.integers(0, np.iinfo(np.uint64).max, num_perm, dtype=np.uint64)
+
+    words = [_WORD.findall(text.lower()) for text in texts]
+    lengths = np.array([len(text_words) for text_words in words], dtype=np.int64)
+    flat_words = np.array(
+        [word for text_words in words for word in text_words], dtype=object
+    )
+    word_hashes = pd.util.hash_array(flat_words)
+
+    # Hash of the shingle starting at every word. Shingles running into the
+    # next text are dropped, and texts shorter than a shingle are reduced to
+    # their first word, so that every text with words has a shingle.
+    shingles = word_hashes.copy()
+    for offset in range(1, shingle_size):
+        shingles[:-offset] = shingles[:-offset] * _PRIME ^ word_hashes[offset:]
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    counts = np.maximum(lengths - shingle_size + 1, np.minimum(lengths, 1))
+    starts = np.repeat(offsets[:-1], counts) + _ranges(counts)
+    shingles = np.where(
+        np.repeat(lengths < shingle_size, counts),
+        word_hashes[starts],
+        shingles[starts],
+    )
+
+    signatures = np.zeros((len(texts), num_perm), dtype=np.uint32)
+    shingle_offsets = np.concatenate(([0], np.cumsum(counts)))
+    nonempty = np.flatnonzero(counts)
+    chunk = max(1, _HASH_CHUNK // num_perm)
+    i = 0
+    while i < len(nonempty):
+        # Texts whose shingles fit in a chunk, or a single text
+        j = int(
+            np.searchsorted(
+                shingle_offsets[nonempty + 1],
+                shingle_offsets[nonempty[i]] + chunk,
+                side="right",
+            )
+        )
+        j = max(j, i + 1)
+        first = shingle_offsets[nonempty[i]]
+        x = shingles[first : shingle_offsets[nonempty[j - 1] + 1], None]
+        hashes = ((x * a + b) >> np.uint64(32)).astype(np.uint32)
+        signatures[nonempty[i:j]] = np.minimum.reduceat(
+            hashes, shingle_offsets[nonempty[i:j]] - first, axis=0
+        )
+        i = j
+    return signatures
+
+
+def cluster_near_duplicates(
+    signatures: np.ndarray, bands: int = 32, threshold: float = 0.7
+) -> np.ndarray:
+    """
+    Cluster texts by their MinHash signatures with locality sensitive hashing (LSH).
+
+    The signatures are cut into ``bands`` bands, and texts whose signatures
+    are identical in at least one band are candidates, found by sorting the
+    hashes of each band instead of comparing all the pairs. A candidate joins
+    the cluster of the first text of its bucket when their signatures agree on
+    at least ``threshold`` of their values. Clusters are the connected
+    components of these pairs.
+
+    Args:
+        signatures (np.ndarray): Signatures of ``minhash_signatures``.
+        bands (int): Number of bands, which must divide the signature length
+            (default: 32). More bands find less similar candidates.
+        threshold (float): Minimum estimated Jaccard similarity of
+            near-duplicates (default: 0.7).
+
+    Returns:
+        np.ndarray: For every text, the position of the first text of its
+        cluster (its own position for the first text and for unique texts).
+    """
+    num_texts, num_perm = signatures.shape
+    if num_perm % bands:
+        raise ValueError(f"{bands} bands do not divide {num_perm} permutations")
+    rows = num_perm // bands
+    # Texts without words are never near-duplicates
+    valid = np.flatnonzero(signatures.any(axis=1))
+
+    pairs = []
+    for band in range(bands):
+        band_hashes = np.zeros(len(valid), dtype=np.uint64)
+        for column in range(band * rows, (band + 1) * rows):
+            band_hashes = band_hashes * _PRIME + signatures[valid, column]
+        order = np.argsort(band_hashes, kind="stable")
+        sorted_hashes = band_hashes[order]
+        same = sorted_hashes[1:] == sorted_hashes[:-1]
+        if not same.any():
+            continue
+        # First text of the bucket of every text, in sorted order
+        bucket_starts = np.where(
+            np.concatenate(([True], ~same)), np.arange(len(order)), 0
+        )
+        leaders = np.maximum.accumulate(bucket_starts)
+        members = np.flatnonzero(np.concatenate(([False], same)))
+        # Pair of the first text of the bucket and of a text, as one number
+        pairs.append(valid[order[leaders[members]]] * num_texts + valid[order[members]])
+
+    labels = np.arange(num_texts)
+    if not pairs:
+        return labels
+    pairs = np.unique(np.concatenate(pairs))
+    left, right = np.divmod(pairs, num_texts)
+    similar = np.zeros(len(pairs), dtype=bool)
+    chunk = max(1, _HASH_CHUNK // num_perm)
+    for start in range(0, len(pairs), chunk):
+        end = start + chunk
+        agreement = signatures[left[start:end]] == signatures[right[start:end]]
+        similar[start:end] = agreement.mean(axis=1) >= threshold
+    return _connected_components(labels, left[similar], right[similar])
+
+
+def dedupe_wiki_text(
+    filename: Union[str, Path],
+    savepath: Optional[Union[str, Path]] = None,
+    threshold: float = 0.7,
+    num_perm: int = 128,
+    bands: int = 32,
+    shingle_size: int = 3,
+    batch_size: int = 10_000,
+    row_group_size: int = 10_000,
+    compression: Optional[str] = "snappy",
+) -> Dict[str, float]:
+    """
+    Find the clusters of near-duplicate articles of a Parquet file.
+
+    The file is the output of ``format_wiki_text`` (or of ``tokenize_wiki_text``).
+
+    Simple Wikipedia has many template-generated pages (years, small towns,
+    species) whose texts differ in a few words. They are clustered with
+    MinHash and LSH (see ``minhash_signatures`` and
+    ``cluster_near_duplicates``), in time linear in the size of the corpus.
+    The first article of every cluster, in file order, is its exemplar, and
+    the ``duplicate_of`` column of the other articles holds its id. The
+    conversion step converts the exemplars first, and the near-duplicates
+    from their conversion (see ``convert_near_duplicates``).
+
+    The texts are read one batch at a time, and only the signatures are kept
+    in memory (512 bytes per article with 128 permutations).
+
+    Args:
+        filename (str | Path): Parquet file of the articles.
+        savepath (str | Path, optional): Path to the output Parquet file.
+            Defaults to ``filename``, which is replaced.
+        threshold (float): Minimum estimated Jaccard similarity of the word
+            shingles of near-duplicates (default: 0.7).
+        num_perm (int): Number of MinHash permutations (default: 128).
+        bands (int): Number of LSH bands (default: 32).
+        shingle_size (int): Number of words per shingle (default: 3).
+        batch_size (int): Number of articles hashed at a time (default: 10000).
+        row_group_size (int): Number of articles per Parquet row group
+            (default: 10000).
+        compression (str, optional): Parquet compression codec
+            (default: "snappy").
+
+    Returns:
+        Dict[str, float]: Number of articles, of clusters, of near-duplicates
+        (articles of a cluster other than its exemplar), size of the largest
+        cluster, share of near-duplicates, and duration, in seconds.
+    """
+    start = time.monotonic()
+    savepath = Path(savepath or filename)
+    parquet_file = pq.ParquetFile(filename)
+    num_articles = parquet_file.metadata.num_rows
+
+    signatures = np.zeros((num_articles, num_perm), dtype=np.uint32)
+    ids = np.zeros(num_articles, dtype=np.int64)
+    position = 0
+    with tqdm(total=num_articles, desc="Hashing articles") as pbar:
+        for batch in parquet_file.iter_batches(
+            batch_size=batch_size, columns=["id", "text"]
+        ):
+            end = position + batch.num_rows
+            with METRICS.time("minhash_batch_seconds"):
+                signatures[position:end] = minhash_signatures(
+                    batch["text"].to_pylist(), num_perm, shingle_size
+                )
+            ids[position:end] = batch["id"].to_numpy()
+            position = end
+            pbar.update(batch.num_rows)
+
+    print("Clustering near-duplicates...")
+    with METRICS.time("lsh_seconds"):
+        exemplars = cluster_near_duplicates(signatures, bands, threshold)
+    del signatures
+
+    is_duplicate = exemplars != np.arange(num_articles)
+    duplicate_of = pa.array(ids[exemplars], pa.int64(), mask=~is_duplicate)
+
+    columns = [
+        name for name in parquet_file.schema_arrow.names if name != DUPLICATE_OF_COLUMN
+    ]
+    schema = pa.schema(
+        [parquet_file.schema_arrow.field(name) for name in columns]
+        + [pa.field(DUPLICATE_OF_COLUMN, pa.int64())]
+    )
+    with ParquetStreamWriter(savepath, schema, row_group_size, compression) as writer:
+        position = 0
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+            end = position + batch.num_rows
+            writer.write_table(
+                pa.Table.from_batches([batch]).append_column(
+                    DUPLICATE_OF_COLUMN, duplicate_of[position:end]
+                )
+            )
+            position = end
+
+    cluster_sizes = np.bincount(exemplars[is_duplicate], minlength=num_articles)
+    num_duplicates = int(is_duplicate.sum())
+    report = {
+        "articles": num_articles,
+        "clusters": int(np.count_nonzero(cluster_sizes)),
+        "near_duplicates": num_duplicates,
+        "largest_cluster": int(cluster_sizes.max(initial=0)) + 1,
+        "near_duplicate_share": num_duplicates / max(num_articles, 1),
+        "seconds": time.monotonic() - start,
+    }
+    for name in ("clusters", "near_duplicates", "largest_cluster"):
+        METRICS.set_gauge(f"dedupe_{name}", report[name])
+    print(
+        f"{num_duplicates} near-duplicates ({report['near_duplicate_share']:.1%}) "
+        f"in {report['clusters']} clusters, the largest of "
+        f"{report['largest_cluster']} articles, saved to {savepath}"
+    )
+    return report
+
+
+def convert_near_duplicates(
+    filename: Union[str, Path],
+    db_path: str,
+    tokenizer: TokenizerLike,
+    batch_size: int = 10_000,
+    max_changed_ratio: float = 0.25,
+    num_workers: int = 1,
+) -> Dict[str, int]:
+    """
+    Convert the near-duplicates from the conversion of their exemplar.
+
+    The near-duplicates are those of the Parquet file of ``dedupe_wiki_text``,
+    and they are converted without the LLM.
+
+    The exemplars must be in the database already (see the ``skip_duplicates``
+    argument of ``stream_process_parquet``). The conversion of a near-duplicate
+    is derived with ``transfer_markdown`` and stored with "near-duplicate" as
+    its model. Near-duplicates whose conversion can not be derived, or whose
+    exemplar is missing, are left to the LLM. With more than one worker, the
+    near-duplicates of a batch are split across a pool of processes.
+
+    Args:
+        filename (str | Path): Parquet file with a ``duplicate_of`` column.
+        db_path (str): SQLite database path.
+        tokenizer (TokenizerLike): Tokenizer for counting tokens.
+        batch_size (int): Number of articles read at a time (default: 10000).
+        max_changed_ratio (float): Maximum share of the text that may differ
+            from the exemplar (default: 0.25).
+        num_workers (int): Number of processes deriving the conversions
+            (default: 1).
+
+    Returns:
+        Dict[str, int]: Number of near-duplicates converted from their
+        exemplar, and left to the LLM.
+    """
+    report = {"converted": 0, "left": 0}
+    parquet_file = pq.ParquetFile(filename)
+    if DUPLICATE_OF_COLUMN not in parquet_file.schema_arrow.names:
+        return report
+
+    columns = ["id", "title", "text", DUPLICATE_OF_COLUMN]
+    if "token_count" in parquet_file.schema_arrow.names:
+        columns.append("token_count")
+    done_ids = get_article_ids(db_path)
+    conn = sqlite3.connect(db_path)
+    writer = DatabaseWriter(db_path)
+    pbar = tqdm(total=parquet_file.metadata.num_rows, desc="Converting near-duplicates")
+    executor = ProcessPoolExecutor(num_workers) if num_workers > 1 else None
+    transfer = partial(_transfer_all, max_changed_ratio=max_changed_ratio)
+    try:
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+            pbar.update(batch.num_rows)
+            data = batch.to_pandas()
+            data = data[
+                data[DUPLICATE_OF_COLUMN].notna()
+                & ~data["id"].map(done_ids.__contains__).astype(bool)
+            ]
+            if data.empty:
+                continue
+            exemplars = _read_conversions(
+                conn, data[DUPLICATE_OF_COLUMN].astype("int64").unique().tolist()
+            )
+            has_exemplar = data[DUPLICATE_OF_COLUMN].astype("int64").isin(exemplars)
+            report["left"] += int((~has_exemplar).sum())
+            data = data[has_exemplar]
+            tasks = [
+                (*exemplars[int(exemplar_id)], text)
+                for exemplar_id, text in zip(
+                    data[DUPLICATE_OF_COLUMN], data["text"], strict=True
+                )
+            ]
+            if executor is None:
+                markdown_texts = transfer(tasks)
+            else:
+                chunk_size = -(-len(tasks) // num_workers)
+                chunks = [
+                    tasks[start : start + chunk_size]
+                    for start in range(0, len(tasks), chunk_size)
+                ]
+                markdown_texts = [
+                    markdown_text
+                    for chunk in executor.map(transfer, chunks)
+                    for markdown_text in chunk
+                ]
+
+            converted = pd.Series([bool(text) for text in markdown_texts], data.index)
+            report["left"] += int((~converted).sum())
+            data = data[converted]
+            markdown_texts = [text for text in markdown_texts if text]
+            if data.empty:
+                continue
+            if "token_count" in data and data["token_count"].notna().all():
+                raw_text_tokens = data["token_count"].astype("int64").tolist()
+            else:
+                raw_text_tokens = count_tokens_batch(tokenizer, data["text"].tolist())
+            markdown_text_tokens = count_tokens_batch(tokenizer, markdown_texts)
+            for row, markdown_text, n_tokens, n_markdown_tokens in zip(
+                data.itertuples(index=False),
+                markdown_texts,
+                raw_text_tokens,
+                markdown_text_tokens,
+                strict=True,
+            ):
+                writer.insert_row(
+                    id=int(row.id),
+                    title=row.title,
+                    raw_text=row.text,
+                    markdown_text=markdown_text,
+                    raw_text_tokens=n_tokens,
+                    markdown_text_tokens=n_markdown_tokens,
+                    model=NEAR_DUPLICATE_MODEL,
+                )
+            report["converted"] += len(data)
+            METRICS.inc("articles_converted_total", len(data), method="near-duplicate")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        pbar.close()
+        writer.close()
+        conn.close()
+
+    print(
+        f"{report['converted']} near-duplicates converted from their exemplar, "
+        f"{report['left']} left to the LLM"
+    )
+    return report
+
+
+def _transfer_all(
+    tasks: List[Tuple[str, str, str]], max_changed_ratio: float
+) -> List[Optional[str]]:
+    """Run ``transfer_markdown`` over (exemplar, Markdown, text) tuples."""
+    return [transfer_markdown(*task, max_changed_ratio) for task in tasks]
+
+
+def _read_conversions(conn: sqlite3.Connection, ids: List[int]) -> Dict[int, tuple]:
+    """Raw and Markdown texts of the articles of the database with these ids."""
+    conversions = {}
+    # SQLite limits the number of parameters of a query
+    for start in range(0, len(ids), 500):
+        chunk = ids[start : start + 500]
+        rows = conn.execute(
+            "SELECT id, raw_text, markdown_text FROM articles "
+            f"WHERE id IN ({', '.join('?' * len(chunk))})",
+            chunk,
+        )
+        conversions.update((id, (raw, markdown)) for id, raw, markdown in rows)
+    return conversions
+
+
+def _ranges(counts: np.ndarray) -> np.ndarray:
+    """Concatenation of ``range(count)`` for every count, without a loop."""
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - counts, counts)
+
+
+def _connected_components(
+    labels: np.ndarray, left: np.ndarray, right: np.ndarray
+) -> np.ndarray:
+    """
+    Label every node with the smallest node of its connected component.
+
+    The labels of the ends of every edge are hooked to the smallest one, with
+    pointer jumping.
+    """
+    while True:
+        smallest = np.minimum(labels[left], labels[right])
+        if np.array_equal(labels[left], labels[right]):
+            return labels
+        np.minimum.at(labels, labels[left], smallest)
+        np.minimum.at(labels, labels[right], smallest)
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
@@ -0,0 +1,205 @@
+"""Parsing of the dump while it is being downloaded."""
+
+import threading
+from pathlib import Path
+from typing import AbstractSet, Iterator, List, Optional, Tuple, Union
+
+from src.download_wiki_file import DUMP_URL, download_simplewiki_dump
+from src.format_wiki_text import (
+    ARTICLE_SCHEMA,
+    BZ2_STREAM_HEADER,
+    parse_stream_ranges,
+)
+from src.utils.parquet_writer import ParquetStreamWriter
+
+# Minimum compressed size of the ranges handed to the parse workers
+_MIN_RANGE_BYTES = 4 * 1024 * 1024
+
+
+class _DownloadProgress:
+    """Number of bytes of the dump available on disk, shared between threads."""
+
+    def __init__(self):
+        self.available = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._condition = threading.Condition()
+
+    def update(self, available: int) -> None:
+        with self._condition:
+            self.available = max(self.available, available)
+            self._condition.notify_all()
+
+    def finish(self, size: int, error: Optional[BaseException] = None) -> None:
+        with self._condition:
+            self.available = max(self.available, size)
+            self.error = error
+            self.done = True
+            self._condition.notify_all()
+
+    def wait(self, position: int) -> Tuple[int, bool]:
+        """Block until more than ``position`` bytes are available, or the end."""
+        with self._condition:
+            while self.available <= position and not self.done:
+                self._condition.wait()
+            if self.error is not None:
+                raise self.error
+            return self.available, self.done
+
+
+def download_and_format_wiki_text(
+    destination_folder: Union[str, Path],
+    savepath: Union[str, Path],
+    num_workers: int = 1,
+    url: str = DUMP_URL,
+    row_group_size: int = 10_000,
+    compression: Optional[str] = "snappy",
+    dewiki_engine: str = "wikitextparser",
+    only_ids: Optional[AbstractSet[int]] = None,
+) -> Tuple[str, str, str]:
+    """
+    Download the dump and parse it at the same time.
+
+    The dump is downloaded in a background thread over a single connection,
+    so the file grows from its start. Every time complete bz2 streams are on
+    disk, they are handed to the parse workers, and the parsed articles are
+    written to the Parquet file as in ``format_wiki_text``. The total time is
+    close to the slowest of the download and the parsing, instead of their
+    sum. The downloaded bytes are buffered on disk, and the number of ranges
+    in flight is bounded, so memory usage does not depend on how far the
+    download is ahead of the parsing.
+
+    Args:
+        destination_folder (str | Path): The folder where the dump is saved.
+        savepath (str | Path): Path to the output Parquet file.
+        num_workers (int): Number of processes used to parse the dump
+            (default: 1).
+        url (str): URL of the dump (default: latest Simple Wikipedia
+            multistream dump).
+        row_group_size (int): Number of articles per Parquet row group
+            (default: 10000).
+        compression (str, optional): Parquet compression codec
+            (default: "snappy").
+        dewiki_engine (str): Engine converting wiki markup to plain text
+            (default: "wikitextparser").
+        only_ids (AbstractSet[int], optional): Only process these article ids.
+
+    Returns:
+        Tuple[str, str, str]: Same as ``download_simplewiki_dump``.
+    """
+    savepath = Path(savepath)
+    savepath.parent.mkdir(parents=True, exist_ok=True)
+
+    output_file = Path(destination_folder) / url.split("/")[-1]
+    progress = _DownloadProgress()
+    result = {}
+
+    def download() -> None:
+        try:
+            result["value"] = download_simplewiki_dump(
+                destination_folder, url=url, on_data=progress.update
+            )
+        except BaseException as error:
+            progress.finish(0, error)
+        else:
+            progress.finish(output_file.stat().st_size)
+
+    thread = threading.Thread(target=download, name="dump-download", daemon=True)
+    thread.start()
+
+    articles = parse_stream_ranges(
+        _iter_growing_ranges(output_file, progress, num_workers),
+        num_workers,
+        dewiki_engine,
+        only_ids,
+    )
+    with ParquetStreamWriter(
+        savepath, ARTICLE_SCHEMA, row_group_size, compression
+    ) as writer:
+        writer.write_many(articles)
+
+    thread.join()
+    print(f"Processed data ({writer.rows_written} articles) saved to {savepath}")
+    return result["value"]
+
+
+def _iter_growing_ranges(
+    output_file: Path, progress: _DownloadProgress, num_workers: int
+) -> Iterator[Tuple[bytes, int, int]]:
+    """
+    Yield ranges of complete bz2 streams as the dump is being downloaded.
+
+    A stream is known to be complete once the header of the next stream is on
+    disk. The bytes of each range are read here and sent to the workers, since
+    the partial file is renamed when the download finishes.
+
+    Args:
+        output_file (Path): Final path of the dump.
+        progress (_DownloadProgress): Download progress.
+        num_workers (int): Number of parse workers, used to size the ranges.
+
+    Yields:
+        Tuple[bytes, int, int]: Bytes, start and end offsets of each range.
+    """
+    overlap = 9  # length of the stream header minus one
+    min_range_size = _MIN_RANGE_BYTES if num_workers > 1 else 1
+    range_start = 0  # start of the next range to yield
+    boundaries: List[int] = []  # stream headers seen after range_start
+    scanned = 0  # bytes searched for stream headers
+
+    while True:
+        available, done = progress.wait(scanned)
+
+        if available > scanned:
+            scan_from = max(0, scanned - overlap)
+            buffer = _read_dump_bytes(output_file, scan_from, available, done)
+            for match in BZ2_STREAM_HEADER.finditer(buffer):
+                offset = scan_from + match.start()
+                if offset > max(boundaries, default=range_start):
+                    boundaries.append(offset)
+            scanned = available
+
+        # Once the download is done, the end of the file closes the last stream
+        if done and scanned > range_start:
+            boundaries.append(scanned)
+
+        for boundary in boundaries:
+            if boundary - range_start >= min_range_size or boundary == scanned:
+                data = _read_dump_bytes(output_file, range_start, boundary, done)
+                yield data, range_start, boundary
+                range_start = boundary
+        boundaries = [offset for offset in boundaries if offset > range_start]
+
+        if done:
+            return
+
+
+def _read_dump_bytes(
+    output_file: Path, start: int, end: int, download_done: bool
+) -> bytes:
+    """
+    Read bytes from the dump while it is downloaded into its ``.part`` file.
+
+    Args:
+        output_file (Path): Final path of the dump.
+        start (int): First byte to read.
+        end (int): End of the bytes to read (exclusive).
+        download_done (bool): Whether the download has finished, in which case
+            the dump is at its final path.
+
+    Returns:
+        bytes: The requested bytes.
+    """
+    part_file = output_file.with_name(output_file.name + ".part")
+    try:
+        if download_done:
+            raise FileNotFoundError(part_file)
+        infile = open(part_file, "rb")
+    except FileNotFoundError:
+        # Streamed downloads write to the final path, and ranged downloads
+        # move the partial file there once complete
+        infile = open(output_file, "rb")
+
+    with infile:
+        infile.seek(start)
+        return infile.read(end - start)
@@ -1,19 +1,77 @@
 import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import requests
 from tqdm import tqdm
 
+DUMP_URL = (
+    "https://dumps.wikimedia.org/simplewiki/latest/"
+    "simplewiki-latest-pages-articles-multistream.xml.bz2"
+)
 
-def download_simplewiki_dump(destination_folder: str) -> Tuple[str, str, str]:
+CHUNK_SIZE = 1024 * 1024
+
+# The download state is saved every time this many bytes have been written
+STATE_SAVE_INTERVAL = 16 * CHUNK_SIZE
+
+# Seconds to connect, and to wait for the next bytes, before giving up on a
+# request, so that a stalled connection fails instead of blocking forever
+TIMEOUT = (10, 60)
+
+# A range whose connection stalls or drops is resumed from its last written
+# byte up to this many times, after a random backoff of up to
+# RANGE_BASE_DELAY * 2^(attempt - 1) seconds, capped at RANGE_MAX_DELAY,
+# before failing the download (which the next run resumes from the saved state)
+RANGE_ATTEMPTS = 5
+RANGE_BASE_DELAY = 1.0
+RANGE_MAX_DELAY = 30.0
+
+# Failures of a connection, including a read timeout while streaming the body
+_CONNECTION_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+
+class RemoteFileChanged(Exception):
+    """The remote file changed while it was being downloaded."""
+
+
+def download_simplewiki_dump(
+    destination_folder: str,
+    num_connections: int = 1,
+    force: bool = False,
+    url: str = DUMP_URL,
+    on_data: Optional[Callable[[int], None]] = None,
+) -> Tuple[str, str, str]:
     """
     Downloads the latest dump from Simple Wikipedia and retrieves the
     associated date.
 
+    The download is skipped when the local copy matches the remote file
+    (same ``Last-Modified``, ``ETag`` and size, as recorded in the metadata
+    file). Interrupted downloads are resumed with HTTP range requests, and the
+    file can be fetched with several concurrent ranged connections.
+
     Args:
         destination_folder (str): The folder where the file will be saved.
+        num_connections (int): Number of concurrent connections used to fetch
+            the file, if the server supports range requests (default: 1).
+        force (bool): Download the file even if the local copy is up to date
+            (default: False).
+        url (str): URL of the dump (default: latest Simple Wikipedia
+            multistream dump).
+        on_data (Callable[[int], None], optional): Called while downloading
+            with the number of bytes, from the start of the file, that have
+            been written and can be read. Used to process the file while it
+            is being downloaded.
 
     Returns:
         Tuple[str, str, str]:
@@ -23,12 +81,65 @@ def download_simplewiki_dump(destination_folder: str) -> Tuple[str, str, str]:
     """
     destination_folder = Path(destination_folder)
 
-    url = (
-        "https://dumps.wikimedia.org/simplewiki/latest/"
-        "simplewiki-latest-pages-articles-multistream.xml.bz2"
-    )
+    remote = get_dump_metadata(url)
+    accepts_ranges = remote.pop("accepts_ranges")
+
+    dump_date = datetime.strptime(remote["last_modified"], "%a, %d %b %Y %H:%M:%S %Z")
+    formatted_date = dump_date.strftime("%Y-%m-%d")
+
+    destination_folder.mkdir(parents=True, exist_ok=True)
+
+    file_name = url.split("/")[-1]
+    output_file = destination_folder / file_name
+    metadata_file = destination_folder / "download_metadata.json"
+
+    if not force and _is_up_to_date(output_file, metadata_file, remote):
+        print(f"{output_file} is up to date, skipping download.")
+        return str(output_file), formatted_date, str(metadata_file)
+
+    if accepts_ranges and remote["file_size"]:
+        try:
+            _download_ranged(url, output_file, remote, num_connections, on_data)
+        except RemoteFileChanged:
+            # The bytes already passed to on_data belong to the previous file
+            if on_data is not None:
+                raise
+            print("The remote file changed during the download, starting over")
+            return download_simplewiki_dump(
+                destination_folder, num_connections, force, url, on_data
+            )
+    else:
+        _download_streamed(url, output_file, on_data)
+
+    metadata = {
+        "file_name": file_name,
+        "download_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "last_modified_date": formatted_date,
+        "file_size": output_file.stat().st_size,
+        "downloaded_file_path": str(output_file),
+        "last_modified": remote["last_modified"],
+        "etag": remote["etag"],
+    }
+
+    with open(metadata_file, "w") as f:
+        json.dump(metadata, f, indent=4)
+
+    return str(output_file), formatted_date, str(metadata_file)
 
-    response = requests.head(url)
+
+def get_dump_metadata(url: str = DUMP_URL) -> Dict[str, Any]:
+    """
+    Get the metadata of the remote dump file, without downloading it.
+
+    Args:
+        url (str): URL of the dump (default: latest Simple Wikipedia
+            multistream dump).
+
+    Returns:
+        Dict[str, Any]: ``last_modified``, ``etag`` and ``file_size`` of the
+        remote file, and whether the server ``accepts_ranges``.
+    """
+    response = requests.head(url, allow_redirects=True, timeout=TIMEOUT)
     if response.status_code != 200:
         raise Exception(f"Failed to access URL. Status code: {response.status_code}")
 
@@ -36,40 +147,330 @@ def download_simplewiki_dump(destination_folder: str) -> Tuple[str, str, str]:
     if not last_modified:
         raise Exception("Could not retrieve the last modified date from headers.")
 
-    dump_date = datetime.strptime(last_modified, "%a, %d %b %Y %H:%M:%S %Z")
-    formatted_date = dump_date.strftime("%Y-%m-%d")
+    return {
+        "last_modified": last_modified,
+        "etag": response.headers.get("ETag"),
+        "file_size": int(response.headers.get("Content-Length", 0)),
+        "accepts_ranges": response.headers.get("Accept-Ranges", "").lower() == "bytes",
+    }
 
-    response = requests.get(url, stream=True)
-    if response.status_code != 200:
-        raise Exception(f"Failed to download file. Status code: {response.status_code}")
 
-    destination_folder.mkdir(parents=True, exist_ok=True)
+def _is_up_to_date(
+    output_file: Path, metadata_file: Path, remote: Dict[str, Any]
+) -> bool:
+    """
+    Check whether the local copy of the dump matches the remote file.
 
-    file_name = url.split("/")[-1]
-    output_file = destination_folder / file_name
+    Args:
+        output_file (Path): Local copy of the dump.
+        metadata_file (Path): Metadata saved by the previous download.
+        remote (dict): ``last_modified``, ``etag`` and ``file_size`` of the
+            remote file.
+
+    Returns:
+        bool: True if the local copy can be reused.
+    """
+    if not output_file.exists() or not metadata_file.exists():
+        return False
+
+    with open(metadata_file, "r") as f:
+        metadata = json.load(f)
+
+    if metadata.get("last_modified") != remote["last_modified"]:
+        return False
+    if remote["etag"] and metadata.get("etag") != remote["etag"]:
+        return False
+    return output_file.stat().st_size == remote["file_size"]
+
+
+def _download_streamed(
+    url: str,
+    output_file: Path,
+    on_data: Optional[Callable[[int], None]] = None,
+) -> None:
+    """
+    Download a file with a single streamed request, without resume support.
+
+    Args:
+        url (str): URL of the file.
+        output_file (Path): Where to save the file.
+        on_data (Callable[[int], None], optional): Called with the number of
+            bytes written so far after each chunk.
+    """
+    response = requests.get(url, stream=True, timeout=TIMEOUT)
+    if response.status_code != 200:
+        raise Exception(f"Failed to download file. Status code: {response.status_code}")
 
     total_size = int(response.headers.get("Content-Length", 0))
 
     with open(output_file, "wb") as file:
-        with tqdm(total=total_size, unit="B", unit_scale=True, desc=file_name) as pbar:
-            for chunk in response.iter_content(chunk_size=1024 * 1024):
+        with tqdm(
+            total=total_size, unit="B", unit_scale=True, desc=output_file.name
+        ) as pbar:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
                 if chunk:
                     file.write(chunk)
                     pbar.update(len(chunk))
+                    if on_data is not None:
+                        file.flush()
+                        on_data(pbar.n)
 
-    metadata = {
-        "file_name": file_name,
-        "download_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "last_modified_date": formatted_date,
-        "file_size": total_size,
-        "downloaded_file_path": str(output_file),
+
+def _download_ranged(
+    url: str,
+    output_file: Path,
+    remote: Dict[str, Any],
+    num_connections: int,
+    on_data: Optional[Callable[[int], None]] = None,
+) -> None:
+    """
+    Download a file in byte ranges into a preallocated ``.part`` file.
+
+    The progress of every range is saved next to the partial file, so an
+    interrupted download resumes where it stopped, as long as the remote file
+    has not changed in the meantime.
+
+    Args:
+        url (str): URL of the file.
+        output_file (Path): Where to save the file.
+        remote (dict): ``last_modified``, ``etag`` and ``file_size`` of the
+            remote file.
+        num_connections (int): Number of concurrent connections.
+        on_data (Callable[[int], None], optional): Called with the number of
+            contiguous bytes written from the start of the file.
+    """
+    part_file = output_file.with_name(output_file.name + ".part")
+    state_file = output_file.with_name(output_file.name + ".part.json")
+    file_size = remote["file_size"]
+
+    state = _load_download_state(part_file, state_file, remote)
+    if state is None:
+        state = {
+            "last_modified": remote["last_modified"],
+            "etag": remote["etag"],
+            "file_size": file_size,
+            "segments": _split_segments(file_size, num_connections),
+        }
+        with open(part_file, "wb") as file:
+            file.truncate(file_size)  # preallocate the whole file
+
+    lock = threading.Lock()
+    done = sum(segment[2] - segment[0] for segment in state["segments"])
+    if done:
+        print(f"Resuming download of {output_file.name} at {done} bytes")
+    if on_data is not None:
+        on_data(_contiguous_bytes(state["segments"]))
+
+    with tqdm(
+        total=file_size,
+        initial=done,
+        unit="B",
+        unit_scale=True,
+        desc=output_file.name,
+    ) as pbar:
+        try:
+            with ThreadPoolExecutor(max_workers=num_connections) as executor:
+                futures = [
+                    executor.submit(
+                        _download_segment,
+                        url,
+                        part_file,
+                        segment,
+                        remote,
+                        lambda n: _on_progress(
+                            n, pbar, lock, state, state_file, on_data
+                        ),
+                    )
+                    for segment in state["segments"]
+                    if segment[2] < segment[1]
+                ]
+                for future in futures:
+                    future.result()
+        finally:
+            with lock:
+                _save_download_state(state, state_file)
+
+    part_file.replace(output_file)
+    state_file.unlink()
+
+
+def _download_segment(
+    url: str,
+    part_file: Path,
+    segment: List[int],
+    remote: Dict[str, Any],
+    on_progress,
+) -> None:
+    """
+    Download the missing bytes of a segment into the partial file.
+
+    When the connection times out or drops, the request is sent again for the
+    bytes still missing, up to ``RANGE_ATTEMPTS`` times.
+
+    Args:
+        url (str): URL of the file.
+        part_file (Path): Preallocated partial file.
+        segment (List[int]): ``[start, end, next]`` where ``next`` is the first
+            byte not downloaded yet. Updated in place as bytes are written.
+        remote (dict): ``last_modified`` and ``etag`` of the remote file.
+        on_progress (Callable[[int], None]): Called with the number of bytes
+            written after each chunk.
+    """
+    for attempt in range(1, RANGE_ATTEMPTS + 1):
+        try:
+            _fetch_range(url, part_file, segment, remote, on_progress)
+            return
+        except _CONNECTION_ERRORS as error:
+            if attempt == RANGE_ATTEMPTS:
+                raise
+            # Random delays, so that the ranges do not reconnect all at once
+            delay = random.uniform(
+                0, min(RANGE_MAX_DELAY, RANGE_BASE_DELAY * 2 ** (attempt - 1))
+            )
+            print(f"Range {segment} interrupted ({error}), resuming in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def _fetch_range(
+    url: str,
+    part_file: Path,
+    segment: List[int],
+    remote: Dict[str, Any],
+    on_progress,
+) -> None:
+    """Send a single request for the missing bytes of a segment."""
+    _, end, position = segment
+    headers = {
+        "Range": f"bytes={position}-{end - 1}",
+        # Only honour the range if the file did not change since we started
+        "If-Range": _if_range_validator(remote),
     }
 
-    metadata_file = destination_folder / "download_metadata.json"
-    with open(metadata_file, "w") as f:
-        json.dump(metadata, f, indent=4)
+    with requests.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+        if response.status_code == 200:
+            # The server sends the whole file when If-Range does not match
+            raise RemoteFileChanged(f"{url} changed since the download started")
+        if response.status_code != 206:
+            raise Exception(
+                "Server did not return the requested range "
+                f"(status code {response.status_code}); the file may have "
+                "changed, remove the partial download and retry."
+            )
 
-    return str(output_file), formatted_date, str(metadata_file)
+        with open(part_file, "r+b") as file:
+            file.seek(position)
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                if not chunk:
+                    continue
+                file.write(chunk)
+                file.flush()
+                segment[2] += len(chunk)
+                on_progress(len(chunk))
+
+    if segment[2] < end:
+        raise requests.exceptions.ConnectionError(
+            f"Connection closed before the end of range {segment}"
+        )
+
+
+def _if_range_validator(remote: Dict[str, Any]) -> str:
+    """
+    Validator of the ``If-Range`` header of the range requests.
+
+    Only a strong ``ETag`` or the ``Last-Modified`` date can be used: servers
+    ignore the range, and send the whole file, for a weak ``ETag``.
+
+    Args:
+        remote (dict): ``last_modified`` and ``etag`` of the remote file.
+
+    Returns:
+        str: The validator.
+    """
+    etag = remote["etag"]
+    if etag and not etag.startswith("W/"):
+        return etag
+    return remote["last_modified"]
+
+
+def _on_progress(
+    n_bytes: int,
+    pbar: tqdm,
+    lock: threading.Lock,
+    state: Dict[str, Any],
+    state_file: Path,
+    on_data: Optional[Callable[[int], None]] = None,
+) -> None:
+    """Update the progress bar and periodically save the download state."""
+    with lock:
+        pbar.update(n_bytes)
+        state["unsaved"] = state.get("unsaved", 0) + n_bytes
+        if state["unsaved"] >= STATE_SAVE_INTERVAL:
+            _save_download_state(state, state_file)
+        if on_data is not None:
+            on_data(_contiguous_bytes(state["segments"]))
+
+
+def _contiguous_bytes(segments: List[List[int]]) -> int:
+    """Return the number of bytes downloaded without gaps from the start."""
+    for _, end, position in segments:
+        if position < end:
+            return position
+    return segments[-1][1] if segments else 0
+
+
+def _split_segments(file_size: int, num_segments: int) -> List[List[int]]:
+    """
+    Split a file into contiguous segments of (almost) equal size.
+
+    Args:
+        file_size (int): Size of the file in bytes.
+        num_segments (int): Number of segments.
+
+    Returns:
+        List[List[int]]: ``[start, end, next]`` for every segment, with ``next``
+        set to ``start``.
+    """
+    num_segments = max(1, min(num_segments, file_size))
+    bounds = [file_size * i // num_segments for i in range(num_segments + 1)]
+    return [
+        [start, end, start] for start, end in zip(bounds[:-1], bounds[1:], strict=True)
+    ]
+
+
+def _load_download_state(
+    part_file: Path, state_file: Path, remote: Dict[str, Any]
+) -> Optional[Dict[str, Any]]:
+    """
+    Load the state of a previous interrupted download of the same remote file.
+
+    Args:
+        part_file (Path): Partial file of the previous download.
+        state_file (Path): State saved by the previous download.
+        remote (dict): ``last_modified``, ``etag`` and ``file_size`` of the
+            remote file.
+
+    Returns:
+        dict, optional: The saved state, or None if there is nothing to resume.
+    """
+    if not part_file.exists() or not state_file.exists():
+        return None
+
+    with open(state_file, "r") as f:
+        state = json.load(f)
+
+    if any(state.get(key) != remote[key] for key in remote):
+        print("Remote file changed since the partial download, starting over")
+        return None
+    return state
+
+
+def _save_download_state(state: Dict[str, Any], state_file: Path) -> None:
+    """Atomically save the download state."""
+    state["unsaved"] = 0
+    tmp_file = state_file.with_name(state_file.name + ".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump({key: value for key, value in state.items() if key != "unsaved"}, f)
+    tmp_file.replace(state_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,310 @@
+"""Export of the converted articles as a dataset of Parquet shards."""
+
+import json
+import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+# Schema of the exported dataset, the columns of the ``articles`` table
+DATASET_SCHEMA = pa.schema(
+    [
+        ("id", pa.int64()),
+        ("title", pa.string()),
+        ("raw_text", pa.string()),
+        ("markdown_text", pa.string()),
+        ("raw_text_tokens", pa.int64()),
+        ("markdown_text_tokens", pa.int64()),
+        ("model", pa.string()),
+    ]
+)
+
+MANIFEST_FILE = "manifest.json"
+
+# Shards are named like the Parquet files of the Hugging Face Hub
+_SHARD_NAME = "{split}-{index:05d}-of-{count:05d}.parquet"
+
+
+def export_dataset(
+    db_path: Union[str, Path],
+    output_folder: Union[str, Path],
+    split: str = "train",
+    shard_size_bytes: int = 256 * 1024**2,
+    num_workers: Optional[int] = None,
+    batch_size: int = 1000,
+    row_group_size: int = 10_000,
+    compression: Optional[str] = "zstd",
+) -> Path:
+    """
+    Export the articles of the SQLite database to Parquet shards.
+
+    The shards are planned by reading the ids and the size of the text of the
+    rows, in id order, without their content: each shard is a range of ids
+    with about ``shard_size_bytes`` of text (before compression). A pool of
+    processes reads and writes the shards, each process reading its range of
+    the ``articles`` table one batch of ``batch_size`` rows at a time, and
+    writing it one row group at a time. At most ``num_workers`` shards are in
+    progress, and each process holds at most one row group in memory, so
+    memory usage does not depend on the size of the database.
+
+    The shards are described by a ``manifest.json`` file, and can be loaded
+    with ``load_exported_dataset`` or directly with the ``datasets`` library.
+
+    Example:
+        >>> export_dataset("data/database.db", "data/export")
+        >>> dataset = load_exported_dataset("data/export")
+
+    Args:
+        db_path (str | Path): Path to the SQLite database file.
+        output_folder (str | Path): Folder of the shards and manifest. Shards
+            of a previous export of the same split are replaced.
+        split (str): Name of the dataset split (default: "train").
+        shard_size_bytes (int): Size of the text of a shard, before
+            compression (default: 256 MiB).
+        num_workers (int, optional): Number of processes writing the shards
+            (default: number of CPUs).
+        batch_size (int): Number of rows read at a time (default: 1000).
+        row_group_size (int): Number of rows per Parquet row group
+            (default: 10000).
+        compression (str, optional): Parquet compression codec
+            (default: "zstd").
+
+    Returns:
+        Path: Path to the manifest.
+    """
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    num_workers = num_workers or os.cpu_count() or 1
+
+    conn = sqlite3.connect(db_path)
+    (total_rows,) = conn.execute("SELECT COUNT(*) FROM articles").fetchone()
+    sizes = conn.execute(
+        f"SELECT id, {_text_size_expression(conn)} FROM articles ORDER BY id"
+    )
+
+    shards: List[Dict[str, Any]] = []
+    pending: Deque[Future] = deque()
+
+    def submit_shard(after_id: Optional[int], last_id: Optional[int]) -> None:
+        # Every shard but the first and the last is bounded on both sides, so
+        # the ranges cover all the ids
+        path = output_folder / f"{split}-{len(shards) + len(pending):05d}.tmp"
+        pending.append(
+            executor.submit(
+                _write_shard,
+                db_path,
+                after_id,
+                last_id,
+                path,
+                batch_size,
+                row_group_size,
+                compression,
+            )
+        )
+
+    def complete_shard() -> None:
+        shard = pending.popleft().result()
+        shards.append(shard)
+        pbar.update(shard["num_rows"])
+
+    with (
+        ProcessPoolExecutor(max_workers=num_workers) as executor,
+        tqdm(total=total_rows, desc="Exporting articles") as pbar,
+    ):
+        try:
+            after_id = None
+            last_id = None
+            shard_bytes = 0
+            while rows := sizes.fetchmany(batch_size):
+                for id, size in rows:
+                    last_id = id
+                    shard_bytes += size or 0
+                    if shard_bytes >= shard_size_bytes:
+                        if len(pending) >= num_workers:
+                            complete_shard()
+                        submit_shard(after_id, last_id)
+                        after_id, shard_bytes = last_id, 0
+
+            # The last shard takes the rest, and an empty database gets an
+            # empty shard
+            if last_id != after_id or not (shards or pending):
+                submit_shard(after_id, None)
+            while pending:
+                complete_shard()
+        finally:
+            conn.close()
+
+    # The number of shards is only known now. The previous export is only
+    # removed once the new one is complete.
+    for path in output_folder.glob(f"{split}-*-of-*.parquet"):
+        path.unlink()
+    for index, shard in enumerate(shards):
+        path = output_folder / _SHARD_NAME.format(
+            split=split, index=index, count=len(shards)
+        )
+        os.replace(shard["file"], path)
+        shard["file"] = path.name
+
+    manifest_path = output_folder / MANIFEST_FILE
+    manifest = _read_manifest(manifest_path) if manifest_path.exists() else {}
+    manifest.setdefault("splits", {})[split] = {
+        "num_rows": sum(shard["num_rows"] for shard in shards),
+        "num_bytes": sum(shard["num_bytes"] for shard in shards),
+        "shards": shards,
+    }
+    manifest.update(
+        {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "compression": compression,
+            "schema": {field.name: str(field.type) for field in DATASET_SCHEMA},
+        }
+    )
+    manifest_path.write_text(json.dumps(manifest, indent=2))
+
+    print(
+        f"Exported {manifest['splits'][split]['num_rows']} articles to "
+        f"{len(shards)} shards in {output_folder}"
+    )
+    return manifest_path
+
+
+def load_exported_dataset(output_folder: Union[str, Path], split: str = "train"):
+    """
+    Load the shards of ``export_dataset`` with the ``datasets`` library.
+
+    Args:
+        output_folder (str | Path): Folder of the shards and manifest.
+        split (str): Name of the dataset split (default: "train").
+
+    Returns:
+        datasets.Dataset: The exported articles.
+    """
+    from datasets import load_dataset
+
+    output_folder = Path(output_folder)
+    manifest = _read_manifest(output_folder / MANIFEST_FILE)
+    data_files = [
+        str(output_folder / shard["file"])
+        for shard in manifest["splits"][split]["shards"]
+    ]
+    return load_dataset("parquet", data_files={split: data_files}, split=split)
+
+
+def _text_size_expression(conn: sqlite3.Connection) -> str:
+    """
+    SQL expression of the size of the text of a row.
+
+    ``octet_length`` (SQLite 3.43) reads the size of the texts without loading
+    them, while ``length`` reads them to count their characters.
+    """
+    try:
+        conn.execute("SELECT octet_length('')")
+        function = "octet_length"
+    except sqlite3.OperationalError:
+        function = "length"
+    return " + ".join(
+        f"{function}({field.name})"
+        for field in DATASET_SCHEMA
+        if pa.types.is_string(field.type)
+    )
+
+
+def _write_shard(
+    db_path: Union[str, Path],
+    after_id: Optional[int],
+    last_id: Optional[int],
+    path: Path,
+    batch_size: int,
+    row_group_size: int,
+    compression: Optional[str],
+) -> Dict[str, Any]:
+    """
+    Write the articles of a range of ids to a shard, one row group at a time.
+
+    Args:
+        db_path (str | Path): Path to the SQLite database file.
+        after_id (int, optional): The ids of the shard are greater than this
+            one. Defaults to no lower bound.
+        last_id (int, optional): Last id of the shard. Defaults to no upper
+            bound.
+        path (Path): Path of the shard.
+        batch_size (int): Number of rows read at a time.
+        row_group_size (int): Number of rows per Parquet row group.
+        compression (str, optional): Parquet compression codec.
+
+    Returns:
+        Dict[str, Any]: The path, number of rows, size of the file, and first
+        and last ids of the shard.
+    """
+    conditions = []
+    params = []
+    if after_id is not None:
+        conditions.append("id > ?")
+        params.append(after_id)
+    if last_id is not None:
+        conditions.append("id <= ?")
+        params.append(last_id)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    conn = sqlite3.connect(f"{Path(db_path).resolve().as_uri()}?mode=ro", uri=True)
+    shard = {"file": path, "num_rows": 0, "first_id": None, "last_id": None}
+    try:
+        cursor = conn.execute(
+            f"SELECT {', '.join(DATASET_SCHEMA.names)} FROM articles {where} "
+            "ORDER BY id",
+            params,
+        )
+        with pq.ParquetWriter(
+            path, DATASET_SCHEMA, compression=compression or "none"
+        ) as writer:
+            batches: List[pa.RecordBatch] = []
+            buffered = 0
+            while rows := cursor.fetchmany(batch_size):
+                batches.append(_to_record_batch(rows))
+                buffered += len(rows)
+                if shard["first_id"] is None:
+                    shard["first_id"] = rows[0][0]
+                shard["last_id"] = rows[-1][0]
+                shard["num_rows"] += len(rows)
+                while buffered >= row_group_size:
+                    table = pa.Table.from_batches(batches, DATASET_SCHEMA)
+                    writer.write_table(
+                        table.slice(0, row_group_size), row_group_size=row_group_size
+                    )
+                    batches = table.slice(row_group_size).to_batches()
+                    buffered -= row_group_size
+            if buffered:
+                writer.write_table(
+                    pa.Table.from_batches(batches, DATASET_SCHEMA),
+                    row_group_size=row_group_size,
+                )
+    finally:
+        conn.close()
+    shard["num_bytes"] = path.stat().st_size
+    return shard
+
+
+def _to_record_batch(rows: List[Tuple]) -> pa.RecordBatch:
+    """Convert rows of the ``articles`` table to a record batch."""
+    return pa.RecordBatch.from_arrays(
+        [
+            pa.array(column, field.type)
+            for column, field in zip(
+                zip(*rows, strict=True), DATASET_SCHEMA, strict=True
+            )
+        ],
+        schema=DATASET_SCHEMA,
+    )
+
+
+def _read_manifest(path: Path) -> Dict[str, Any]:
+    """Read the manifest of an export."""
+    with open(path, "r") as file:
+        return json.load(file)
@@ -1,21 +1,98 @@
 import bz2
 import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from time import sleep
-from typing import Dict, Optional, Union
-
-import pandas as pd
-import wikitextparser as wtp
-from html2text import html2text as htt
+from typing import (
+    AbstractSet,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import pyarrow as pa
 from tqdm import tqdm  # for progress tracking
 
+from src.utils.dewiki import dewiki
+from src.utils.metrics import METRICS
+from src.utils.parquet_writer import ParquetStreamWriter
+from src.utils.wiki_xml import WikiPage, iter_wiki_pages, page_fragment_bounds
+
+# Schema of the Parquet file produced by format_wiki_text
+ARTICLE_SCHEMA = pa.schema(
+    [
+        ("title", pa.string()),
+        ("text", pa.string()),
+        ("id", pa.int64()),
+        ("revision_id", pa.int64()),
+        ("sha1", pa.string()),
+    ]
+)
+
+# Every bz2 stream starts with the "BZh" signature, the block size digit and the
+# magic number of its first compressed block (the BCD digits of pi).
+BZ2_STREAM_HEADER = re.compile(rb"BZh[1-9]\x31\x41\x59\x26\x53\x59")
+
+# Disambiguation templates, e.g. {{disambig}}, {{Disambiguation|...}} or {{dab}}
+_DISAMBIGUATION = re.compile(
+    r"\{\{\s*(?:disambig(?:uation)?|dab)\s*(?:\||\}\})", re.IGNORECASE
+)
+
+# Number of decompressed bytes fed to the XML parser at a time
+_READ_SIZE = 1024 * 1024
+
+# Number of block ranges handed to each worker, so that slow ranges (e.g. the
+# ones holding the longest articles) do not leave the rest of the pool idle.
+_RANGES_PER_WORKER = 8
+
+# Upper bound on the compressed size of a block range, which bounds the memory
+# used by each worker (and by the ranges waiting to be written) on large dumps.
+_MAX_RANGE_BYTES = 16 * 1024 * 1024
+
+
+def format_wiki_text(
+    filename: Union[str, Path],
+    savepath: Union[str, Path],
+    num_workers: int = 1,
+    index_filename: Optional[Union[str, Path]] = None,
+    row_group_size: int = 10_000,
+    compression: Optional[str] = "snappy",
+    dewiki_engine: str = "wikitextparser",
+    only_ids: Optional[AbstractSet[int]] = None,
+    byte_range: Optional[Tuple[int, int]] = None,
+) -> None:
+    """
+    Process a Wikipedia XML dump file and save articles into a Parquet file.
+
+    Articles are written to the Parquet file in row groups of ``row_group_size``
+    as they are parsed, so memory usage does not grow with the size of the dump.
 
-def format_wiki_text(filename: Union[str, Path], savepath: Union[str, Path]) -> None:
-    """Process a Wikipedia XML dump file and save articles into a Parquet file.
+    When ``num_workers`` is greater than one, the multistream dump is split into
+    independent ranges of bz2 streams that are decompressed and parsed by a pool
+    of processes. The stream offsets are read from the companion multistream
+    index when ``index_filename`` is given, or found by scanning the dump for
+    bz2 stream headers otherwise.
 
     Args:
         filename: Path to the bzip2 compressed XML dump file
         savepath: Path to the output Parquet file
+        num_workers: Number of processes used to parse the dump (default: 1)
+        index_filename: Optional path to the multistream index file
+        row_group_size: Number of articles per Parquet row group (default: 10000)
+        compression: Parquet compression codec (default: "snappy")
+        dewiki_engine: Engine converting wiki markup to plain text, one of
+            ``src.utils.dewiki.DEWIKI_ENGINES`` (default: "wikitextparser")
+        only_ids: Optional set of page ids. When given, only these articles are
+            processed and saved, e.g. the ones that changed since the last dump
+        byte_range: Optional ``(start, end)`` byte range of the multistream
+            dump, starting at a bz2 stream offset. When given, only the streams
+            starting in this range are processed, e.g. the shard of a node
     """
     # Convert to Path objects
     filename = Path(filename)
@@ -24,128 +101,417 @@ def format_wiki_text(filename: Union[str, Path], savepath: Union[str, Path]) ->
     # Ensure save directory exists
     savepath.parent.mkdir(parents=True, exist_ok=True)
 
-    # Count total number of articles (pages) in the file
-    total_pages = _count_pages_in_file(filename)
-    print(f"Total unique articles to process: {total_pages}")
-    sleep(0.1)  # Allow print to be shown before tqdm
+    if num_workers > 1 or byte_range is not None:
+        articles = _parse_in_parallel(
+            filename, num_workers, dewiki_engine, index_filename, only_ids, byte_range
+        )
+    else:
+        articles = _parse_serially(filename, dewiki_engine, only_ids)
 
-    articles = []
-    article = ""
+    # Stream the articles into the Parquet file, one row group at a time
+    with ParquetStreamWriter(
+        savepath, ARTICLE_SCHEMA, row_group_size, compression
+    ) as writer:
+        writer.write_many(articles)
 
-    with bz2.open(filename, "rt", encoding="utf-8") as infile:
-        # Initialize tqdm for progress tracking
-        with tqdm(
-            total=total_pages, desc="Processing articles", unit="article"
-        ) as pbar:
-            for line in infile:
-                if "<page>" in line:
-                    article = ""
-                elif "</page>" in line:  # end of article
-                    doc = _analyze_chunk(article)
-                    if doc:
-                        articles.append(doc)
-                    pbar.update(1)  # Update progress bar for each processed article
-                else:
-                    article += line
+    print(f"Processed data ({writer.rows_written} articles) saved to {savepath}")
+
+
+def iter_dump_pages(filename: Union[str, Path]) -> Iterator[WikiPage]:
+    """
+    Iterate over all the pages of a dump, reading it as a single bz2 stream.
 
-    # Convert list of articles to a DataFrame
-    df = pd.DataFrame(articles)
+    Args:
+        filename: Path to the bzip2 compressed XML dump file
 
-    # Id column as integer
-    df["id"] = df["id"].astype(int)
+    Yields:
+        Pages of the dump, in dump order.
+    """
+    filename = Path(filename)
+    file_size = filename.stat().st_size
 
-    # Save DataFrame as Parquet file
-    df.to_parquet(savepath, index=False)
-    print(f"Processed data saved to {savepath}")
+    with open(filename, "rb") as raw_file, bz2.open(raw_file, "rb") as infile:
+        # Track progress on the compressed bytes read, so that the dump does not
+        # have to be decompressed twice just to count its pages
+        with tqdm(
+            total=file_size, desc="Processing dump", unit="B", unit_scale=True
+        ) as pbar:
+            for page in iter_wiki_pages(iter(lambda: infile.read(_READ_SIZE), b"")):
+                yield page
+                pbar.update(raw_file.tell() - pbar.n)
 
 
-def _analyze_chunk(text: str) -> Optional[Dict[str, str]]:
-    """Analyze a Wikipedia article chunk and extract relevant information.
+def is_article(page: WikiPage) -> bool:
+    """
+    Check whether a page is an article to be included in the dataset.
 
     Args:
-        text: Raw XML chunk containing a Wikipedia article.
+        page: Page extracted from the XML dump.
 
     Returns:
-        Dictionary containing article title, content, and ID if valid.
-        Returns None if the article should be skipped.
+        False for pages outside of the main (article) namespace, redirects and
+        disambiguation pages, True otherwise.
     """
-    try:
-        # Skip articles that are redirects or disambiguation pages
-        if '<redirect title="' in text:  # this is not the main article
-            return None
-        if "(disambiguation)" in text:  # this is not an article
-            return None
+    if page.ns != 0:
+        return False
+    if page.redirect:  # this is not the main article
+        return False
+    if "(disambiguation)" in page.title or _DISAMBIGUATION.search(page.text):
+        return False
+    return True
+
+
+def _parse_serially(
+    filename: Path,
+    dewiki_engine: str,
+    only_ids: Optional[AbstractSet[int]] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Parse the whole dump as a single bz2 stream on one core.
 
-        # Extract the title and validate it
-        title = text.split("<title>")[1].split("</title>")[0]
-        title = htt(title)
-        # Skip articles with colons in their title (likely metadata or lists)
-        if ":" in title:
-            return None
+    Args:
+        filename: Path to the bzip2 compressed XML dump file
+        dewiki_engine: Engine converting wiki markup to plain text
+        only_ids: Optional set of page ids to process
 
-        # Extract the article's unique ID
-        serial = text.split("<id>")[1].split("</id>")[0]
+    Yields:
+        Parsed articles, in dump order.
+    """
+    for page in iter_dump_pages(filename):
+        doc = _analyze_page(page, dewiki_engine, only_ids)
+        if doc:
+            yield doc
+
+
+def _parse_in_parallel(
+    filename: Path,
+    num_workers: int,
+    dewiki_engine: str,
+    index_filename: Optional[Union[str, Path]] = None,
+    only_ids: Optional[AbstractSet[int]] = None,
+    byte_range: Optional[Tuple[int, int]] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Parse a multistream dump by fanning out ranges of bz2 streams to processes.
 
-        # Extract and process the article's content
-        content = text.split("</text")[0].split("<text")[1].split(">", maxsplit=1)[1]
-        content = _dewiki(content)
+    Args:
+        filename: Path to the bzip2 compressed multistream XML dump file
+        num_workers: Number of worker processes
+        dewiki_engine: Engine converting wiki markup to plain text
+        index_filename: Optional path to the multistream index file
+        only_ids: Optional set of page ids to process
+        byte_range: Optional ``(start, end)`` byte range of the streams to parse
+
+    Yields:
+        Parsed articles. Ranges are merged in file order and each range is
+        sorted by id, so the articles follow the id order of the dump.
+    """
+    start, end = byte_range or (0, filename.stat().st_size)
+    if index_filename is not None:
+        offsets = _read_index_offsets(index_filename)
+        offsets = [offset for offset in offsets if start <= offset < end]
+    else:
+        offsets = _find_stream_offsets(filename, start=start, end=end)
+    if not offsets:
+        return
+
+    ranges = _group_stream_ranges(
+        offsets,
+        end,
+        num_workers * _RANGES_PER_WORKER,
+        max_range_size=_MAX_RANGE_BYTES,
+    )
+    print(f"Parsing {len(offsets)} bz2 streams in {len(ranges)} ranges")
+    sleep(0.1)  # Allow print to be shown before tqdm
 
-        # Add the title to the beginning of the content, separated by a newline
-        content = f"= {title.strip()} =\n\n{content.strip()}"
+    yield from parse_stream_ranges(
+        ((filename, start, end) for start, end in ranges),
+        num_workers,
+        dewiki_engine,
+        only_ids,
+        total_size=end - offsets[0],
+    )
+
+
+def parse_stream_ranges(
+    tasks: Iterable[Tuple[Union[Path, bytes], int, int]],
+    num_workers: int,
+    dewiki_engine: str = "wikitextparser",
+    only_ids: Optional[AbstractSet[int]] = None,
+    total_size: Optional[int] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Parse ranges of bz2 streams of a multistream dump in a pool of processes.
 
-        # Return a dictionary with the extracted data
-        return {"title": title.strip(), "text": content, "id": serial.strip()}
+    Tasks are consumed lazily and at most ``2 * num_workers`` of them are in
+    flight at any time, so a slow consumer (or a producer waiting for the data
+    of the next range) holds back the whole pipeline instead of letting parsed
+    ranges pile up in memory.
 
-    except Exception as oops:
-        # Handle unexpected errors during parsing
-        print(oops)
-        return None
+    Args:
+        tasks: ``(source, start, end)`` tuples, in file order. ``source`` is
+            either the path of the dump, from which the worker reads the bytes
+            ``[start, end)``, or the bytes of the range themselves
+        num_workers: Number of worker processes. With one worker, the ranges
+            are parsed in the calling process
+        dewiki_engine: Engine converting wiki markup to plain text
+        only_ids: Optional set of page ids to process
+        total_size: Optional total size of the ranges, for the progress bar
+
+    Yields:
+        Parsed articles. Ranges are merged in file order and each range is
+        sorted by id, so the articles follow the id order of the dump.
+    """
+    with tqdm(
+        total=total_size, desc="Processing dump", unit="B", unit_scale=True
+    ) as pbar:
+        if num_workers <= 1:
+            for source, start, end in tasks:
+                yield from _parse_stream_range(
+                    source, start, end, dewiki_engine, only_ids
+                )
+                pbar.update(end - start)
+            return
+
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            # Keep a bounded number of ranges in flight and consume them in file
+            # order, so finished ranges never pile up in memory.
+            pending: deque = deque()
+            for source, start, end in tasks:
+                future = executor.submit(
+                    _parse_stream_range_with_metrics,
+                    source,
+                    start,
+                    end,
+                    dewiki_engine,
+                    only_ids,
+                )
+                pending.append((end - start, future))
+                METRICS.set_gauge("parse_ranges_in_flight", len(pending))
+                if len(pending) >= 2 * num_workers:
+                    size, future = pending.popleft()
+                    yield from _merge_metrics(future.result())
+                    pbar.update(size)
+
+            while pending:
+                size, future = pending.popleft()
+                METRICS.set_gauge("parse_ranges_in_flight", len(pending))
+                yield from _merge_metrics(future.result())
+                pbar.update(size)
+
+
+def _parse_stream_range(
+    source: Union[Path, bytes],
+    start: int,
+    end: int,
+    dewiki_engine: str,
+    only_ids: Optional[AbstractSet[int]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Decompress and parse the bz2 streams stored in ``[start, end)``.
 
+    Args:
+        source: Path to the bzip2 compressed multistream XML dump file, or the
+            bytes of the range
+        start: Byte offset of the first stream of the range
+        end: Byte offset where the range ends (exclusive)
+        dewiki_engine: Engine converting wiki markup to plain text
+        only_ids: Optional set of page ids to process
 
-def _dewiki(text: str) -> str:
+    Returns:
+        List of parsed articles in the range, sorted by id.
     """
-    Convert raw wiki markup text into clean plain text.
+    if isinstance(source, bytes):
+        data = source
+    else:
+        with open(source, "rb") as infile:
+            infile.seek(start)
+            data = infile.read(end - start)
+
+    # bz2.decompress handles several concatenated streams
+    with METRICS.time("parse_decompress_seconds"):
+        xml = bz2.decompress(data)
+    METRICS.inc("parse_compressed_bytes_total", len(data))
+    METRICS.inc("parse_xml_bytes_total", len(xml))
+    pages_start, pages_end = page_fragment_bounds(xml)
 
-    This function processes a given wiki markup string to remove excess formatting,
-    HTML entities, and extraneous whitespace, while retaining readable plain text.
-    It also ensures proper formatting around section titles.
+    articles = []
+    for page in iter_wiki_pages(
+        [memoryview(xml)[pages_start:pages_end]], fragment=True
+    ):
+        doc = _analyze_page(page, dewiki_engine, only_ids)
+        if doc:
+            articles.append(doc)
+
+    articles.sort(key=lambda doc: doc["id"])
+    return articles
+
+
+def _parse_stream_range_with_metrics(
+    *args: Any,
+) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """Run ``_parse_stream_range`` in a worker, returning its metrics too."""
+    articles = _parse_stream_range(*args)
+    return articles, METRICS.drain()
+
+
+def _merge_metrics(
+    result: Tuple[List[Dict[str, Any]], Dict[str, Any]],
+) -> List[Dict[str, Any]]:
+    """Record the metrics of a worker and return its articles."""
+    articles, metrics = result
+    METRICS.merge(metrics)
+    return articles
+
+
+def _find_stream_offsets(
+    filename: Union[str, Path],
+    chunk_size: int = 16 * 1024 * 1024,
+    start: int = 0,
+    end: Optional[int] = None,
+) -> List[int]:
+    """
+    Find the byte offsets of the bz2 streams of a multistream dump.
 
     Args:
-        text (str): The input string containing raw wiki markup.
+        filename: Path to the bzip2 compressed multistream XML dump file
+        chunk_size: Number of bytes read at a time (default: 16 MiB)
+        start: Offset of the first stream to find (default: 0)
+        end: Optional offset where the search stops, the end of the file by
+            default
 
     Returns:
-        str: The processed plain text with wiki markup removed and formatting cleaned.
+        Sorted list of stream offsets, starting with ``start``.
+    """
+    overlap = 9  # length of the stream header minus one
+    offsets = []
+    position = start
+    tail = b""
+    if end is None:
+        end = Path(filename).stat().st_size
+
+    with open(filename, "rb") as infile:
+        infile.seek(start)
+        while position < end and (
+            chunk := infile.read(min(chunk_size, end - position))
+        ):
+            buffer = tail + chunk
+            base = position - len(tail)
+            for match in BZ2_STREAM_HEADER.finditer(buffer):
+                offset = base + match.start()
+                if not offsets or offset > offsets[-1]:
+                    offsets.append(offset)
+            position += len(chunk)
+            tail = buffer[-overlap:]
+
+    return offsets
+
+
+def _read_index_offsets(index_filename: Union[str, Path]) -> List[int]:
     """
-    # Parse the wiki markup to extract plain text
-    text = wtp.parse(text).plain_text()
+    Read the stream offsets from a multistream index file.
 
-    # Decode any HTML entities, such as &amp; -> &
-    text = htt(text)
+    Each line of the index has the form ``offset:page_id:title``, where
+    ``offset`` is the byte position of the bz2 stream holding the page.
 
-    # Replace newlines with spaces for better readability
-    text = text.replace("\n", " ")
+    Args:
+        index_filename: Path to the (optionally bzip2 compressed) index file
 
-    # Replace multiple spaces or tabs with a single space
-    text = re.sub(r"\s+", " ", text)
+    Returns:
+        Sorted list of unique stream offsets, starting with 0.
+    """
+    index_filename = Path(index_filename)
+    opener = bz2.open if index_filename.suffix == ".bz2" else open
 
-    # Add blank lines before and after section titles (levels 1 to 5)
-    text = re.sub(r"(={1,5}\s*[^=]+\s*={1,5})", r"\n\n\1\n\n", text)
+    offsets = {0}  # the first stream holds the siteinfo header
+    with opener(index_filename, "rt", encoding="utf-8") as infile:
+        for line in infile:
+            offsets.add(int(line.split(":", maxsplit=1)[0]))
 
-    return text
+    return sorted(offsets)
 
 
-def _count_pages_in_file(filename: Union[str, Path]) -> int:
-    """Count the total number of pages in a bzip2 compressed XML file.
+def _group_stream_ranges(
+    offsets: List[int],
+    file_size: int,
+    num_ranges: int,
+    max_range_size: Optional[int] = None,
+) -> List[Tuple[int, int]]:
+    """
+    Group consecutive bz2 streams into ranges of roughly equal byte size.
 
     Args:
-        filename: Path to the bzip2 compressed XML file
+        offsets: Sorted stream offsets
+        file_size: Size of the dump file in bytes, or end of the last stream
+        num_ranges: Desired number of ranges
+        max_range_size: Optional upper bound on the size of a range in bytes.
+            More than ``num_ranges`` ranges are produced when needed.
 
     Returns:
-        Total number of pages found in the file
+        List of ``(start, end)`` byte ranges covering the streams.
     """
-    page_count = 0
-    with bz2.open(filename, "rt", encoding="utf-8") as infile:
-        for line in infile:
-            if "<page>" in line:
-                page_count += 1
-    return page_count
+    target_size = max(1, (file_size - offsets[0]) // max(1, num_ranges))
+    if max_range_size is not None:
+        target_size = min(target_size, max_range_size)
+    boundaries = offsets + [file_size]
+
+    ranges = []
+    start = boundaries[0]
+    for offset in boundaries[1:]:
+        if offset - start >= target_size or offset == file_size:
+            ranges.append((start, offset))
+            start = offset
+
+    return ranges
+
+
+def _analyze_page(
+    page: WikiPage,
+    dewiki_engine: str,
+    only_ids: Optional[AbstractSet[int]] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Analyze a Wikipedia page and extract relevant information.
+
+    Args:
+        page: Page extracted from the XML dump.
+        dewiki_engine: Engine converting wiki markup to plain text.
+        only_ids: Optional set of page ids to process.
+
+    Returns:
+        Dictionary containing article title, content, and ID if valid.
+        Returns None if the article should be skipped.
+    """
+    try:
+        # Skip pages that were not requested
+        if only_ids is not None and page.id not in only_ids:
+            return None
+
+        # Skip non-articles, redirects and disambiguation pages
+        if not is_article(page):
+            return None
+
+        title = page.title.strip()
+
+        # Extract and process the article's content
+        with METRICS.time("parse_dewiki_seconds"):
+            content = dewiki(page.text, dewiki_engine)
+        METRICS.inc("parse_articles_total")
+
+        # Add the title to the beginning of the content, separated by a newline
+        content = f"= {title} =\n\n{content.strip()}"
+
+        # Return a dictionary with the extracted data
+        return {
+            "title": title,
+            "text": content,
+            "id": page.id,
+            "revision_id": page.revision_id,
+            "sha1": page.sha1,
+        }
+
+    except Exception as oops:
+        # Handle unexpected errors during parsing
+        print(oops)
+        METRICS.inc("parse_errors_total")
+        return None
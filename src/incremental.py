@@ -0,0 +1,247 @@
+"""Incremental updates of the articles from a new dump."""
+
+from pathlib import Path
+from typing import Any, NamedTuple, Optional, Set, Union
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from src.format_wiki_text import (
+    format_wiki_text,
+    is_article,
+    iter_dump_pages,
+)
+from src.utils.database import delete_rows, get_article_ids
+from src.utils.parquet_writer import ParquetStreamWriter
+
+
+class DumpDiff(NamedTuple):
+    """Article ids that differ between a new dump and the previous one."""
+
+    new: Set[int]
+    changed: Set[int]
+    deleted: Set[int]
+
+    @property
+    def to_process(self) -> Set[int]:
+        """Ids that have to be parsed (and converted) again."""
+        return self.new | self.changed
+
+    @property
+    def stale(self) -> Set[int]:
+        """Ids whose previous output must be discarded."""
+        return self.changed | self.deleted
+
+
+def diff_dump(
+    dump_file: Union[str, Path],
+    previous_file: Union[str, Path],
+    db_path: Optional[Union[str, Path]] = None,
+) -> DumpDiff:
+    """
+    Compare the articles of a new dump against the previously processed ones.
+
+    The new dump is only scanned for the revision SHA-1 of each article, which
+    is much cheaper than parsing it, and compared with the ``sha1`` column of
+    the Parquet file written by ``format_wiki_text`` for the previous dump. If
+    that file predates the ``sha1`` column, every article is reported as
+    changed.
+
+    Args:
+        dump_file (str | Path): Path to the new bzip2 compressed XML dump.
+        previous_file (str | Path): Parquet file of the previous dump.
+        db_path (str | Path, optional): SQLite database of converted articles.
+            Articles stored in it that are not in the new dump are reported as
+            deleted.
+
+    Returns:
+        DumpDiff: New, changed and deleted article ids.
+    """
+    current = {
+        page.id: page.sha1 for page in iter_dump_pages(dump_file) if is_article(page)
+    }
+
+    previous_columns = pq.read_schema(previous_file).names
+    if "sha1" in previous_columns:
+        table = pq.read_table(previous_file, columns=["id", "sha1"])
+        previous = dict(
+            zip(table["id"].to_pylist(), table["sha1"].to_pylist(), strict=True)
+        )
+    else:
+        table = pq.read_table(previous_file, columns=["id"])
+        previous = dict.fromkeys(table["id"].to_pylist())
+
+    new = current.keys() - previous.keys()
+    deleted = previous.keys() - current.keys()
+    changed = {
+        id
+        for id, sha1 in current.items()
+        if id in previous and (not sha1 or previous[id] != sha1)
+    }
+
+    if db_path is not None:
+        deleted |= get_article_ids(db_path) - current.keys()
+
+    return DumpDiff(new=set(new), changed=changed, deleted=set(deleted))
+
+
+def update_wiki_text(
+    dump_file: Union[str, Path],
+    previous_file: Union[str, Path],
+    savepath: Union[str, Path],
+    db_path: Optional[Union[str, Path]] = None,
+    **format_kwargs: Any,
+) -> DumpDiff:
+    """
+    Process a new dump reusing the output of the previous one.
+
+    Only new and changed articles are parsed and converted to plain text. They
+    are merged with the unchanged articles of ``previous_file`` into
+    ``savepath`` (which may be ``previous_file`` itself), and the rows of
+    changed and deleted articles are removed from the database, so that the
+    Markdown conversion only processes the articles that changed.
+
+    The merged file keeps the id order of the dump. The columns added by the
+    later stages are kept for the unchanged articles, so that the token counts
+    are only computed for the new and changed ones.
+
+    If ``previous_file`` predates the ``sha1`` column, the unchanged articles
+    can not be told apart: the whole dump is parsed into ``savepath``, every
+    previous article is reported as changed, and the database is left as is.
+
+    Args:
+        dump_file (str | Path): Path to the new bzip2 compressed XML dump.
+        previous_file (str | Path): Parquet file of the previous dump.
+        savepath (str | Path): Path to the output Parquet file.
+        db_path (str | Path, optional): SQLite database of converted articles.
+        **format_kwargs: Extra arguments for ``format_wiki_text``.
+
+    Returns:
+        DumpDiff: New, changed and deleted article ids.
+    """
+    savepath = Path(savepath)
+    if "sha1" not in pq.read_schema(previous_file).names:
+        print(f"{previous_file} has no sha1 column, processing the whole dump")
+        previous_ids = _read_ids(previous_file)
+        format_wiki_text(dump_file, savepath, **format_kwargs)
+        current_ids = _read_ids(savepath)
+        return DumpDiff(
+            new=current_ids - previous_ids,
+            changed=current_ids & previous_ids,
+            deleted=previous_ids - current_ids,
+        )
+
+    diff = diff_dump(dump_file, previous_file, db_path)
+    print(
+        f"New articles: {len(diff.new)}, changed: {len(diff.changed)}, "
+        f"deleted: {len(diff.deleted)}"
+    )
+
+    # Parse only the articles that are new or changed
+    delta_file = savepath.with_name(f"{savepath.stem}.delta{savepath.suffix}")
+    format_wiki_text(dump_file, delta_file, only_ids=diff.to_process, **format_kwargs)
+
+    _merge_parquet(
+        previous_file,
+        delta_file,
+        diff.stale,
+        savepath,
+        row_group_size=format_kwargs.get("row_group_size", 10_000),
+        compression=format_kwargs.get("compression", "snappy"),
+    )
+    delta_file.unlink()
+
+    if db_path is not None and diff.stale:
+        removed = delete_rows(db_path, diff.stale)
+        print(f"Removed {removed} outdated articles from {db_path}")
+
+    return diff
+
+
+def _read_ids(filename: Union[str, Path]) -> Set[int]:
+    """Ids of the articles of a Parquet file."""
+    return set(pq.read_table(filename, columns=["id"])["id"].to_pylist())
+
+
+def _merge_parquet(
+    previous_file: Union[str, Path],
+    delta_file: Union[str, Path],
+    removed_ids: Set[int],
+    savepath: Union[str, Path],
+    row_group_size: int,
+    compression: Optional[str],
+) -> None:
+    """
+    Merge the kept rows of the previous file and the delta into a new file.
+
+    Both files are in id order, like the dump, and are merged into a file in
+    id order as well, one batch of the previous file at a time. The columns
+    added to the previous file by the later stages (e.g. the token counts) are
+    kept for its unchanged rows and are null for the rows of the delta.
+
+    Args:
+        previous_file (str | Path): Parquet file of the previous dump.
+        delta_file (str | Path): Parquet file with the new and changed articles.
+        removed_ids (Set[int]): Ids of the previous file to leave out.
+        savepath (str | Path): Path to the output Parquet file.
+        row_group_size (int): Number of articles per row group.
+        compression (str, optional): Parquet compression codec.
+    """
+    removed = pa.array(sorted(removed_ids), type=pa.int64())
+    previous = pq.ParquetFile(previous_file)
+    schema = previous.schema_arrow
+    kept_previous = kept_delta = 0
+
+    delta_batches = pq.ParquetFile(delta_file).iter_batches(batch_size=row_group_size)
+    pending = pa.Table.from_pylist([], schema)
+
+    def take_delta(max_id: Optional[int]) -> pa.Table:
+        """Rows of the delta up to ``max_id`` (all of them if None)."""
+        nonlocal pending
+        while max_id is None or (
+            pending.num_rows == 0 or pc.max(pending["id"]).as_py() <= max_id
+        ):
+            batch = next(delta_batches, None)
+            if batch is None:
+                break
+            pending = pa.concat_tables([pending, _conform(batch, schema)])
+        if max_id is None:
+            taken, pending = pending, pending.slice(0, 0)
+            return taken
+        mask = pc.less_equal(pending["id"], max_id)
+        taken = pending.filter(mask)
+        pending = pending.filter(pc.invert(mask))
+        return taken
+
+    with ParquetStreamWriter(savepath, schema, row_group_size, compression) as writer:
+        for batch in previous.iter_batches(batch_size=row_group_size):
+            batch = batch.filter(pc.invert(pc.is_in(batch["id"], removed)))
+            kept_previous += batch.num_rows
+            if batch.num_rows == 0:
+                continue
+            delta = take_delta(pc.max(batch["id"]).as_py())
+            kept_delta += delta.num_rows
+            table = pa.concat_tables([pa.Table.from_batches([batch]), delta])
+            writer.write_table(table.sort_by("id"))
+        delta = take_delta(None)
+        kept_delta += delta.num_rows
+        writer.write_table(delta)
+
+    print(
+        f"Merged {kept_previous} unchanged and {kept_delta} updated "
+        f"articles into {savepath}"
+    )
+
+
+def _conform(batch: pa.RecordBatch, schema: pa.Schema) -> pa.Table:
+    """Give a batch of the delta the columns of the previous file."""
+    columns = [
+        (
+            batch[field.name]
+            if field.name in batch.schema.names
+            else pa.nulls(batch.num_rows, field.type)
+        )
+        for field in schema
+    ]
+    return pa.Table.from_arrays(columns, schema=schema)
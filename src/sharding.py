@@ -0,0 +1,531 @@
+"""Sharded runs of the pipeline over several nodes sharing a folder."""
+
+import bisect
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+import pyarrow.parquet as pq
+
+from src.format_wiki_text import _find_stream_offsets, _read_index_offsets
+from src.utils.database import initialize_db
+from src.utils.parquet_writer import ParquetStreamWriter
+
+PLAN_FILE = "plan.json"
+
+# Outputs of every shard, in its own folder
+SHARD_PARQUET_FILE = "data.parquet"
+SHARD_DB_FILE = "database.db"
+
+_SHARD_NAME = "shard-{index:05d}-of-{count:05d}"
+
+# Rows of a shard whose id is already in the merged database with other values
+_FIND_CONFLICTS = """
+    SELECT shard.articles.id
+    FROM shard.articles JOIN main.articles ON main.articles.id = shard.articles.id
+    WHERE shard.articles.title IS NOT main.articles.title
+        OR shard.articles.raw_text IS NOT main.articles.raw_text
+        OR shard.articles.markdown_text IS NOT main.articles.markdown_text
+        OR shard.articles.model IS NOT main.articles.model
+    LIMIT 10
+"""
+
+_MERGE_ARTICLES = """
+    INSERT OR IGNORE INTO main.articles (
+        id, title, raw_text, markdown_text,
+        raw_text_tokens, markdown_text_tokens, model
+    )
+    SELECT
+        id, title, raw_text, markdown_text,
+        raw_text_tokens, markdown_text_tokens, model
+    FROM shard.articles
+"""
+
+
+class ShardPlan(NamedTuple):
+    """Partition of a multistream dump into shards processed independently."""
+
+    dump_file: str
+    dump_size: int
+    ranges: List[Tuple[int, int]]
+
+    @property
+    def num_shards(self) -> int:
+        """Number of shards of the plan."""
+        return len(self.ranges)
+
+    def shard_folder(self, folder: Union[str, Path], index: int) -> Path:
+        """Folder of the outputs of a shard."""
+        return Path(folder) / _SHARD_NAME.format(index=index, count=self.num_shards)
+
+
+class Claim(NamedTuple):
+    """Claim of a shard by a worker."""
+
+    index: int
+    generation: int
+    path: Path
+
+
+def plan_shards(
+    dump_file: Union[str, Path],
+    num_shards: int,
+    index_filename: Optional[Union[str, Path]] = None,
+) -> ShardPlan:
+    """
+    Partition the bz2 streams of a multistream dump into shards.
+
+    Each shard is a contiguous byte range of the dump, starting at a stream
+    offset, and the shards hold about the same number of compressed bytes. A
+    node only reads and decompresses the streams of its shards, and the
+    partition only depends on the dump, so every node computes the same one.
+
+    Args:
+        dump_file (str | Path): Path to the multistream dump.
+        num_shards (int): Number of shards.
+        index_filename (str | Path, optional): Path to the multistream index.
+            The dump is scanned for the stream offsets otherwise.
+
+    Returns:
+        ShardPlan: The byte range of every shard. Shards are empty when there
+        are fewer streams than shards.
+    """
+    dump_file = Path(dump_file)
+    dump_size = dump_file.stat().st_size
+    if index_filename is not None:
+        offsets = _read_index_offsets(index_filename)
+    else:
+        offsets = _find_stream_offsets(dump_file)
+
+    # Every shard starts at the first stream after its share of the file
+    boundaries = [0]
+    for index in range(1, num_shards):
+        position = bisect.bisect_left(offsets, dump_size * index // num_shards)
+        boundaries.append(
+            max(boundaries[-1], offsets[position])
+            if position < len(offsets)
+            else dump_size
+        )
+    boundaries.append(dump_size)
+
+    return ShardPlan(
+        dump_file.name,
+        dump_size,
+        list(zip(boundaries[:-1], boundaries[1:], strict=True)),
+    )
+
+
+def load_shard_plan(
+    folder: Union[str, Path],
+    dump_file: Union[str, Path],
+    num_shards: int,
+    index_filename: Optional[Union[str, Path]] = None,
+) -> ShardPlan:
+    """
+    Read the shard plan of a shared folder, creating it if needed.
+
+    The plan is saved in ``plan.json`` by the first node, and checked by the
+    others, so that nodes given a different dump or number of shards fail
+    instead of mixing their shards.
+
+    Args:
+        folder (str | Path): Folder shared by the nodes.
+        dump_file (str | Path): Path to the multistream dump.
+        num_shards (int): Number of shards.
+        index_filename (str | Path, optional): Path to the multistream index.
+
+    Returns:
+        ShardPlan: The plan of the folder.
+    """
+    plan_path = Path(folder) / PLAN_FILE
+    dump_file = Path(dump_file)
+    if plan_path.exists():
+        plan = read_shard_plan(folder)
+        if (
+            plan.dump_file != dump_file.name
+            or plan.dump_size != dump_file.stat().st_size
+            or plan.num_shards != num_shards
+        ):
+            raise ValueError(
+                f"{plan_path} holds {plan.num_shards} shards of {plan.dump_file} "
+                f"({plan.dump_size} bytes), not {num_shards} shards of "
+                f"{dump_file.name}. Use another folder or remove this one."
+            )
+        return plan
+
+    plan = plan_shards(dump_file, num_shards, index_filename)
+    plan_path.parent.mkdir(parents=True, exist_ok=True)
+    # Nodes creating the plan at the same time write the same content
+    tmp_path = plan_path.with_name(f"{PLAN_FILE}.{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(plan._asdict(), indent=2))
+    os.replace(tmp_path, plan_path)
+    return plan
+
+
+def read_shard_plan(folder: Union[str, Path]) -> ShardPlan:
+    """Read the ``plan.json`` file of a shared folder."""
+    with open(Path(folder) / PLAN_FILE, "r") as file:
+        plan = json.load(file)
+    return ShardPlan(
+        plan["dump_file"],
+        plan["dump_size"],
+        [tuple(byte_range) for byte_range in plan["ranges"]],
+    )
+
+
+class ShardClaims:
+    """
+    Claims of the shards by the workers of several nodes, as files of a shared folder.
+
+    A worker claims a shard by creating its claim file with ``O_EXCL``, so a
+    single worker gets it, and keeps the file's modification time fresh while
+    it processes the shard. A claim that was not refreshed for
+    ``stale_after`` seconds is considered abandoned, e.g. by a node that
+    crashed. It is taken over by creating the claim file of the next
+    generation, again with ``O_EXCL``. A completed shard gets a ``.done``
+    file, which is only written by the worker holding its latest claim.
+
+    Example:
+        >>> claims = ShardClaims("data/shards", num_shards=16)
+        >>> while claim := claims.claim():
+        ...     with claims.hold(claim):
+        ...         process_shard(claim.index)
+        ...     claims.complete(claim)
+    """
+
+    def __init__(
+        self,
+        folder: Union[str, Path],
+        num_shards: int,
+        stale_after: float = 600.0,
+        owner: Optional[str] = None,
+    ):
+        """
+        Open the claims of a shared folder.
+
+        Args:
+            folder (str | Path): Folder shared by the nodes. The claims are
+                kept in its ``claims`` subfolder.
+            num_shards (int): Number of shards.
+            stale_after (float): Seconds without a refresh after which a claim
+                can be taken over (default: 600).
+            owner (str, optional): Name of the worker in its claims. Defaults
+                to the host name and process id.
+        """
+        self.folder = Path(folder) / "claims"
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.num_shards = num_shards
+        self.stale_after = stale_after
+        self.owner = owner or f"{socket.gethostname()}-{os.getpid()}"
+
+    def claim(self, exclude: Set[int] = frozenset()) -> Optional[Claim]:
+        """
+        Claim the first shard neither done nor claimed by a live worker.
+
+        Args:
+            exclude (Set[int]): Shards not to claim.
+
+        Returns:
+            Claim, optional: The claim, or None if there is no shard to claim.
+        """
+        generations, done = self._scan()
+        for index in range(self.num_shards):
+            if index in done or index in exclude:
+                continue
+            generation = generations.get(index, 0)
+            if generation and not self._is_stale(self._path(index, generation)):
+                continue
+            claim = self._create(index, generation + 1)
+            if claim is not None and not self.is_done(index):
+                return claim
+        return None
+
+    def pending(self) -> Set[int]:
+        """Shards that are not done yet."""
+        return set(range(self.num_shards)) - self._scan()[1]
+
+    def is_done(self, index: int) -> bool:
+        """Check whether a shard is done."""
+        return (self.folder / f"{index:05d}.done").exists()
+
+    def is_current(self, claim: Claim) -> bool:
+        """Check that a claim was not taken over by another worker."""
+        return self._scan()[0].get(claim.index) == claim.generation
+
+    @contextmanager
+    def hold(self, claim: Claim) -> Iterator[None]:
+        """Refresh a claim from a background thread while a shard is processed."""
+        stop = threading.Event()
+
+        def refresh() -> None:
+            while not stop.wait(self.stale_after / 4):
+                os.utime(claim.path)
+
+        thread = threading.Thread(target=refresh, name="shard-claim", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, claim: Claim) -> bool:
+        """
+        Mark a shard as done.
+
+        Args:
+            claim (Claim): The claim of the worker that processed the shard.
+
+        Returns:
+            bool: False if the claim was taken over, in which case the shard
+            is completed by the worker that took it over.
+        """
+        if not self.is_current(claim):
+            return False
+        self._write(
+            self.folder / f"{claim.index:05d}.done",
+            {"owner": self.owner, "generation": claim.generation},
+        )
+        return True
+
+    def release(self, claim: Claim) -> None:
+        """Give up a claim, so that any worker can claim the shard again."""
+        os.utime(claim.path, (0, 0))
+
+    def _scan(self) -> Tuple[Dict[int, int], Set[int]]:
+        """Latest claim generation of every shard, and the shards done."""
+        generations: Dict[int, int] = {}
+        done = set()
+        for name in os.listdir(self.folder):
+            parts = name.split(".")
+            if len(parts) == 3 and parts[2] == "claim":
+                index, generation = int(parts[0]), int(parts[1])
+                generations[index] = max(generations.get(index, 0), generation)
+            elif len(parts) == 2 and parts[1] == "done":
+                done.add(int(parts[0]))
+        return generations, done
+
+    def _path(self, index: int, generation: int) -> Path:
+        return self.folder / f"{index:05d}.{generation:04d}.claim"
+
+    def _create(self, index: int, generation: int) -> Optional[Claim]:
+        """Create a claim file, unless another worker created it first."""
+        path = self._path(index, generation)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        with os.fdopen(fd, "w") as file:
+            json.dump({"owner": self.owner, "claimed_at": time.time()}, file)
+        return Claim(index, generation, path)
+
+    def _is_stale(self, path: Path) -> bool:
+        """
+        Check whether a claim was not refreshed for ``stale_after`` seconds.
+
+        The age of the claim is measured with the clock of the shared file
+        system rather than the clock of this node.
+        """
+        clock = self.folder / f".clock-{self.owner}"
+        clock.touch()
+        return clock.stat().st_mtime - path.stat().st_mtime > self.stale_after
+
+    def _write(self, path: Path, content: Dict[str, Any]) -> None:
+        """Write a file under a temporary name and move it into place."""
+        tmp_path = path.with_name(f"{path.name}.{self.owner}.tmp")
+        tmp_path.write_text(json.dumps(content))
+        os.replace(tmp_path, path)
+
+
+def run_shard_worker(
+    claims: ShardClaims,
+    process_shard: Callable[[int], bool],
+    poll_interval: Optional[float] = None,
+) -> List[int]:
+    """
+    Claim and process shards until every shard is done.
+
+    When the remaining shards are claimed by other workers, the worker waits
+    for them, and takes over the claims of the workers that died.
+
+    Args:
+        claims (ShardClaims): Claims of the shared folder.
+        process_shard (Callable[[int], bool]): Function processing a shard
+            from its index. It returns False if the shard is not complete,
+            e.g. some articles failed, in which case its claim is released
+            for another worker and this worker does not claim it again.
+        poll_interval (float, optional): Seconds between checks of the claims
+            of other workers (default: a quarter of ``claims.stale_after``, at
+            most 30).
+
+    Returns:
+        List[int]: The shards completed by this worker.
+    """
+    poll_interval = poll_interval or min(30.0, claims.stale_after / 4)
+    completed: List[int] = []
+    released: Set[int] = set()
+    while True:
+        claim = claims.claim(exclude=released)
+        if claim is None:
+            if not claims.pending() - released:
+                return completed
+            time.sleep(poll_interval)
+            continue
+
+        print(f"Processing shard {claim.index} (claim {claim.generation})...")
+        try:
+            with claims.hold(claim):
+                complete = process_shard(claim.index)
+        except BaseException:
+            claims.release(claim)
+            raise
+        if not complete:
+            print(f"Shard {claim.index} is incomplete, releasing it")
+            claims.release(claim)
+            released.add(claim.index)
+        elif claims.complete(claim):
+            completed.append(claim.index)
+        else:
+            print(f"Shard {claim.index} was taken over by another worker")
+
+
+def merge_shards(
+    folder: Union[str, Path],
+    db_path: Union[str, Path],
+    output_file: Optional[Union[str, Path]] = None,
+    allow_incomplete: bool = False,
+    row_group_size: int = 10_000,
+    compression: Optional[str] = "snappy",
+) -> Dict[str, int]:
+    """
+    Merge the databases (and Parquet files) of the shards.
+
+    The rows of every shard are inserted into the database in a transaction,
+    after checking that none of them conflicts with a row already in it: a row
+    with the same id but another title, text, Markdown or model. A conflict
+    aborts the merge of the shard, with the ids in the error. Rows identical
+    to those already in the database are skipped, so a merge can be run again.
+
+    Args:
+        folder (str | Path): Folder shared by the nodes.
+        db_path (str | Path): Database into which the shards are merged. It is
+            created if needed.
+        output_file (str | Path, optional): Parquet file into which the parsed
+            articles of the shards are concatenated, in dump order.
+        allow_incomplete (bool): Merge the completed shards even if some are
+            not done (default: False).
+        row_group_size (int): Number of articles per Parquet row group
+            (default: 10000).
+        compression (str, optional): Parquet compression codec
+            (default: "snappy").
+
+    Returns:
+        Dict[str, int]: Number of shards merged and of rows inserted.
+    """
+    plan = read_shard_plan(folder)
+    claims = ShardClaims(folder, plan.num_shards)
+    pending = sorted(claims.pending())
+    if pending and not allow_incomplete:
+        raise RuntimeError(
+            f"{len(pending)} of {plan.num_shards} shards are not done: {pending[:10]}"
+        )
+    shards = [
+        plan.shard_folder(folder, index)
+        for index in range(plan.num_shards)
+        if claims.is_done(index)
+    ]
+
+    Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+    initialize_db(str(db_path))
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    columns = _table_columns(conn, "main")
+    inserted = 0
+    try:
+        for shard in shards:
+            conn.execute("ATTACH DATABASE ? AS shard", (str(shard / SHARD_DB_FILE),))
+            try:
+                if _table_columns(conn, "shard") != columns:
+                    raise ValueError(f"The articles table of {shard} has other columns")
+                conn.execute("BEGIN IMMEDIATE")
+                conflicts = [id for (id,) in conn.execute(_FIND_CONFLICTS)]
+                if conflicts:
+                    raise ValueError(
+                        f"Articles of {shard} conflict with articles already "
+                        f"merged, e.g. the articles {conflicts}"
+                    )
+                inserted += conn.execute(_MERGE_ARTICLES).rowcount
+                conn.execute("COMMIT")
+            finally:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                conn.execute("DETACH DATABASE shard")
+    finally:
+        conn.close()
+
+    if output_file is not None:
+        _merge_parquet_files(
+            [shard / SHARD_PARQUET_FILE for shard in shards],
+            output_file,
+            row_group_size,
+            compression,
+        )
+
+    print(f"Merged {inserted} articles of {len(shards)} shards into {db_path}")
+    return {"shards": len(shards), "inserted": inserted}
+
+
+def _table_columns(conn: sqlite3.Connection, schema: str) -> List[Tuple[str, str]]:
+    """Names and types of the columns of the articles table of a database."""
+    return [
+        (name, type)
+        for _, name, type, *_ in conn.execute(f"PRAGMA {schema}.table_info(articles)")
+    ]
+
+
+def _merge_parquet_files(
+    paths: List[Path],
+    output_file: Union[str, Path],
+    row_group_size: int,
+    compression: Optional[str],
+) -> None:
+    """Concatenate the Parquet files of the shards, checking for duplicate ids."""
+    if not paths:
+        return
+    schema = pq.read_schema(paths[0])
+    Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+    ids: Set[int] = set()
+    with ParquetStreamWriter(
+        output_file, schema, row_group_size, compression
+    ) as writer:
+        for path in paths:
+            parquet_file = pq.ParquetFile(path)
+            if not parquet_file.schema_arrow.equals(schema):
+                raise ValueError(f"{path} does not have the schema of {paths[0]}")
+            for index in range(parquet_file.num_row_groups):
+                table = parquet_file.read_row_group(index)
+                batch_ids = table["id"].to_pylist()
+                duplicates = ids.intersection(batch_ids)
+                if duplicates:
+                    raise ValueError(
+                        f"Articles of {path} are in several shards, "
+                        f"e.g. the articles {sorted(duplicates)[:10]}"
+                    )
+                ids.update(batch_ids)
+                writer.write_table(table)
@@ -0,0 +1,121 @@
+"""Token counts of the parsed articles."""
+
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+from src.convert_to_markdown import _divide_into_sections
+from src.format_wiki_text import ARTICLE_SCHEMA
+from src.utils.parquet_writer import ParquetStreamWriter
+from src.utils.tokenizer import TokenizerLike, count_tokens_batch
+
+# Schema of the Parquet file produced by tokenize_wiki_text
+TOKENIZED_ARTICLE_SCHEMA = ARTICLE_SCHEMA.append(
+    pa.field("token_count", pa.int64())
+).append(pa.field("section_token_counts", pa.list_(pa.int64())))
+
+
+def tokenize_wiki_text(
+    filename: Union[str, Path],
+    tokenizer: TokenizerLike,
+    savepath: Optional[Union[str, Path]] = None,
+    batch_size: int = 1000,
+    row_group_size: int = 10_000,
+    compression: Optional[str] = "snappy",
+    keep_counts: bool = False,
+) -> None:
+    """
+    Add the token counts of the articles to the Parquet file of ``format_wiki_text``.
+
+    Two columns are added: ``token_count``, the number of tokens of the text,
+    and ``section_token_counts``, the number of tokens of each of its sections
+    (as split by ``convert_long_text_to_markdown``). They are computed with the
+    batched encoding of the fast tokenizer and consumed by the conversion step,
+    which then does not have to encode the texts again.
+
+    With ``keep_counts``, the articles that have token counts already, e.g.
+    the unchanged articles of an incremental update (see
+    ``update_wiki_text``), keep them, and only the others are encoded.
+
+    The file is read and written one batch of articles at a time, so memory
+    usage does not depend on the size of the corpus.
+
+    Args:
+        filename (str | Path): Parquet file written by ``format_wiki_text``.
+        tokenizer (TokenizerLike): Tokenizer of the conversion model.
+        savepath (str | Path, optional): Path to the output Parquet file.
+            Defaults to ``filename``, which is replaced.
+        batch_size (int): Number of articles encoded at a time (default: 1000).
+        row_group_size (int): Number of articles per Parquet row group
+            (default: 10000).
+        compression (str, optional): Parquet compression codec
+            (default: "snappy").
+        keep_counts (bool): Keep the token counts already in the file, which
+            must have been computed with the same tokenizer (default: False).
+    """
+    savepath = Path(savepath or filename)
+    parquet_file = pq.ParquetFile(filename)
+    counted = keep_counts and set(TOKENIZED_ARTICLE_SCHEMA.names) <= set(
+        parquet_file.schema.names
+    )
+
+    with (
+        ParquetStreamWriter(
+            savepath, TOKENIZED_ARTICLE_SCHEMA, row_group_size, compression
+        ) as writer,
+        tqdm(total=parquet_file.metadata.num_rows, desc="Counting tokens") as pbar,
+    ):
+        for batch in parquet_file.iter_batches(
+            batch_size=batch_size,
+            columns=(TOKENIZED_ARTICLE_SCHEMA if counted else ARTICLE_SCHEMA).names,
+        ):
+            texts = batch["text"].to_pylist()
+            if counted:
+                token_counts = batch["token_count"].to_pylist()
+                section_token_counts = batch["section_token_counts"].to_pylist()
+            else:
+                token_counts = [None] * batch.num_rows
+                section_token_counts = [None] * batch.num_rows
+
+            missing = [i for i, count in enumerate(token_counts) if count is None]
+            counts, section_counts = _count_tokens(
+                tokenizer, [texts[i] for i in missing]
+            )
+            for i, count, sections in zip(missing, counts, section_counts, strict=True):
+                token_counts[i] = count
+                section_token_counts[i] = sections
+
+            table = pa.Table.from_batches([batch]).select(ARTICLE_SCHEMA.names)
+            table = table.append_column(
+                "token_count", pa.array(token_counts, pa.int64())
+            )
+            table = table.append_column(
+                "section_token_counts",
+                pa.array(section_token_counts, pa.list_(pa.int64())),
+            )
+            writer.write_table(table)
+            pbar.update(batch.num_rows)
+
+    print(f"Token counts of {writer.rows_written} articles saved to {savepath}")
+
+
+def _count_tokens(
+    tokenizer: TokenizerLike, texts: List[str]
+) -> Tuple[List[int], List[List[int]]]:
+    """Number of tokens of texts, and of each of their sections."""
+    token_counts = count_tokens_batch(tokenizer, texts)
+
+    # Encode the sections of all the texts at once
+    sections = [_divide_into_sections(text) for text in texts]
+    flat_counts = count_tokens_batch(
+        tokenizer, [section for article in sections for section in article]
+    )
+    section_token_counts = []
+    start = 0
+    for article in sections:
+        section_token_counts.append(flat_counts[start : start + len(article)])
+        start += len(article)
+    return token_counts, section_token_counts
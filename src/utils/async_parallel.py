@@ -0,0 +1,711 @@
+"""Asynchronous conversion of the articles under adaptive rate limits."""
+
+import asyncio
+import queue
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import httpx
+import pandas as pd
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+from src.convert_to_markdown import (
+    MarkdownConverter,
+    aconvert_long_text_to_markdown,
+)
+from src.convert_with_rules import (
+    RULE_BASED_MODEL,
+    FastPathClassifier,
+    convert_text_with_rules,
+)
+from src.utils.cache import ConversionCache
+from src.utils.database import DatabaseWriter
+from src.utils.metrics import METRICS
+from src.utils.parallel import ARTICLE_FIELDS, _stream_work_items
+from src.utils.rate_limit import (
+    AIMDLimiter,
+    TokenBudget,
+    is_overload,
+    rate_limit_pause,
+    retry_delay,
+)
+from src.utils.retry import RetryPolicy
+from src.utils.scheduling import (
+    LatencyModel,
+    WorkItem,
+    get_token_counts,
+    pack_texts,
+    plan_work,
+    predict_makespan,
+    unpack_markdown,
+)
+from src.utils.tokenizer import TokenizerLike, count_tokens
+
+
+class ThrottledConverter:
+    """
+    Send the requests of a converter through a concurrency limit and a token budget.
+
+    The concurrency limit is adaptive, and the requests rejected because of rate
+    limits are retried.
+
+    Every request of every article goes through the same limiter, so it
+    controls the total number of requests in flight. Requests failing with
+    other retryable errors, such as server errors and timeouts, are retried
+    after an exponential backoff with jitter, without holding a slot.
+    """
+
+    def __init__(
+        self,
+        converter: MarkdownConverter,
+        tokenizer: TokenizerLike,
+        limiter: AIMDLimiter,
+        token_budget: Optional[TokenBudget] = None,
+        max_attempts: int = 5,
+    ):
+        """
+        Wrap a converter in a concurrency limit and a token budget.
+
+        Args:
+            converter (MarkdownConverter): Converter sending the requests. It
+                should not retry by itself (``max_retries=0``), so that rate
+                limit errors reach the limiter.
+            tokenizer (TokenizerLike): Tokenizer for counting tokens.
+            limiter (AIMDLimiter): Concurrency limit.
+            token_budget (TokenBudget, optional): Tokens per minute limit.
+            max_attempts (int): Attempts per request on retryable errors
+                (default: 5).
+        """
+        self.converter = converter
+        self.tokenizer = tokenizer
+        self.limiter = limiter
+        self.token_budget = token_budget
+        self.max_attempts = max_attempts
+        self.retries = 0
+        # Number of tokens and duration, in seconds, of the requests that
+        # succeeded, without the waits for the limiter and the token budget
+        self.samples: List[Tuple[int, float]] = []
+
+        self._backoff = RetryPolicy(max_attempts=max_attempts)
+
+        self._prompt_tokens = count_tokens(tokenizer, converter.template)
+        converter.add_response_hook(self._on_response)
+
+    async def aconvert(self, raw_text: str, text_tokens: Optional[int] = None) -> str:
+        """
+        Convert a text, waiting for the limiter and the token budget.
+
+        Args:
+            raw_text (str): The input text to be formatted.
+            text_tokens (int, optional): Number of tokens of the text, counted
+                if not given.
+
+        Returns:
+            str: The formatted markdown text.
+        """
+        # Cached conversions need neither a slot nor tokens
+        cached = self.converter.lookup(raw_text)
+        if cached is not None:
+            return cached
+
+        if text_tokens is None:
+            text_tokens = count_tokens(self.tokenizer, raw_text)
+        # The output is about as long as the input
+        request_tokens = self._prompt_tokens + 2 * text_tokens
+
+        for attempt in range(1, self.max_attempts + 1):
+            if self.token_budget is not None:
+                await self.token_budget.acquire(request_tokens)
+
+            backoff = 0.0
+            async with self.limiter:
+                start = time.monotonic()
+                try:
+                    # Looked up in the cache above already
+                    markdown_text = await self.converter.aconvert(
+                        raw_text, check_cache=False
+                    )
+                except Exception as error:
+                    delay = retry_delay(error)
+                    if delay is None or attempt == self.max_attempts:
+                        raise
+                    if is_overload(error):
+                        self.limiter.on_overload(delay)
+                        METRICS.inc("api_overloads_total")
+                    elif delay:
+                        self.limiter.pause(delay)
+                    else:
+                        backoff = self._backoff.delay(attempt)
+                    self.retries += 1
+                    METRICS.inc("api_retries_total")
+                    METRICS.set_gauge("api_concurrency_limit", self.limiter.limit)
+                else:
+                    duration = time.monotonic() - start
+                    self.samples.append((text_tokens, duration))
+                    self.limiter.on_success(duration, duration / request_tokens)
+                    METRICS.set_gauge("api_concurrency_limit", self.limiter.limit)
+                    return markdown_text
+            await asyncio.sleep(backoff)
+
+    async def _on_response(self, response: httpx.Response) -> None:
+        """Pause new requests when the rate limit headers ask for it."""
+        pause = rate_limit_pause(response.headers)
+        if pause:
+            self.limiter.pause(pause)
+
+
+async def async_process_dataframe(
+    data: pd.DataFrame,
+    model_openrouter: str,
+    template: str,
+    tokenizer: TokenizerLike,
+    model_hf: str,
+    db_path: str,
+    max_tokens: int = 7000,
+    initial_concurrency: int = 16,
+    max_concurrency: int = 1024,
+    tokens_per_minute: Optional[int] = None,
+    max_attempts: int = 5,
+    request_timeout: Optional[float] = None,
+    hedge_quantile: Optional[float] = None,
+    cache: Optional[ConversionCache] = None,
+    schedule: bool = True,
+    stub_tokens: int = 0,
+    pack_tokens: int = 2000,
+    fast_path: Optional[FastPathClassifier] = None,
+) -> Dict[str, Any]:
+    """
+    Asynchronous version of ``parallel_process_dataframe``.
+
+    All the requests run on a single event loop. Instead of a fixed number of
+    workers, the number of requests in flight is adapted to the provider: it
+    grows while requests succeed with healthy latencies, and backs off on rate
+    limit and overload errors (429, 503) and rate limit headers. An optional
+    token budget keeps the tokens sent per minute under the account's quota.
+
+    Articles are scheduled as in ``parallel_process_dataframe``: longest first,
+    with stubs optionally packed into shared requests, and trivial articles
+    optionally converted with the rules.
+
+    Example:
+        >>> asyncio.run(async_process_dataframe(data, model, template, ...))
+
+    Args:
+        data (pd.DataFrame): DataFrame with rows to process.
+        model_openrouter (str): Model for markdown conversion.
+        template (str): Template for markdown conversion.
+        tokenizer (TokenizerLike): Tokenizer for counting tokens.
+        model_hf (str): Hugging Face model identifier.
+        db_path (str): SQLite database path.
+        max_tokens (int): Max tokens allowed for long text (default: 7000).
+        initial_concurrency (int): Initial number of requests in flight
+            (default: 16).
+        max_concurrency (int): Maximum number of requests in flight
+            (default: 1024).
+        tokens_per_minute (int, optional): Token budget per minute, counting
+            both the prompt and the expected output.
+        max_attempts (int): Attempts per request on retryable errors
+            (default: 5).
+        request_timeout (float, optional): Seconds after which a request fails
+            with a timeout, and is retried.
+        hedge_quantile (float, optional): Quantile of the recent latencies
+            after which a slow request is sent a second time (see
+            ``MarkdownConverter``). Defaults to no hedging.
+        cache (ConversionCache, optional): Cache of conversion results.
+        schedule (bool): Submit the articles longest first (default: True).
+        stub_tokens (int): Maximum number of tokens of the articles packed
+            together into a request. 0 disables packing (default: 0).
+        pack_tokens (int): Maximum number of tokens of a packed request
+            (default: 2000).
+        fast_path (FastPathClassifier, optional): Classifier routing trivial
+            articles to the rule-based converter.
+
+    Returns:
+        Dict[str, Any]: Number of processed and failed articles, retries,
+        overload errors, the final concurrency limit, the predicted and actual
+        makespans, in seconds, and number of articles converted with the rules.
+        The prediction made before the run assumes ``initial_concurrency`` and
+        the default latency model, the one made after uses the final limit and
+        a model fitted to the run.
+    """
+    throttled = _throttled_converter(
+        model_openrouter,
+        template,
+        tokenizer,
+        initial_concurrency,
+        max_concurrency,
+        tokens_per_minute,
+        max_attempts,
+        request_timeout,
+        hedge_quantile,
+        cache,
+    )
+    limiter = throttled.limiter
+    writer = DatabaseWriter(db_path)
+
+    # Use the token counts of tokenize_wiki_text when available
+    token_counts = get_token_counts(data, tokenizer)
+    rows = list(data.reindex(columns=ARTICLE_FIELDS).itertuples(index=False, name=None))
+
+    rule_positions: List[int] = []
+    llm_positions = list(range(len(data)))
+    if fast_path is not None:
+        rule_positions, llm_positions = fast_path.split(
+            data["text"].tolist(), token_counts
+        )
+        for position in tqdm(rule_positions, desc="Converting with rules"):
+            id, title, text = rows[position][:3]
+            await _insert_article(
+                writer,
+                id,
+                title,
+                text,
+                convert_text_with_rules(text),
+                token_counts[position],
+                tokenizer,
+                RULE_BASED_MODEL,
+            )
+
+    if schedule:
+        items = plan_work(token_counts, stub_tokens, pack_tokens, llm_positions)
+    else:
+        items = [WorkItem([i], token_counts[i]) for i in llm_positions]
+    predicted = predict_makespan(items, initial_concurrency, max_tokens)
+    pending = iter(items)
+
+    pbar = tqdm(total=len(llm_positions), desc="Processing rows")
+    failed = 0
+
+    async def worker() -> None:
+        nonlocal failed
+        # Items are taken one at a time, so all workers share the iterator
+        for item in pending:
+            try:
+                await _aprocess_item(
+                    [rows[position] for position in item.positions],
+                    [token_counts[position] for position in item.positions],
+                    throttled,
+                    tokenizer,
+                    model_hf,
+                    writer,
+                    max_tokens,
+                )
+            except Exception as e:
+                failed += len(item.positions)
+                print(f"An error occurred: {e}")
+                await _arecord_failures(
+                    writer, [rows[position] for position in item.positions], e
+                )
+            pbar.update(len(item.positions))
+
+    # The limiter, not the number of workers, bounds the requests in flight
+    start = time.monotonic()
+    try:
+        await asyncio.gather(*(worker() for _ in range(max_concurrency)))
+    finally:
+        pbar.close()
+        await throttled.converter.aclose()
+        # Commit the rows still queued, off the event loop
+        await asyncio.to_thread(writer.close)
+
+    return {
+        "processed": len(llm_positions) - failed,
+        "failed": failed,
+        "retries": throttled.retries,
+        "overloads": limiter.overloads,
+        "concurrency_limit": int(limiter.limit),
+        "predicted_makespan": predicted,
+        "fitted_makespan": predict_makespan(
+            items, int(limiter.limit), max_tokens, LatencyModel.fit(throttled.samples)
+        ),
+        "actual_makespan": time.monotonic() - start,
+        "rule_based": len(rule_positions),
+    }
+
+
+async def async_stream_process_parquet(
+    filename: Union[str, Path],
+    model_openrouter: str,
+    template: str,
+    tokenizer: TokenizerLike,
+    model_hf: str,
+    db_path: str,
+    max_tokens: int = 7000,
+    batch_size: int = 1000,
+    initial_concurrency: int = 16,
+    max_concurrency: int = 1024,
+    tokens_per_minute: Optional[int] = None,
+    max_attempts: int = 5,
+    request_timeout: Optional[float] = None,
+    hedge_quantile: Optional[float] = None,
+    cache: Optional[ConversionCache] = None,
+    stub_tokens: int = 0,
+    pack_tokens: int = 2000,
+    fast_path: Optional[FastPathClassifier] = None,
+    skip_duplicates: bool = False,
+    max_in_flight: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Asynchronous version of ``stream_process_parquet``.
+
+    The file is read one batch at a time, off the event loop, and the work
+    items are queued for the workers, at most ``max_in_flight`` at a time, so
+    memory usage does not depend on the size of the corpus. The requests are
+    throttled as in ``async_process_dataframe``: the number in flight adapts to
+    the provider, between 1 and ``max_concurrency``.
+
+    Articles already in the database are skipped, so an interrupted run
+    resumes where it stopped, and the articles that failed are retried.
+
+    Example:
+        >>> asyncio.run(async_stream_process_parquet("data.parquet", model, ...))
+
+    Args:
+        filename (str | Path): Parquet file of ``format_wiki_text``, or of
+            ``tokenize_wiki_text`` to reuse its token counts.
+        model_openrouter (str): Model for markdown conversion.
+        template (str): Template for markdown conversion.
+        tokenizer (TokenizerLike): Tokenizer for counting tokens.
+        model_hf (str): Hugging Face model identifier.
+        db_path (str): SQLite database path.
+        max_tokens (int): Max tokens allowed for long text (default: 7000).
+        batch_size (int): Number of articles read at a time (default: 1000).
+        initial_concurrency (int): Initial number of requests in flight
+            (default: 16).
+        max_concurrency (int): Maximum number of requests in flight
+            (default: 1024).
+        tokens_per_minute (int, optional): Token budget per minute, counting
+            both the prompt and the expected output.
+        max_attempts (int): Attempts per request on retryable errors
+            (default: 5).
+        request_timeout (float, optional): Seconds after which a request fails
+            with a timeout, and is retried.
+        hedge_quantile (float, optional): Quantile of the recent latencies
+            after which a slow request is sent a second time. Defaults to no
+            hedging.
+        cache (ConversionCache, optional): Cache of conversion results.
+        stub_tokens (int): Maximum number of tokens of the articles packed
+            together into a request. 0 disables packing (default: 0).
+        pack_tokens (int): Maximum number of tokens of a packed request
+            (default: 2000).
+        fast_path (FastPathClassifier, optional): Classifier routing trivial
+            articles to the rule-based converter.
+        skip_duplicates (bool): Leave out the near-duplicates found by
+            ``dedupe_wiki_text``, to convert them from their exemplar with
+            ``convert_near_duplicates`` (default: False).
+        max_in_flight (int, optional): Maximum number of work items read and
+            not completed yet (default: twice ``max_concurrency``).
+
+    Returns:
+        Dict[str, Any]: Number of processed, failed and skipped articles,
+        number of articles converted with the rules, of near-duplicates left
+        out, retries, overload errors, the final concurrency limit, and
+        duration of the run, in seconds.
+    """
+    throttled = _throttled_converter(
+        model_openrouter,
+        template,
+        tokenizer,
+        initial_concurrency,
+        max_concurrency,
+        tokens_per_minute,
+        max_attempts,
+        request_timeout,
+        hedge_quantile,
+        cache,
+    )
+    parquet_file = pq.ParquetFile(filename)
+    report: Dict[str, Any] = {
+        "processed": 0,
+        "failed": 0,
+        "skipped": 0,
+        "rule_based": 0,
+        "duplicates": 0,
+    }
+    max_in_flight = max_in_flight or 2 * max_concurrency
+    pending: asyncio.Queue = asyncio.Queue(maxsize=max_in_flight)
+
+    start = time.monotonic()
+    writer = DatabaseWriter(db_path)
+    pbar = tqdm(total=parquet_file.metadata.num_rows, desc="Processing rows")
+    work = _stream_work_items(
+        parquet_file,
+        db_path,
+        tokenizer,
+        writer,
+        report,
+        pbar,
+        batch_size,
+        stub_tokens,
+        pack_tokens,
+        fast_path,
+        skip_duplicates,
+    )
+
+    async def produce() -> None:
+        # Reading and tokenizing a batch takes a while, so it runs in a thread
+        while True:
+            item = await asyncio.to_thread(next, work, None)
+            if item is None:
+                break
+            await pending.put(item)
+            METRICS.add_gauge("work_items_in_flight", 1)
+        for _ in range(max_concurrency):
+            await pending.put(None)
+
+    async def worker() -> None:
+        while True:
+            item = await pending.get()
+            if item is None:
+                return
+            rows, token_counts = item
+            try:
+                await _aprocess_item(
+                    rows,
+                    token_counts,
+                    throttled,
+                    tokenizer,
+                    model_hf,
+                    writer,
+                    max_tokens,
+                )
+                report["processed"] += len(rows)
+            except Exception as e:
+                report["failed"] += len(rows)
+                print(f"An error occurred: {e}")
+                await _arecord_failures(writer, rows, e)
+            METRICS.add_gauge("work_items_in_flight", -1)
+            pbar.update(len(rows))
+
+    # The limiter, not the number of workers, bounds the requests in flight
+    tasks = [asyncio.ensure_future(produce())]
+    tasks += [asyncio.ensure_future(worker()) for _ in range(max_concurrency)]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            # Raise the error of a failed task, such as a failed writer
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        pbar.close()
+        await throttled.converter.aclose()
+        # Commit the rows still queued, off the event loop
+        await asyncio.to_thread(writer.close)
+
+    report.update(
+        {
+            "retries": throttled.retries,
+            "overloads": throttled.limiter.overloads,
+            "concurrency_limit": int(throttled.limiter.limit),
+            "actual_makespan": time.monotonic() - start,
+        }
+    )
+    return report
+
+
+def _throttled_converter(
+    model_openrouter: str,
+    template: str,
+    tokenizer: TokenizerLike,
+    initial_concurrency: int,
+    max_concurrency: int,
+    tokens_per_minute: Optional[int],
+    max_attempts: int,
+    request_timeout: Optional[float],
+    hedge_quantile: Optional[float],
+    cache: Optional[ConversionCache],
+) -> ThrottledConverter:
+    """Create a converter sending its requests through a new limiter."""
+    limiter = AIMDLimiter(initial_limit=initial_concurrency, max_limit=max_concurrency)
+    token_budget = TokenBudget(tokens_per_minute) if tokens_per_minute else None
+    converter = MarkdownConverter(
+        model_openrouter,
+        template,
+        max_connections=max_concurrency,
+        max_retries=0,
+        cache=cache,
+        request_timeout=request_timeout,
+        hedge_quantile=hedge_quantile,
+    )
+    return ThrottledConverter(converter, tokenizer, limiter, token_budget, max_attempts)
+
+
+async def _aprocess_item(
+    rows: List[Tuple],
+    token_counts: List[int],
+    converter: ThrottledConverter,
+    tokenizer: TokenizerLike,
+    model_hf: str,
+    writer: DatabaseWriter,
+    max_tokens: int,
+) -> None:
+    """
+    Convert the articles of a work item and insert them into a database.
+
+    Args:
+        rows (List[Tuple]): The articles, as tuples of the ``ARTICLE_FIELDS``.
+        token_counts (List[int]): Number of tokens of each article.
+        converter (ThrottledConverter): Converter to use.
+        tokenizer (TokenizerLike): Tokenizer for counting tokens.
+        model_hf (str): Hugging Face model identifier.
+        writer (DatabaseWriter): Writer of the database.
+        max_tokens (int): Max tokens for long text.
+    """
+    if len(rows) > 1:
+        await _aprocess_stubs(
+            rows, token_counts, converter, tokenizer, model_hf, writer
+        )
+        return
+
+    id, title, text, _, section_token_counts = rows[0]
+    await _aprocess_row(
+        id,
+        title,
+        text,
+        converter,
+        tokenizer,
+        model_hf,
+        writer,
+        max_tokens,
+        token_counts[0],
+        section_token_counts,
+    )
+
+
+async def _arecord_failures(
+    writer: DatabaseWriter, rows: List[Tuple], error: Exception
+) -> None:
+    """Record the failure of the articles of a work item, to retry them later."""
+    for row in rows:
+        id, title = row[:2]
+        await asyncio.to_thread(writer.record_failure, int(id), title, error)
+
+
+async def _aprocess_row(
+    id: int,
+    title: str,
+    text: str,
+    converter: ThrottledConverter,
+    tokenizer: TokenizerLike,
+    model_hf: str,
+    writer: DatabaseWriter,
+    max_tokens: int,
+    n_tokens: Optional[int] = None,
+    section_token_counts: Optional[Sequence[int]] = None,
+) -> None:
+    """
+    Convert an article to markdown and insert it into a database.
+
+    Args:
+        id (int): Article id.
+        title (str): Article title.
+        text (str): Article text.
+        converter (ThrottledConverter): Converter to use.
+        tokenizer (TokenizerLike): Tokenizer for counting tokens.
+        model_hf (str): Hugging Face model identifier.
+        writer (DatabaseWriter): Writer of the database.
+        max_tokens (int): Max tokens for long text.
+        n_tokens (int, optional): Precomputed number of tokens of the text.
+        section_token_counts (Sequence[int], optional): Precomputed number of
+            tokens of each section.
+    """
+    if n_tokens is None or pd.isna(n_tokens):
+        n_tokens = count_tokens(tokenizer, text)
+    n_tokens = int(n_tokens)
+
+    with METRICS.time("article_convert_seconds"):
+        if n_tokens <= max_tokens:
+            markdown_text = await converter.aconvert(text, n_tokens)
+        else:
+            markdown_text = await aconvert_long_text_to_markdown(
+                text,
+                tokenizer,
+                max_tokens,
+                converter.aconvert,
+                (
+                    list(section_token_counts)
+                    if pd.api.types.is_list_like(section_token_counts)
+                    else None
+                ),
+            )
+
+    await _insert_article(
+        writer, id, title, text, markdown_text, n_tokens, tokenizer, model_hf
+    )
+
+
+async def _aprocess_stubs(
+    rows: List[Tuple],
+    token_counts: List[int],
+    converter: ThrottledConverter,
+    tokenizer: TokenizerLike,
+    model_hf: str,
+    writer: DatabaseWriter,
+) -> None:
+    """
+    Convert several short articles in a single request and insert them.
+
+    If the output can not be split back into articles, they are converted again
+    one by one.
+
+    Args:
+        rows (List[Tuple]): Id, title and text (followed by the token count
+            columns) of each article.
+        token_counts (List[int]): Number of tokens of each article.
+        converter (ThrottledConverter): Converter to use.
+        tokenizer (TokenizerLike): Tokenizer for counting tokens.
+        model_hf (str): Hugging Face model identifier.
+        writer (DatabaseWriter): Writer of the database.
+    """
+    texts = [row[2] for row in rows]
+    markdown_text = await converter.aconvert(pack_texts(texts), sum(token_counts))
+    markdown_texts = unpack_markdown(markdown_text, len(rows))
+    if markdown_texts is None:
+        markdown_texts = await asyncio.gather(
+            *(
+                converter.aconvert(text, n_tokens)
+                for text, n_tokens in zip(texts, token_counts, strict=True)
+            )
+        )
+
+    for row, n_tokens, markdown_text in zip(
+        rows, token_counts, markdown_texts, strict=True
+    ):
+        id, title, text = row[:3]
+        await _insert_article(
+            writer, id, title, text, markdown_text, n_tokens, tokenizer, model_hf
+        )
+
+
+async def _insert_article(
+    writer: DatabaseWriter,
+    id: int,
+    title: str,
+    text: str,
+    markdown_text: str,
+    n_tokens: int,
+    tokenizer: TokenizerLike,
+    model_hf: str,
+) -> None:
+    """Queue a converted article for insertion into the database."""
+    row = {
+        "id": int(id),
+        "title": title,
+        "raw_text": text,
+        "markdown_text": markdown_text,
+        "raw_text_tokens": n_tokens,
+        "markdown_text_tokens": count_tokens(tokenizer, markdown_text),
+        "model": model_hf,
+    }
+    try:
+        writer.insert_row(**row, block=False)
+    except queue.Full:
+        # The writer is behind: wait for room off the event loop
+        await asyncio.to_thread(writer.insert_row, **row)
+    method = "rules" if model_hf == RULE_BASED_MODEL else "llm"
+    METRICS.inc("articles_converted_total", method=method)
+    METRICS.inc("article_tokens_total", n_tokens, method=method)
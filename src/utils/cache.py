@@ -0,0 +1,181 @@
+"""Persistent cache of the conversions."""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+
+class ConversionCache:
+    """
+    Persistent, content-addressed cache of LLM conversion results.
+
+    Results are stored in a SQLite database under the SHA-256 of the model,
+    the prompt template and the input text, so the same chunk is never paid
+    for twice, across retries, restarts and dump releases. When the stored
+    results exceed ``max_size_bytes``, the least recently used ones are
+    evicted. A cache is thread-safe, and the database can be shared by several
+    processes.
+
+    Example:
+        >>> cache = ConversionCache("data/conversion_cache.db")
+        >>> converter = MarkdownConverter(model, template, cache=cache)
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        max_size_bytes: Optional[int] = 1024**3,
+    ):
+        """
+        Open the cache, creating its database if needed.
+
+        Args:
+            path (str | Path): Path to the SQLite database of the cache.
+            max_size_bytes (int, optional): Maximum total size of the cached
+                results. None for no limit (default: 1 GiB).
+        """
+        self.path = Path(path)
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None, timeout=30
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value TEXT,
+                size INTEGER,
+                last_access REAL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)"
+        )
+        (self._size,) = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache"
+        ).fetchone()
+
+    @staticmethod
+    def make_key(model: str, template: str, text: str) -> str:
+        """
+        Compute the key of a conversion.
+
+        Args:
+            model (str): The model used for the conversion.
+            template (str): The prompt template.
+            text (str): The converted text.
+
+        Returns:
+            str: Hex digest identifying the conversion.
+        """
+        digest = hashlib.sha256()
+        for part in (model, template, text):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Look up a conversion, marking it as recently used.
+
+        Args:
+            key (str): Key from ``make_key``.
+
+        Returns:
+            str, optional: The cached result, or None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE cache SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        """
+        Store a conversion, evicting old results if the cache is full.
+
+        Args:
+            key (str): Key from ``make_key``.
+            value (str): The result of the conversion.
+        """
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO cache (key, value, size, last_access) "
+                "VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            if cursor.rowcount > 0:
+                self._size += size
+            if self.max_size_bytes is not None and self._size > self.max_size_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Delete the least recently used results down to 90% of the limit."""
+        target = 0.9 * self.max_size_bytes
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Other processes may have written to the cache too
+            (self._size,) = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM cache"
+            ).fetchone()
+            cursor = self._conn.execute(
+                "SELECT key, size FROM cache ORDER BY last_access"
+            )
+            evicted = []
+            for key, size in cursor:
+                if self._size <= target:
+                    break
+                evicted.append((key,))
+                self._size -= size
+            cursor.close()
+            self._conn.executemany("DELETE FROM cache WHERE key = ?", evicted)
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self.evictions += len(evicted)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the hit and miss statistics of this process.
+
+        Returns:
+            Dict[str, Any]: Hits, misses, hit rate, evictions, and number and
+            total size of the cached results.
+        """
+        with self._lock:
+            (entries,) = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "size_bytes": self._size,
+        }
+
+    def close(self) -> None:
+        """Close the database."""
+        with self._lock:
+            self._conn.close()
@@ -1,20 +1,81 @@
+import atexit
 import os
+import queue
 import sqlite3
+import threading
+import time
 from pathlib import Path
-from typing import Union
+from typing import Iterable, List, NamedTuple, Optional, Set, Tuple, Union
 
 import pandas as pd
 
+from src.utils.metrics import METRICS
+
+_INSERT_ARTICLE = """
+    INSERT OR IGNORE INTO articles (
+        id, title, raw_text, markdown_text,
+        raw_text_tokens, markdown_text_tokens, model
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Covering index of the ids. The primary key is the rowid, whose B-tree also
+# holds the texts, so scanning it reads the whole database.
+_CREATE_ID_INDEX = "CREATE INDEX IF NOT EXISTS articles_id ON articles (id)"
+
+# Articles whose conversion failed, retried by the next run. ``failures``
+# counts the runs in which the article failed.
+_CREATE_FAILED_TABLE = """
+    CREATE TABLE IF NOT EXISTS failed_articles (
+        id INTEGER PRIMARY KEY,
+        title TEXT,
+        error TEXT,
+        failures INTEGER,
+        failed_at REAL
+    )
+"""
+
+_RECORD_FAILURE = """
+    INSERT INTO failed_articles (id, title, error, failures, failed_at)
+    VALUES (?, ?, ?, 1, ?)
+    ON CONFLICT (id) DO UPDATE SET
+        title = excluded.title,
+        error = excluded.error,
+        failures = failures + 1,
+        failed_at = excluded.failed_at
+"""
+
+_DELETE_FAILURE = "DELETE FROM failed_articles WHERE id = ?"
+
+
+class _Failure(NamedTuple):
+    """Failure queued by ``DatabaseWriter.record_failure``."""
+
+    id: int
+    title: str
+    error: str
+    failed_at: float
+
 
 def initialize_db(db_path: str):
     """
     Initialize the SQLite database and create the table if it doesn't exist.
 
+    Databases created by earlier versions are migrated: the index of the IDs
+    and the table of the failed articles are added if they are missing.
+
     Args:
         db_path (str): Path to the SQLite database file.
     """
     if os.path.exists(db_path):
         print(f"Database already exists at {db_path}")
+        conn = sqlite3.connect(db_path)
+        try:
+            with conn:
+                conn.execute(_CREATE_ID_INDEX)
+                conn.execute(_CREATE_FAILED_TABLE)
+        finally:
+            conn.close()
     else:
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
@@ -31,6 +92,8 @@ def initialize_db(db_path: str):
             )
             """
         )
+        cursor.execute(_CREATE_ID_INDEX)
+        cursor.execute(_CREATE_FAILED_TABLE)
         conn.commit()
         conn.close()
         print(f"Database initialized successfully at {db_path}")
@@ -42,6 +105,10 @@ def filter_rows_in_db(
     """
     Filter DataFrame rows to exclude IDs already present in the database.
 
+    The IDs of the database are read at once from their index and matched
+    with a hash table, so filtering the full corpus takes a fraction of a
+    second.
+
     Args:
         df (pd.DataFrame): DataFrame to filter.
         db_path (str): Path to the SQLite database file.
@@ -50,17 +117,31 @@ def filter_rows_in_db(
     Returns:
         pd.DataFrame: Filtered DataFrame with IDs not in the database.
     """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    ids = df[id_column].tolist()
-    placeholders = ",".join(["?"] * len(ids))
-    query = f"SELECT id FROM articles WHERE id IN ({placeholders})"
-    cursor.execute(query, ids)
-    existing_ids = [row[0] for row in cursor.fetchall()]
-    conn.close()
+    existing_ids = read_article_ids(db_path)
     return df[~df[id_column].isin(existing_ids)]
 
 
+def read_article_ids(db_path: Union[str, Path]) -> pd.Series:
+    """
+    Read the IDs of all the articles stored in the database.
+
+    The IDs are read from their covering index, which ``initialize_db`` adds
+    to databases made before it existed. The database is not modified.
+
+    Args:
+        db_path (str): Path to the SQLite database file.
+
+    Returns:
+        pd.Series: The IDs, as 64-bit integers.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        ids = pd.read_sql_query("SELECT id FROM articles", conn)["id"]
+    finally:
+        conn.close()
+    return ids.astype("int64")
+
+
 def insert_row(
     db_path: Union[str, Path],
     id: int,
@@ -86,16 +167,11 @@ def insert_row(
         model (str): Name of the model.
         debug (bool): If True, print debug messages (default: False).
     """
+    start = time.perf_counter()
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
     cursor.execute(
-        """
-        INSERT OR IGNORE INTO articles (
-            id, title, raw_text, markdown_text,
-            raw_text_tokens, markdown_text_tokens, model
-        )
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """,
+        _INSERT_ARTICLE,
         (
             id,
             title,
@@ -114,3 +190,302 @@ def insert_row(
             print(f"Row with id {id} already exists. No changes were made.")
     conn.commit()
     conn.close()
+    METRICS.observe("db_insert_seconds", time.perf_counter() - start)
+    METRICS.inc("db_rows_written_total")
+
+
+def get_article_ids(db_path: Union[str, Path]) -> Set[int]:
+    """
+    Get the IDs of all the articles stored in the database.
+
+    Args:
+        db_path (str): Path to the SQLite database file.
+
+    Returns:
+        Set[int]: IDs present in the database.
+    """
+    return set(read_article_ids(db_path).tolist())
+
+
+def read_failed_articles(db_path: Union[str, Path]) -> pd.DataFrame:
+    """
+    Read the articles whose conversion failed and did not succeed since.
+
+    Example:
+        >>> failed = read_failed_articles("data/database.db")
+        >>> parallel_process_dataframe(data[data["id"].isin(failed["id"])], ...)
+
+    Args:
+        db_path (str): Path to the SQLite database file.
+
+    Returns:
+        pd.DataFrame: The 'id', 'title', last 'error', number of 'failures' and
+        time of the last failure ('failed_at', in seconds since the epoch) of
+        each article, most failures first.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute(_CREATE_FAILED_TABLE)
+        return pd.read_sql_query(
+            "SELECT * FROM failed_articles ORDER BY failures DESC, id", conn
+        )
+    finally:
+        conn.close()
+
+
+def delete_rows(db_path: Union[str, Path], ids: Iterable[int]) -> int:
+    """
+    Delete the rows with the given IDs from the database.
+
+    Args:
+        db_path (str): Path to the SQLite database file.
+        ids (Iterable[int]): IDs of the rows to delete.
+
+    Returns:
+        int: Number of deleted rows.
+    """
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.executemany("DELETE FROM articles WHERE id = ?", ((id,) for id in ids))
+    deleted = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return deleted
+
+
+class DatabaseWriter:
+    """
+    Single writer thread inserting articles into the database in batches.
+
+    ``insert_row`` only puts the row in a queue, so it can be called from any
+    number of threads without waiting for SQLite. It only waits while the queue
+    is full, and event loops pass ``block=False`` to wait elsewhere. The
+    writer thread inserts the queued rows in one transaction every
+    ``batch_size`` rows or ``flush_interval`` seconds, on a single connection
+    in WAL mode, so there is one commit per batch instead of one per article,
+    and no "database is locked" errors between the threads.
+
+    Articles whose conversion failed are recorded in the ``failed_articles``
+    table with ``record_failure``, and removed from it once inserted.
+
+    Rows still queued are written by ``flush`` and ``close``. Closing happens
+    when leaving the ``with`` block, even on an exception such as
+    ``KeyboardInterrupt``, and at interpreter exit.
+
+    Example:
+        >>> with DatabaseWriter("data/database.db") as writer:
+        ...     writer.insert_row(id=1, title="April", ...)
+    """
+
+    _CLOSE = object()
+
+    def __init__(
+        self,
+        db_path: Union[str, Path],
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+        max_queue_size: int = 10_000,
+    ):
+        """
+        Start the writer thread of a database.
+
+        Args:
+            db_path (str): Path to the SQLite database file.
+            batch_size (int): Maximum number of rows per transaction
+                (default: 500).
+            flush_interval (float): Maximum number of seconds a row waits in
+                the queue (default: 1).
+            max_queue_size (int): Maximum number of queued rows. ``insert_row``
+                blocks while the queue is full (default: 10000).
+        """
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows_written = 0
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._error: Optional[BaseException] = None
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="database-writer", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.close)
+
+    def insert_row(
+        self,
+        id: int,
+        title: str,
+        raw_text: str,
+        markdown_text: str,
+        raw_text_tokens: int,
+        markdown_text_tokens: int,
+        model: str,
+        block: bool = True,
+    ) -> None:
+        """
+        Queue a row to be inserted if the ID does not already exist.
+
+        Args:
+            id (int): Unique identifier for the row.
+            title (str): Title of the text.
+            raw_text (str): Original text.
+            markdown_text (str): Transformed Markdown text.
+            raw_text_tokens (int): Token count of raw text.
+            markdown_text_tokens (int): Token count of Markdown text.
+            model (str): Name of the model.
+            block (bool): Wait while the queue is full. If False, raise
+                ``queue.Full`` instead (default: True).
+
+        Raises:
+            RuntimeError: If the writer is closed or its thread failed.
+        """
+        self._put(
+            (
+                id,
+                title,
+                raw_text,
+                markdown_text,
+                raw_text_tokens,
+                markdown_text_tokens,
+                model,
+            ),
+            block,
+        )
+        METRICS.set_gauge("db_queue_depth", self._queue.qsize())
+
+    def record_failure(
+        self, id: int, title: str, error: BaseException, block: bool = True
+    ) -> None:
+        """
+        Queue the failure of the conversion of an article.
+
+        Args:
+            id (int): Unique identifier of the article.
+            title (str): Title of the article.
+            error (BaseException): The error raised by the conversion.
+            block (bool): Wait while the queue is full. If False, raise
+                ``queue.Full`` instead (default: True).
+
+        Raises:
+            RuntimeError: If the writer is closed or its thread failed.
+        """
+        self._put(_Failure(id, title, repr(error), time.time()), block)
+        METRICS.inc("articles_failed_total")
+
+    def flush(self) -> None:
+        """Block until all the rows queued so far are committed."""
+        if self._thread.is_alive():
+            done = threading.Event()
+            self._put(done)
+            while not done.wait(0.1) and self._thread.is_alive():
+                pass
+        self._raise_error()
+
+    def close(self) -> None:
+        """Commit the queued rows and stop the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        while self._thread.is_alive():
+            try:
+                self._queue.put(self._CLOSE, timeout=0.1)
+            except queue.Full:
+                continue
+            self._thread.join()
+        self._raise_error()
+
+    def _run(self) -> None:
+        """Insert the queued rows in batches until closed."""
+        try:
+            conn = sqlite3.connect(self.db_path, timeout=60)
+        except BaseException as error:
+            self._error = error
+            return
+
+        batch: List[Tuple] = []
+        failures: List[_Failure] = []
+        deadline = None
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA cache_size=-65536")  # 64 MiB
+            # Databases created before the table existed
+            conn.execute(_CREATE_FAILED_TABLE)
+
+            while True:
+                try:
+                    if deadline is None:
+                        item = self._queue.get()
+                    else:
+                        timeout = max(0.0, deadline - time.monotonic())
+                        item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = None
+
+                if isinstance(item, tuple):
+                    if isinstance(item, _Failure):
+                        failures.append(item)
+                    else:
+                        batch.append(item)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+                    if len(batch) + len(failures) < self.batch_size:
+                        continue
+
+                # Full batch, timeout, flush or close
+                if batch or failures:
+                    with METRICS.time("db_commit_seconds"), conn:
+                        conn.executemany(_INSERT_ARTICLE, batch)
+                        conn.executemany(_DELETE_FAILURE, ((row[0],) for row in batch))
+                        conn.executemany(_RECORD_FAILURE, failures)
+                    self.rows_written += len(batch)
+                    METRICS.inc("db_rows_written_total", len(batch))
+                    METRICS.set_gauge("db_queue_depth", self._queue.qsize())
+                    batch = []
+                    failures = []
+                deadline = None
+
+                if isinstance(item, threading.Event):
+                    item.set()
+                elif item is self._CLOSE:
+                    return
+        except BaseException as error:
+            self._error = error
+        finally:
+            conn.close()
+
+    def _put(self, item: object, block: bool = True) -> None:
+        """
+        Put an item in the queue, waiting while it is full.
+
+        The wait stops when the writer thread stops, so that a failed writer
+        does not block the callers forever.
+        """
+        while True:
+            self._raise_error()
+            if self._closed:
+                raise RuntimeError("The database writer is closed")
+            try:
+                self._queue.put(item, block=block, timeout=0.1 if block else None)
+                return
+            except queue.Full:
+                if not block:
+                    raise
+                if not self._thread.is_alive():
+                    self._raise_error()
+                    raise RuntimeError("The database writer stopped") from None
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise RuntimeError("The database writer failed") from self._error
+
+    def __enter__(self) -> "DatabaseWriter":
+        """Return the writer, closed at the end of the block."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        """Close the writer."""
+        self.close()
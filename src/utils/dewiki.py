@@ -0,0 +1,247 @@
+"""Conversion of wiki markup to plain text."""
+
+import html
+import re
+import sys
+import time
+from difflib import SequenceMatcher
+from typing import Callable, Dict, Iterable
+
+import wikitextparser as wtp
+from html2text import html2text as htt
+
+# Section titles (levels 1 to 5), shared by all engines
+_SECTION_TITLE = re.compile(r"(={1,5}\s*[^=]+\s*={1,5})")
+_WHITESPACE = re.compile(r"\s+")
+
+# Patterns used by the fast engine
+_COMMENT = re.compile(r"<!--.*?-->", re.DOTALL)
+_INNER_TEMPLATE = re.compile(r"\{\{[^{}]*\}\}")
+_INNER_TABLE = re.compile(r"^[ \t]*\{\|(?:(?!^[ \t]*\{\|).)*?^[ \t]*\|\}", re.M | re.S)
+_TABLE_CELL_SEPARATOR = re.compile(r"\|\||!!")
+_INNER_WIKILINK = re.compile(r"\[\[([^\[\]]*)\]\]")
+_EXTERNAL_LINK = re.compile(r"\[(?:[a-z]+:)?//[^\s\]]*(?:\s+([^\]]*))?\]", re.I)
+_BOLD_ITALIC = re.compile(r"'{2,5}")
+_HTML_TAG = re.compile(r"</?[a-zA-Z][^<>]*>")
+
+# Wikilinks to these namespaces render as media, not as text
+_MEDIA_PREFIXES = ("file:", "image:", "media:")
+
+
+def dewiki(text: str, engine: str = "wikitextparser") -> str:
+    """
+    Convert raw wiki markup text into clean plain text.
+
+    Args:
+        text (str): The input string containing raw wiki markup.
+        engine (str): Name of the engine to use, one of ``DEWIKI_ENGINES``
+            (default: "wikitextparser").
+
+    Returns:
+        str: The processed plain text with wiki markup removed and formatting cleaned.
+    """
+    try:
+        convert = DEWIKI_ENGINES[engine]
+    except KeyError:
+        raise ValueError(
+            f"Unknown dewiki engine '{engine}'. "
+            f"Available engines: {', '.join(DEWIKI_ENGINES)}"
+        ) from None
+    return convert(text)
+
+
+def _dewiki_wikitextparser(text: str) -> str:
+    """
+    Convert raw wiki markup text into clean plain text.
+
+    This function processes a given wiki markup string to remove excess formatting,
+    HTML entities, and extraneous whitespace, while retaining readable plain text.
+    It also ensures proper formatting around section titles. This is the
+    reference engine, which the other engines are validated against.
+
+    Args:
+        text (str): The input string containing raw wiki markup.
+
+    Returns:
+        str: The processed plain text with wiki markup removed and formatting cleaned.
+    """
+    # Parse the wiki markup to extract plain text
+    text = wtp.parse(text).plain_text()
+
+    # Decode any HTML entities, such as &amp; -> &
+    text = htt(text)
+
+    return _normalize_whitespace(text)
+
+
+def _dewiki_fast(text: str) -> str:
+    """
+    Convert raw wiki markup text into clean plain text with regular expressions.
+
+    Mimics the output of the wikitextparser engine without building a parse
+    tree: comments, templates and media links are removed, tables, references
+    and HTML tags are reduced to their text, and links are replaced by their
+    label.
+
+    Args:
+        text (str): The input string containing raw wiki markup.
+
+    Returns:
+        str: The processed plain text with wiki markup removed and formatting cleaned.
+    """
+    text = _COMMENT.sub("", text)
+    text = _remove_innermost_first(_INNER_TEMPLATE, "", text)
+    text = _remove_innermost_first(_INNER_TABLE, _table_text, text)
+    text = _remove_innermost_first(_INNER_WIKILINK, _wikilink_text, text)
+    text = _EXTERNAL_LINK.sub(lambda match: match.group(1) or "", text)
+    text = _BOLD_ITALIC.sub("", text)
+    text = _HTML_TAG.sub("", text)
+    text = html.unescape(text)
+
+    # Like html2text, drop leading blank space and end with a line break
+    text = text.strip() + "\n"
+
+    return _normalize_whitespace(text)
+
+
+def _normalize_whitespace(text: str) -> str:
+    """
+    Collapse whitespace and add blank lines around section titles.
+
+    Args:
+        text (str): Plain text.
+
+    Returns:
+        str: The text on a single line, except around section titles.
+    """
+    # Replace newlines with spaces for better readability
+    text = text.replace("\n", " ")
+
+    # Replace multiple spaces or tabs with a single space
+    text = _WHITESPACE.sub(" ", text)
+
+    # Add blank lines before and after section titles (levels 1 to 5)
+    text = _SECTION_TITLE.sub(r"\n\n\1\n\n", text)
+
+    return text
+
+
+def _remove_innermost_first(pattern: re.Pattern, replacement, text: str) -> str:
+    """
+    Apply ``pattern.sub`` until nothing matches, to resolve nested constructs.
+
+    Args:
+        pattern (re.Pattern): Pattern matching a construct with no nested ones.
+        replacement (str | Callable): Replacement passed to ``pattern.sub``.
+        text (str): Input text.
+
+    Returns:
+        str: The text with every (nested) construct replaced.
+    """
+    while True:
+        text, replacements = pattern.subn(replacement, text)
+        if not replacements:
+            return text
+
+
+def _wikilink_text(match: re.Match) -> str:
+    """Return the text shown for a ``[[target|label]]`` wikilink."""
+    parts = match.group(1).split("|")
+    target = parts[0].strip()
+    if target.lower().startswith(_MEDIA_PREFIXES):
+        return ""
+    if len(parts) > 1:
+        return parts[-1]
+    return target.lstrip(":")
+
+
+def _table_text(match: re.Match) -> str:
+    """Return the text of the cells and caption of a ``{| ... |}`` table."""
+    cells = []
+    for line in match.group(0).splitlines()[1:-1]:
+        line = line.strip()
+        if not line or line.startswith("|-"):
+            continue
+        if line.startswith("|+"):
+            line = line[2:]
+        elif line[0] in "|!":
+            line = line[1:]
+        for cell in _TABLE_CELL_SEPARATOR.split(line):
+            # Cells may start with attributes: style="..." | content
+            cells.append(cell.split("|")[-1].strip())
+    return "\n" + " ".join(cells) + "\n"
+
+
+def compare_dewiki_engines(
+    texts: Iterable[str],
+    engine: str = "fast",
+    reference: str = "wikitextparser",
+) -> Dict[str, float]:
+    """
+    Validate an engine against the reference engine on a sample of articles.
+
+    Args:
+        texts (Iterable[str]): Raw wiki markup of the sample articles.
+        engine (str): Engine to validate (default: "fast").
+        reference (str): Reference engine (default: "wikitextparser").
+
+    Returns:
+        Dict[str, float]: Number of articles, share of identical outputs, mean
+        and minimum word-level similarity (1.0 means identical) and the speedup
+        of ``engine`` over ``reference``.
+    """
+    engine_time = reference_time = 0.0
+    similarities = []
+    exact = 0
+
+    for text in texts:
+        start = time.perf_counter()
+        expected = dewiki(text, reference)
+        reference_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        output = dewiki(text, engine)
+        engine_time += time.perf_counter() - start
+
+        exact += output == expected
+        similarities.append(
+            SequenceMatcher(None, expected.split(), output.split()).ratio()
+        )
+
+    n = len(similarities)
+    return {
+        "articles": n,
+        "exact_match": exact / n if n else 0.0,
+        "mean_similarity": sum(similarities) / n if n else 0.0,
+        "min_similarity": min(similarities, default=0.0),
+        "speedup": reference_time / engine_time if engine_time else 0.0,
+    }
+
+
+DEWIKI_ENGINES: Dict[str, Callable[[str], str]] = {
+    "wikitextparser": _dewiki_wikitextparser,
+    "fast": _dewiki_fast,
+}
+
+
+if __name__ == "__main__":
+    import bz2
+    from itertools import islice
+
+    from src.utils.wiki_xml import iter_wiki_pages
+
+    # Usage: python -m src.utils.dewiki <dump.xml.bz2> [sample size]
+    dump_file = sys.argv[1]
+    sample_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    with bz2.open(dump_file, "rb") as infile:
+        pages = iter_wiki_pages(iter(lambda: infile.read(1024 * 1024), b""))
+        sample = [
+            page.text
+            for page in islice(
+                (p for p in pages if p.ns == 0 and not p.redirect), sample_size
+            )
+        ]
+
+    for metric, value in compare_dewiki_engines(sample).items():
+        print(f"{metric}: {value:.3f}")
@@ -0,0 +1,369 @@
+"""Metrics of the pipeline, exported as JSON reports and Prometheus textfiles."""
+
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+# Upper bounds of the histogram buckets, in seconds: 0.1 ms to about 28 min,
+# growing by a factor of sqrt(2)
+DEFAULT_BUCKETS = tuple(1e-4 * 2 ** (i / 2) for i in range(48))
+
+# Prefix of the metric names in the Prometheus textfile
+PROMETHEUS_PREFIX = "simplewiki_"
+
+_Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class Histogram:
+    """Distribution of observed values, in cumulative buckets like Prometheus."""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        """
+        Create an empty histogram.
+
+        Args:
+            buckets (Tuple[float, ...]): Upper bounds of the buckets, in
+                increasing order (default: ``DEFAULT_BUCKETS``).
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """Record a value."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Estimate a quantile by linear interpolation within its bucket.
+
+        This is the estimate of ``histogram_quantile`` in Prometheus.
+
+        Args:
+            q (float): The quantile, between 0 and 1.
+
+        Returns:
+            float, optional: The estimate, or None if there are no values.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def merge(self, other: "Histogram") -> None:
+        """Add the values of another histogram with the same buckets."""
+        self.counts = [a + b for a, b in zip(self.counts, other.counts, strict=True)]
+        self.count += other.count
+        self.sum += other.sum
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters, gauges and histograms.
+
+    Metrics are identified by a name and optional labels, e.g.
+    ``metrics.inc("api_errors_total", status="429")``. The registry can be
+    exported as a JSON report, with throughputs and latency quantiles, and as
+    a Prometheus textfile. Worker processes record into their own copy of the
+    registry, which is sent back with ``drain`` and added with ``merge``.
+
+    Example:
+        >>> with METRICS.time("api_request_seconds"):
+        ...     markdown_text = converter.convert(text)
+        >>> METRICS.inc("articles_converted_total")
+    """
+
+    def __init__(self):
+        """Create an empty registry."""
+        self._lock = threading.Lock()
+        self.reset()
+        # A forked worker starts empty, with a lock that no thread holds
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Remove all the recorded values."""
+        with self._lock:
+            self.started_at = time.time()
+            self.counters: Dict[_Key, float] = {}
+            # Time of the first and last increment of each counter, for rates
+            self.active: Dict[_Key, List[float]] = {}
+            self.gauges: Dict[_Key, float] = {}
+            self.histograms: Dict[_Key, Histogram] = {}
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        """Increase a counter."""
+        key = _key(name, labels)
+        now = time.time()
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            self.active.setdefault(key, [now, now])[1] = now
+
+    def set_gauge(self, name: str, value: float, **labels: Any) -> None:
+        """Set a gauge, e.g. the depth of a queue."""
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def add_gauge(self, name: str, value: float, **labels: Any) -> None:
+        """Increase (or decrease) a gauge, e.g. the number of requests in flight."""
+        key = _key(name, labels)
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        """Record a value in a histogram, e.g. the duration of a request."""
+        key = _key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def time(self, name: str, **labels: Any) -> Iterator[None]:
+        """Record the duration of a block, in seconds, in a histogram."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def drain(self) -> Dict[str, Any]:
+        """
+        Take the values recorded since the last reset, for ``merge``.
+
+        Returns:
+            Dict[str, Any]: Picklable counters, activity times and histograms.
+        """
+        with self._lock:
+            values = {
+                "counters": self.counters,
+                "active": self.active,
+                "histograms": self.histograms,
+            }
+        self.reset()
+        return values
+
+    def merge(self, values: Dict[str, Any]) -> None:
+        """Add the values of ``drain``, e.g. from a worker process."""
+        with self._lock:
+            for key, value in values["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, (first, last) in values["active"].items():
+                active = self.active.setdefault(key, [first, last])
+                active[0], active[1] = min(active[0], first), max(active[1], last)
+            for key, histogram in values["histograms"].items():
+                if key in self.histograms:
+                    self.histograms[key].merge(histogram)
+                else:
+                    self.histograms[key] = histogram
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Summarize the metrics.
+
+        Counters come with their rate per second while they were increasing,
+        e.g. the articles per second of the stage that counts them, and
+        histograms with their mean, p50, p95 and p99.
+
+        Returns:
+            Dict[str, Any]: The report, which can be serialized to JSON.
+        """
+        with self._lock:
+            counters = {
+                _label(key): {
+                    "total": value,
+                    "per_second": _rate(value, *self.active[key]),
+                }
+                for key, value in sorted(self.counters.items())
+            }
+            gauges = {_label(key): value for key, value in sorted(self.gauges.items())}
+            histograms = {
+                _label(key): {
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "mean": histogram.sum / histogram.count,
+                    "p50": histogram.quantile(0.5),
+                    "p95": histogram.quantile(0.95),
+                    "p99": histogram.quantile(0.99),
+                }
+                for key, histogram in sorted(self.histograms.items())
+                if histogram.count
+            }
+        return {
+            "started_at": time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(self.started_at)
+            ),
+            "elapsed_seconds": time.time() - self.started_at,
+            "counters": counters,
+            "gauges": gauges,
+            "histograms": histograms,
+        }
+
+    def write_json(self, path: Union[str, Path]) -> None:
+        """Write the report to a JSON file."""
+        _write_atomically(path, json.dumps(self.report(), indent=4))
+
+    def write_prometheus(self, path: Union[str, Path]) -> None:
+        """
+        Write the metrics in the Prometheus text format.
+
+        The file is replaced atomically. It can be read by the textfile
+        collector of the node exporter.
+        """
+        lines = []
+        with self._lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name} {kind}")
+                    for key, value in sorted(values.items()):
+                        if key[0] == name:
+                            lines.append(f"{_series(key)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name} histogram")
+                for key, histogram in sorted(self.histograms.items()):
+                    if key[0] != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(
+                        histogram.buckets + (float("inf"),),
+                        histogram.counts,
+                        strict=True,
+                    ):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else f"{bound:.6g}"
+                        lines.append(f"{_series(key, '_bucket', le=le)} {cumulative}")
+                    lines.append(f"{_series(key, '_sum')} {histogram.sum}")
+                    lines.append(f"{_series(key, '_count')} {histogram.count}")
+        _write_atomically(path, "\n".join(lines) + "\n")
+
+
+class MetricsExporter:
+    """
+    Write the metrics to a Prometheus textfile every ``interval`` seconds.
+
+    The file is written from a background thread, and a final JSON report is
+    written when the exporter is stopped.
+
+    Example:
+        >>> with MetricsExporter("data/metrics"):
+        ...     run()
+    """
+
+    def __init__(
+        self,
+        folder: Union[str, Path],
+        interval: float = 5.0,
+        metrics: Optional[Metrics] = None,
+    ):
+        """
+        Configure the exporter, which is started by ``start``.
+
+        Args:
+            folder (str | Path): Folder of ``metrics.prom`` and
+                ``run_report.json``.
+            interval (float): Seconds between updates of the textfile
+                (default: 5).
+            metrics (Metrics, optional): Registry to export. Defaults to the
+                registry of the process.
+        """
+        self.folder = Path(folder)
+        self.interval = interval
+        self.metrics = metrics or METRICS
+        self.prometheus_path = self.folder / "metrics.prom"
+        self.report_path = self.folder / "run_report.json"
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="metrics-exporter", daemon=True
+        )
+
+    def start(self) -> "MetricsExporter":
+        """Start updating the textfile."""
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop the updates and write the final textfile and report."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.metrics.write_prometheus(self.prometheus_path)
+        self.metrics.write_json(self.report_path)
+
+    def _run(self) -> None:
+        """Write the textfile until stopped."""
+        while not self._stop.wait(self.interval):
+            self.metrics.write_prometheus(self.prometheus_path)
+
+    def __enter__(self) -> "MetricsExporter":
+        """Start the exporter."""
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        """Stop the exporter."""
+        self.stop()
+
+
+def _key(name: str, labels: Dict[str, Any]) -> _Key:
+    """Identify a metric by its name and sorted labels."""
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def _label(key: _Key) -> str:
+    """Readable name of a metric, e.g. ``api_errors_total{status=429}``."""
+    name, labels = key
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{label}={value}" for label, value in labels) + "}"
+
+
+def _series(key: _Key, suffix: str = "", **extra: str) -> str:
+    """Name and labels of a series in the Prometheus text format."""
+    name, labels = key
+    labels = labels + tuple(extra.items())
+    if not labels:
+        return f"{PROMETHEUS_PREFIX}{name}{suffix}"
+    formatted = ",".join(f'{label}="{_escape(value)}"' for label, value in labels)
+    return f"{PROMETHEUS_PREFIX}{name}{suffix}{{{formatted}}}"
+
+
+def _escape(value: str) -> str:
+    """Escape a label value for the Prometheus text format."""
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _rate(value: float, first: float, last: float) -> Optional[float]:
+    """Rate of a counter between its first and last increments."""
+    return value / (last - first) if last > first else None
+
+
+def _write_atomically(path: Union[str, Path], content: str) -> None:
+    """Write a file under a temporary name and move it into place."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(content)
+    os.replace(tmp_path, path)
+
+
+# Registry of the process, where the pipeline records its metrics
+METRICS = Metrics()
@@ -1,116 +1,645 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import pandas as pd
+import pyarrow.parquet as pq
 from tqdm import tqdm
-from transformers import PreTrainedTokenizerFast
 
 from src.convert_to_markdown import (
+    MarkdownConverter,
     convert_long_text_to_markdown,
-    convert_text_to_markdown,
+    get_converter,
+)
+from src.convert_with_rules import (
+    RULE_BASED_MODEL,
+    FastPathClassifier,
+    convert_text_with_rules,
+)
+from src.utils.cache import ConversionCache
+from src.utils.database import DatabaseWriter, get_article_ids
+from src.utils.metrics import METRICS
+from src.utils.scheduling import (
+    LatencyModel,
+    WorkItem,
+    get_token_counts,
+    pack_texts,
+    plan_work,
+    predict_makespan,
+    unpack_markdown,
 )
-from src.utils.database import insert_row
-from src.utils.tokenizer import count_tokens
+from src.utils.tokenizer import TokenizerLike, count_tokens
+
+# Fields of the article tuples handed to the workers (the last two come from
+# tokenize_wiki_text and may be missing)
+ARTICLE_FIELDS = ["id", "title", "text", "token_count", "section_token_counts"]
 
 
 def parallel_process_dataframe(
     data: pd.DataFrame,
     model_openrouter: str,
     template: str,
-    tokenizer: PreTrainedTokenizerFast,
+    tokenizer: TokenizerLike,
     model_hf: str,
     db_path: str,
     max_tokens: int = 7000,
     max_workers: int = 4,
-) -> None:
+    converter: Optional[MarkdownConverter] = None,
+    cache: Optional[ConversionCache] = None,
+    schedule: bool = True,
+    stub_tokens: int = 0,
+    pack_tokens: int = 2000,
+    fast_path: Optional[FastPathClassifier] = None,
+    max_in_flight: Optional[int] = None,
+) -> Dict[str, float]:
     """
     Process a DataFrame in parallel to convert text to markdown and insert it
     into a database. Uses different conversion methods for short and long text.
 
+    All the threads share a single converter, and therefore a single pool of
+    keep-alive connections to the API. The converted articles are written to
+    the database by a single ``DatabaseWriter``.
+
+    With ``schedule``, the articles are submitted longest first, so that the
+    longest ones do not hold the tail of the run, and stubs of at most
+    ``stub_tokens`` tokens are packed into shared requests (see ``plan_work``).
+    The makespan predicted from the token counts is reported next to the
+    actual one.
+
+    With a ``fast_path`` classifier, the articles it deems trivial are
+    converted locally by ``convert_text_with_rules``, without any request, and
+    stored with "rule-based" as their model.
+
+    Articles whose conversion fails are recorded in the ``failed_articles``
+    table of the database (see ``read_failed_articles``).
+
     Args:
         data (pd.DataFrame): DataFrame with rows to process.
         model_openrouter (str): Model for markdown conversion.
         template (str): Template for markdown conversion.
-        tokenizer (PreTrainedTokenizerFast): Tokenizer for counting tokens.
+        tokenizer (TokenizerLike): Tokenizer for counting tokens.
         model_hf (str): Hugging Face model identifier.
         db_path (str): SQLite database path.
         max_tokens (int): Max tokens allowed for long text (default: 7000).
         max_workers (int): Max threads for parallel processing (default: 4).
+        converter (MarkdownConverter, optional): Converter shared by the
+            threads. By default, one with a connection pool of ``max_workers``
+            connections is created and closed at the end.
+        cache (ConversionCache, optional): Cache of conversion results, used
+            by the converter created when ``converter`` is not given.
+        schedule (bool): Submit the articles longest first (default: True).
+        stub_tokens (int): Maximum number of tokens of the articles packed
+            together into a request. 0 disables packing (default: 0).
+        pack_tokens (int): Maximum number of tokens of a packed request
+            (default: 2000).
+        fast_path (FastPathClassifier, optional): Classifier routing trivial
+            articles to the rule-based converter.
+        max_in_flight (int, optional): Maximum number of work items submitted
+            and not completed yet (default: twice ``max_workers``).
 
     Returns:
-        None
+        Dict[str, float]: Predicted makespan, with the default latency model
+        and with the one fitted to this run, and actual makespan, in seconds,
+        and number of articles converted with the rules.
     """
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [
-            executor.submit(
-                _process_row,
-                row,
+    owns_converter = converter is None
+    if owns_converter:
+        converter = MarkdownConverter(
+            model_openrouter, template, max_connections=max_workers, cache=cache
+        )
+
+    token_counts = get_token_counts(data, tokenizer)
+    rows = _to_tuples(data)
+
+    # A single thread writes to the database, in batches, and commits what is
+    # queued even when the run is interrupted
+    writer = DatabaseWriter(db_path)
+    rule_positions: List[int] = []
+    llm_positions = list(range(len(data)))
+    samples = []  # (tokens, seconds) of the requests sent
+
+    def record_request(raw_text: str, seconds: float) -> None:
+        samples.append((count_tokens(tokenizer, raw_text), seconds))
+
+    converter.add_request_hook(record_request)
+    try:
+        if fast_path is not None:
+            rule_positions, llm_positions = fast_path.split(
+                data["text"].tolist(), token_counts
+            )
+            for position in tqdm(rule_positions, desc="Converting with rules"):
+                _convert_with_rules(
+                    writer, rows[position], token_counts[position], tokenizer
+                )
+
+        if schedule:
+            items = plan_work(token_counts, stub_tokens, pack_tokens, llm_positions)
+        else:
+            items = [WorkItem([i], token_counts[i]) for i in llm_positions]
+        predicted = predict_makespan(items, max_workers, max_tokens)
+
+        start = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        jobs = (
+            (
+                item,
+                (
+                    [rows[position] for position in item.positions],
+                    [token_counts[position] for position in item.positions],
+                    model_openrouter,
+                    template,
+                    tokenizer,
+                    model_hf,
+                    writer,
+                    max_tokens,
+                    converter,
+                ),
+            )
+            for item in items
+        )
+        try:
+            with tqdm(total=len(llm_positions), desc="Processing rows") as pbar:
+                for item, future in _submit_bounded(
+                    executor, _process_item, jobs, max_in_flight or 2 * max_workers
+                ):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"An error occurred: {e}")
+                        _record_failures(
+                            writer, [rows[position] for position in item.positions], e
+                        )
+                    pbar.update(len(item.positions))
+        finally:
+            # On Ctrl-C, drop the articles not started yet
+            executor.shutdown(cancel_futures=True)
+    finally:
+        converter.remove_request_hook(record_request)
+        writer.close()
+        if owns_converter:
+            converter.close()
+
+    report = {
+        "predicted_makespan": predicted,
+        "fitted_makespan": predict_makespan(
+            items, max_workers, max_tokens, LatencyModel.fit(samples)
+        ),
+        "actual_makespan": time.monotonic() - start,
+        "rule_based": len(rule_positions),
+    }
+    print(
+        f"Makespan: {report['actual_makespan']:.1f}s, predicted "
+        f"{report['predicted_makespan']:.1f}s (default latency model), "
+        f"{report['fitted_makespan']:.1f}s (latency model fitted to this run)"
+    )
+    return report
+
+
+def stream_process_parquet(
+    filename: Union[str, Path],
+    model_openrouter: str,
+    template: str,
+    tokenizer: TokenizerLike,
+    model_hf: str,
+    db_path: str,
+    max_tokens: int = 7000,
+    max_workers: int = 4,
+    batch_size: int = 1000,
+    max_in_flight: Optional[int] = None,
+    converter: Optional[MarkdownConverter] = None,
+    cache: Optional[ConversionCache] = None,
+    stub_tokens: int = 0,
+    pack_tokens: int = 2000,
+    fast_path: Optional[FastPathClassifier] = None,
+    skip_duplicates: bool = False,
+) -> Dict[str, float]:
+    """
+    Convert the articles of a Parquet file to markdown and store them in a database.
+
+    The file is streamed instead of being loaded into a DataFrame.
+
+    The file is read one batch of ``batch_size`` articles at a time, and at
+    most ``max_in_flight`` work items are submitted to the threads and not
+    completed yet. The next batch is only read once there is room for its
+    articles, so memory usage does not depend on the size of the corpus and
+    the first articles are stored as soon as they are converted.
+
+    Articles already in the database are skipped, so an interrupted run
+    resumes where it stopped, and the articles that failed, recorded in the
+    ``failed_articles`` table, are retried. Within each batch, the articles are
+    submitted longest first and stubs are packed as in
+    ``parallel_process_dataframe``.
+
+    Example:
+        >>> stream_process_parquet("data/processed/data.parquet", model, ...)
+
+    Args:
+        filename (str | Path): Parquet file of ``format_wiki_text``, or of
+            ``tokenize_wiki_text`` to reuse its token counts.
+        model_openrouter (str): Model for markdown conversion.
+        template (str): Template for markdown conversion.
+        tokenizer (TokenizerLike): Tokenizer for counting tokens.
+        model_hf (str): Hugging Face model identifier.
+        db_path (str): SQLite database path.
+        max_tokens (int): Max tokens allowed for long text (default: 7000).
+        max_workers (int): Max threads for parallel processing (default: 4).
+        batch_size (int): Number of articles read at a time (default: 1000).
+        max_in_flight (int, optional): Maximum number of work items submitted
+            and not completed yet (default: twice ``max_workers``).
+        converter (MarkdownConverter, optional): Converter shared by the
+            threads. By default, one with a connection pool of ``max_workers``
+            connections is created and closed at the end.
+        cache (ConversionCache, optional): Cache of conversion results, used
+            by the converter created when ``converter`` is not given.
+        stub_tokens (int): Maximum number of tokens of the articles packed
+            together into a request. 0 disables packing (default: 0).
+        pack_tokens (int): Maximum number of tokens of a packed request
+            (default: 2000).
+        fast_path (FastPathClassifier, optional): Classifier routing trivial
+            articles to the rule-based converter.
+        skip_duplicates (bool): Leave out the near-duplicates found by
+            ``dedupe_wiki_text``, to convert them from their exemplar with
+            ``convert_near_duplicates`` (default: False).
+
+    Returns:
+        Dict[str, float]: Number of processed, failed and skipped articles,
+        number of articles converted with the rules, of near-duplicates left
+        out, and duration of the run, in seconds.
+    """
+    owns_converter = converter is None
+    if owns_converter:
+        converter = MarkdownConverter(
+            model_openrouter, template, max_connections=max_workers, cache=cache
+        )
+
+    parquet_file = pq.ParquetFile(filename)
+    report = {
+        "processed": 0,
+        "failed": 0,
+        "skipped": 0,
+        "rule_based": 0,
+        "duplicates": 0,
+    }
+
+    def jobs() -> Iterator[Tuple[List[Tuple], tuple]]:
+        for item_rows, item_token_counts in _stream_work_items(
+            parquet_file,
+            db_path,
+            tokenizer,
+            writer,
+            report,
+            pbar,
+            batch_size,
+            stub_tokens,
+            pack_tokens,
+            fast_path,
+            skip_duplicates,
+        ):
+            yield item_rows, (
+                item_rows,
+                item_token_counts,
                 model_openrouter,
                 template,
                 tokenizer,
                 model_hf,
-                db_path,
+                writer,
                 max_tokens,
+                converter,
             )
-            for _, row in data.iterrows()
-        ]
 
-        for future in tqdm(
-            as_completed(futures), total=len(futures), desc="Processing rows"
+    start = time.monotonic()
+    writer = DatabaseWriter(db_path)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pbar = tqdm(total=parquet_file.metadata.num_rows, desc="Processing rows")
+    try:
+        for item_rows, future in _submit_bounded(
+            executor, _process_item, jobs(), max_in_flight or 2 * max_workers
         ):
             try:
                 future.result()
+                report["processed"] += len(item_rows)
             except Exception as e:
+                report["failed"] += len(item_rows)
                 print(f"An error occurred: {e}")
+                _record_failures(writer, item_rows, e)
+            pbar.update(len(item_rows))
+    finally:
+        # On Ctrl-C, drop the articles not started yet
+        executor.shutdown(cancel_futures=True)
+        pbar.close()
+        writer.close()
+        if owns_converter:
+            converter.close()
+
+    report["actual_makespan"] = time.monotonic() - start
+    return report
+
+
+def _stream_work_items(
+    parquet_file: pq.ParquetFile,
+    db_path: str,
+    tokenizer: TokenizerLike,
+    writer: DatabaseWriter,
+    report: Dict[str, float],
+    pbar: tqdm,
+    batch_size: int = 1000,
+    stub_tokens: int = 0,
+    pack_tokens: int = 2000,
+    fast_path: Optional[FastPathClassifier] = None,
+    skip_duplicates: bool = False,
+) -> Iterator[Tuple[List[Tuple], List[int]]]:
+    """
+    Plan the work items of the articles of a Parquet file still to convert.
+
+    The file is read one batch at a time. Articles already in the database are
+    skipped, and so are the near-duplicates with ``skip_duplicates``. The
+    articles routed to the rules by ``fast_path`` are converted and queued for
+    insertion right away. The ``skipped``, ``duplicates`` and ``rule_based``
+    counts of ``report`` and the progress bar are updated along the way.
+
+    Args:
+        parquet_file (pq.ParquetFile): Parquet file of ``format_wiki_text`` or
+            ``tokenize_wiki_text``.
+        db_path (str): SQLite database path.
+        tokenizer (TokenizerLike): Tokenizer for counting tokens.
+        writer (DatabaseWriter): Writer of the articles converted with rules.
+        report (Dict[str, float]): Counts updated by the generator.
+        pbar (tqdm): Progress bar updated by the generator.
+        batch_size (int): Number of articles read at a time (default: 1000).
+        stub_tokens (int): Maximum number of tokens of the articles packed
+            together into a request (default: 0).
+        pack_tokens (int): Maximum number of tokens of a packed request
+            (default: 2000).
+        fast_path (FastPathClassifier, optional): Classifier routing trivial
+            articles to the rule-based converter.
+        skip_duplicates (bool): Leave out the near-duplicates found by
+            ``dedupe_wiki_text`` (default: False).
+
+    Yields:
+        Tuple[List[Tuple], List[int]]: The articles of each work item, as
+        tuples of the ``ARTICLE_FIELDS``, and their number of tokens.
+    """
+    columns = [name for name in ARTICLE_FIELDS if name in parquet_file.schema.names]
+    if skip_duplicates:
+        # Only imported with near-duplicates, as it takes a while to import
+        from src.dedupe_wiki_text import DUPLICATE_OF_COLUMN
+
+        skip_duplicates = DUPLICATE_OF_COLUMN in parquet_file.schema.names
+        if skip_duplicates:
+            columns.append(DUPLICATE_OF_COLUMN)
+    done_ids = get_article_ids(db_path)
+
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        data = batch.to_pandas()
+        processed = data["id"].map(done_ids.__contains__).astype(bool)
+        report["skipped"] += int(processed.sum())
+        pbar.update(int(processed.sum()))
+        data = data[~processed]
+        if skip_duplicates:
+            duplicates = data[DUPLICATE_OF_COLUMN].notna()
+            report["duplicates"] += int(duplicates.sum())
+            pbar.update(int(duplicates.sum()))
+            data = data[~duplicates]
+        if data.empty:
+            continue
+
+        token_counts = get_token_counts(data, tokenizer)
+        rows = _to_tuples(data)
+        llm_positions = list(range(len(rows)))
+        if fast_path is not None:
+            rule_positions, llm_positions = fast_path.split(
+                data["text"].tolist(), token_counts
+            )
+            for position in rule_positions:
+                _convert_with_rules(
+                    writer, rows[position], token_counts[position], tokenizer
+                )
+            report["rule_based"] += len(rule_positions)
+            pbar.update(len(rule_positions))
+
+        for item in plan_work(token_counts, stub_tokens, pack_tokens, llm_positions):
+            yield (
+                [rows[position] for position in item.positions],
+                [token_counts[position] for position in item.positions],
+            )
+
+
+def _submit_bounded(
+    executor: Executor,
+    fn: Callable[..., Any],
+    jobs: Iterable[Tuple[Any, tuple]],
+    max_in_flight: int,
+) -> Iterator[Tuple[Any, Future]]:
+    """
+    Submit jobs to an executor, and yield them as they complete.
+
+    At most ``max_in_flight`` jobs are pending at a time.
+
+    ``jobs`` is only consumed when there is room for the next job, so it can
+    lazily read its input.
+
+    Args:
+        executor (Executor): Executor running the jobs.
+        fn (Callable): Function called by every job.
+        jobs (Iterable[Tuple[Any, tuple]]): Key identifying each job, and
+            arguments of ``fn``.
+        max_in_flight (int): Maximum number of pending jobs.
+
+    Yields:
+        Tuple[Any, Future]: Key and future of each completed job.
+    """
+    pending: Dict[Future, Any] = {}
+    for key, args in jobs:
+        while len(pending) >= max_in_flight:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                METRICS.add_gauge("work_items_in_flight", -1)
+                yield pending.pop(future), future
+        pending[executor.submit(fn, *args)] = key
+        METRICS.add_gauge("work_items_in_flight", 1)
+    for future in as_completed(pending):
+        METRICS.add_gauge("work_items_in_flight", -1)
+        yield pending[future], future
+
+
+def _record_failures(
+    writer: DatabaseWriter, rows: List[Tuple], error: Exception
+) -> None:
+    """Record the articles of a failed work item, to be retried by the next run."""
+    for row in rows:
+        writer.record_failure(int(row[0]), row[1], error)
+
+
+def _to_tuples(data: pd.DataFrame) -> List[Tuple]:
+    """Turn the rows of a DataFrame into tuples of the ``ARTICLE_FIELDS``."""
+    return list(data.reindex(columns=ARTICLE_FIELDS).itertuples(index=False, name=None))
+
+
+def _convert_with_rules(
+    writer: DatabaseWriter,
+    row: Tuple,
+    n_tokens: int,
+    tokenizer: TokenizerLike,
+) -> None:
+    """Convert an article with ``convert_text_with_rules`` and queue it."""
+    markdown_text = convert_text_with_rules(row[2])
+    _insert_article(writer, row, markdown_text, n_tokens, tokenizer, RULE_BASED_MODEL)
+
+
+def _process_item(
+    rows: List[Tuple],
+    token_counts: List[int],
+    model_openrouter: str,
+    template: str,
+    tokenizer: TokenizerLike,
+    model_hf: str,
+    writer: DatabaseWriter,
+    max_tokens: int,
+    converter: MarkdownConverter,
+) -> None:
+    """
+    Convert the articles of a work item and insert them into a database.
+
+    Several articles are converted in a single request, and split back with
+    ``unpack_markdown``. If the output can not be split, they are converted
+    again one by one.
+
+    Args:
+        rows (List[Tuple]): The articles, as tuples of the ``ARTICLE_FIELDS``.
+        token_counts (List[int]): Number of tokens of each article.
+        model_openrouter (str): Model for markdown conversion.
+        template (str): Template for markdown conversion.
+        tokenizer (TokenizerLike): Tokenizer for counting tokens.
+        model_hf (str): Hugging Face model identifier.
+        writer (DatabaseWriter): Writer of the SQLite database.
+        max_tokens (int): Max tokens for long text.
+        converter (MarkdownConverter): Converter to use.
+    """
+    if len(rows) == 1:
+        _process_row(
+            rows[0],
+            model_openrouter,
+            template,
+            tokenizer,
+            model_hf,
+            writer,
+            max_tokens,
+            converter,
+            token_counts[0],
+        )
+        return
+
+    texts = [row[2] for row in rows]
+    markdown_texts = unpack_markdown(converter.convert(pack_texts(texts)), len(rows))
+    if markdown_texts is None:
+        markdown_texts = converter.convert_many(texts)
+
+    for row, n_tokens, markdown_text in zip(
+        rows, token_counts, markdown_texts, strict=True
+    ):
+        _insert_article(writer, row, markdown_text, n_tokens, tokenizer, model_hf)
 
 
 def _process_row(
-    row: pd.Series,
+    row: Tuple,
     model_openrouter: str,
     template: str,
-    tokenizer: PreTrainedTokenizerFast,
+    tokenizer: TokenizerLike,
     model_hf: str,
-    db_path: str,
+    writer: DatabaseWriter,
     max_tokens: int = 7000,
+    converter: Optional[MarkdownConverter] = None,
+    n_tokens: Optional[int] = None,
 ) -> None:
     """
-    Convert a DataFrame row's text to markdown and insert it into a database.
+    Convert an article's text to markdown and insert it into a database.
 
     Args:
-        row (pd.Series): A DataFrame row with 'id', 'title', and 'text' fields.
+        row (Tuple): The 'id', 'title', 'text', 'token_count' and
+            'section_token_counts' fields of the article. The last two come
+            from ``tokenize_wiki_text`` and may be missing (NaN).
         model_openrouter (str): Model for markdown conversion.
         template (str): Template for markdown conversion.
-        tokenizer (PreTrainedTokenizerFast): Tokenizer for counting tokens.
+        tokenizer (TokenizerLike): Tokenizer for counting tokens.
         model_hf (str): Hugging Face model identifier.
-        db_path (str): SQLite database path.
+        writer (DatabaseWriter): Writer of the SQLite database.
         max_tokens (int): Max tokens for long text (default: 7000).
+        converter (MarkdownConverter, optional): Converter to use. Defaults to
+            the shared converter for the model and template.
+        n_tokens (int, optional): Number of tokens of the text.
 
     Returns:
         None
     """
-    n_tokens = count_tokens(tokenizer, row["text"])
+    if converter is None:
+        converter = get_converter(model_openrouter, template)
 
-    if n_tokens <= max_tokens:
-        markdown_text = convert_text_to_markdown(
-            model_openrouter=model_openrouter,
-            raw_text=row["text"],
-            template=template,
-        )
-    else:
-        markdown_text = convert_long_text_to_markdown(
-            model_openrouter=model_openrouter,
-            raw_text=row["text"],
-            template=template,
-            tokenizer=tokenizer,
-            max_tokens=max_tokens,
-        )
+    _, _, text, token_count, section_token_counts = row
 
-    insert_row(
-        db_path=db_path,
-        id=int(row["id"]),
-        title=row["title"],
-        raw_text=row["text"],
+    # Use the token counts of tokenize_wiki_text when available
+    if n_tokens is None:
+        n_tokens = token_count
+    if n_tokens is None or pd.isna(n_tokens):
+        n_tokens = count_tokens(tokenizer, text)
+
+    with METRICS.time("article_convert_seconds"):
+        if n_tokens <= max_tokens:
+            markdown_text = converter.convert(text)
+        else:
+            markdown_text = convert_long_text_to_markdown(
+                model_openrouter=model_openrouter,
+                raw_text=text,
+                template=template,
+                tokenizer=tokenizer,
+                max_tokens=max_tokens,
+                converter=converter,
+                section_token_counts=(
+                    list(section_token_counts)
+                    if pd.api.types.is_list_like(section_token_counts)
+                    else None
+                ),
+            )
+
+    _insert_article(writer, row, markdown_text, n_tokens, tokenizer, model_hf)
+
+
+def _insert_article(
+    writer: DatabaseWriter,
+    row: Tuple,
+    markdown_text: str,
+    n_tokens: int,
+    tokenizer: TokenizerLike,
+    model_hf: str,
+) -> None:
+    """Queue a converted article for insertion into the database."""
+    id, title, text = row[:3]
+    writer.insert_row(
+        id=int(id),
+        title=title,
+        raw_text=text,
         markdown_text=markdown_text,
-        raw_text_tokens=n_tokens,
+        raw_text_tokens=int(n_tokens),
         markdown_text_tokens=count_tokens(tokenizer, markdown_text),
         model=model_hf,
     )
+    method = "rules" if model_hf == RULE_BASED_MODEL else "llm"
+    METRICS.inc("articles_converted_total", method=method)
+    METRICS.inc("article_tokens_total", int(n_tokens), method=method)
@@ -0,0 +1,128 @@
+"""Streaming writer of Parquet files."""
+
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Union
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class ParquetStreamWriter:
+    """
+    Write records to a Parquet file one row group at a time.
+
+    Records are buffered column by column and flushed as a row group every
+    ``row_group_size`` records, so memory usage only depends on the row group
+    size and not on the total number of records. The file is written under a
+    temporary name and moved into place when the writer is closed, so an
+    interrupted run never leaves a truncated file at ``path``.
+
+    Example:
+        >>> schema = pa.schema([("id", pa.int64()), ("title", pa.string())])
+        >>> with ParquetStreamWriter("data.parquet", schema) as writer:
+        ...     writer.write({"id": 1, "title": "April"})
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        schema: pa.Schema,
+        row_group_size: int = 10_000,
+        compression: Optional[str] = "snappy",
+    ):
+        """
+        Prepare the writer of a Parquet file.
+
+        Args:
+            path (str | Path): Path to the output Parquet file.
+            schema (pa.Schema): Schema of the records.
+            row_group_size (int): Number of records per row group
+                (default: 10000).
+            compression (str, optional): Compression codec, e.g. "snappy",
+                "zstd", "gzip" or None (default: "snappy").
+        """
+        self.path = Path(path)
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.rows_written = 0
+
+        self._tmp_path = self.path.with_name(self.path.name + ".tmp")
+        self._buffer: Dict[str, list] = {name: [] for name in schema.names}
+        self._buffered_rows = 0
+        self._writer = pq.ParquetWriter(
+            self._tmp_path, schema, compression=compression or "none"
+        )
+
+    def write(self, record: Dict[str, Any]) -> None:
+        """
+        Buffer a record, flushing a row group when the buffer is full.
+
+        Args:
+            record (dict): Mapping from column name to value. Missing columns
+                are written as nulls.
+        """
+        for name, column in self._buffer.items():
+            column.append(record.get(name))
+        self._buffered_rows += 1
+
+        if self._buffered_rows >= self.row_group_size:
+            self.flush()
+
+    def write_many(self, records: Iterable[Dict[str, Any]]) -> None:
+        """
+        Buffer several records.
+
+        Args:
+            records (Iterable[dict]): Records to write.
+        """
+        for record in records:
+            self.write(record)
+
+    def write_table(self, table: pa.Table) -> None:
+        """
+        Write an Arrow table, after the records buffered so far.
+
+        Args:
+            table (pa.Table): Table with the writer's schema. It is split into
+                row groups of at most ``row_group_size`` rows.
+        """
+        self.flush()
+        self._writer.write_table(
+            table.select(self.schema.names).cast(self.schema),
+            row_group_size=self.row_group_size,
+        )
+        self.rows_written += table.num_rows
+
+    def flush(self) -> None:
+        """Write the buffered records as a new row group."""
+        if not self._buffered_rows:
+            return
+
+        table = pa.Table.from_pydict(self._buffer, schema=self.schema)
+        self._writer.write_table(table, row_group_size=self.row_group_size)
+        self.rows_written += self._buffered_rows
+
+        self._buffer = {name: [] for name in self.schema.names}
+        self._buffered_rows = 0
+
+    def close(self) -> None:
+        """Flush the remaining records and move the file into place."""
+        self.flush()
+        self._writer.close()
+        self._tmp_path.replace(self.path)
+
+    def abort(self) -> None:
+        """Close the writer and discard the partially written file."""
+        self._writer.close()
+        self._tmp_path.unlink(missing_ok=True)
+
+    def __enter__(self) -> "ParquetStreamWriter":
+        """Return the writer, closed at the end of the block."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        """Close the writer, or abort it if the block raised an exception."""
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
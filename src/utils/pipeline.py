@@ -0,0 +1,148 @@
+"""State of the pipeline, to skip the stages that are up to date."""
+
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Union
+
+
+class PipelineState:
+    """
+    Record of the completed stages of the pipeline, saved in a JSON file.
+
+    Every stage is recorded with a key, the fingerprint of its inputs (the
+    keys of the stages it depends on, the files it reads and the config values
+    it uses). A stage is up to date when it completed with the key computed
+    for the current run and its outputs still exist. A stage is marked as
+    incomplete when it starts, so a stage that was interrupted runs again.
+
+    Example:
+        >>> state = PipelineState("data/pipeline_state.json")
+        >>> key = fingerprint(state.key("parse"), config["model_hf"])
+        >>> if not state.is_up_to_date("tokenize", key, [output_file]):
+        ...     state.start("tokenize")
+        ...     tokenize_wiki_text(output_file, tokenizer)
+        ...     state.complete("tokenize", key)
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        """
+        Load the state saved by a previous run, if any.
+
+        Args:
+            path (str | Path): Path to the JSON file of the state.
+        """
+        self.path = Path(path)
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                self.stages = json.load(f)
+
+    def key(self, stage: str) -> Optional[str]:
+        """
+        Get the key of the last completion of a stage.
+
+        Args:
+            stage (str): Name of the stage.
+
+        Returns:
+            str, optional: The key, or None if the stage never completed.
+        """
+        return self.stages.get(stage, {}).get("key")
+
+    def value(self, stage: str, name: str) -> Any:
+        """
+        Get a value recorded with the last completion of a stage.
+
+        Args:
+            stage (str): Name of the stage.
+            name (str): Name of the value.
+
+        Returns:
+            Any: The value, or None if the stage never completed or did not
+            record it.
+        """
+        return self.stages.get(stage, {}).get("values", {}).get(name)
+
+    def is_up_to_date(
+        self, stage: str, key: str, outputs: Iterable[Union[str, Path]] = ()
+    ) -> bool:
+        """
+        Check whether a stage completed with the given key.
+
+        Args:
+            stage (str): Name of the stage.
+            key (str): Fingerprint of the current inputs of the stage.
+            outputs (Iterable[str | Path]): Files written by the stage.
+
+        Returns:
+            bool: True if the stage can be skipped.
+        """
+        return self.key(stage) == key and all(Path(path).exists() for path in outputs)
+
+    def start(self, stage: str) -> None:
+        """Mark a stage as incomplete until ``complete`` is called."""
+        self.stages.pop(stage, None)
+        self._save()
+
+    def complete(self, stage: str, key: str, **values: Any) -> None:
+        """
+        Mark a stage as completed.
+
+        Args:
+            stage (str): Name of the stage.
+            key (str): Fingerprint of the inputs the stage ran with.
+            **values: Values serializable to JSON to record with the stage,
+                e.g. fingerprints of some of its inputs, read with ``value``.
+        """
+        self.stages[stage] = {
+            "key": key,
+            "completed_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        if values:
+            self.stages[stage]["values"] = values
+        self._save()
+
+    def _save(self) -> None:
+        """Write the state atomically, so a crash never leaves it corrupted."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.stages, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+
+def fingerprint(*values: Any) -> str:
+    """
+    Hash values that can be serialized to JSON, e.g. keys and config values.
+
+    Args:
+        *values: The values to hash.
+
+    Returns:
+        str: Hex digest of the values.
+    """
+    data = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def file_fingerprint(path: Union[str, Path]) -> Optional[Dict[str, int]]:
+    """
+    Identify the current version of a file by its size and modification time.
+
+    Unlike a hash of its content, this is instant for files of any size.
+
+    Args:
+        path (str | Path): Path to the file.
+
+    Returns:
+        Dict[str, int], optional: Size and modification time, in nanoseconds,
+        or None if the file does not exist.
+    """
+    path = Path(path)
+    if not path.exists():
+        return None
+    stat = path.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
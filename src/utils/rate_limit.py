@@ -0,0 +1,293 @@
+"""Adaptive concurrency limit and token budget of the API requests."""
+
+import asyncio
+import re
+import time
+from email.utils import parsedate_to_datetime
+from typing import Mapping, Optional
+
+import httpx
+import openai
+
+# Status codes worth retrying, and those meaning the provider is overloaded
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 520, 522, 524, 529}
+OVERLOAD_STATUS_CODES = {429, 503, 529}
+
+
+class AIMDLimiter:
+    """
+    Concurrency limit adapted to the provider, as in TCP congestion control.
+
+    The limit follows additive increase and multiplicative decrease (AIMD).
+
+    Until the first overload error the limit doubles every round trip (slow
+    start). Then it grows by about one request per round trip while requests
+    succeed with healthy latencies, and is cut by ``decrease_factor`` every
+    time the provider answers with a rate limit or overload error. Rate limit
+    headers can also pause new requests until the limit resets. The limiter is
+    meant to be used from a single event loop.
+
+    Example:
+        >>> limiter = AIMDLimiter(initial_limit=16)
+        >>> async with limiter:
+        ...     await send_request()
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 16,
+        min_limit: int = 1,
+        max_limit: int = 1024,
+        decrease_factor: float = 0.5,
+        latency_tolerance: float = 2.0,
+    ):
+        """
+        Create a limiter starting at ``initial_limit`` concurrent requests.
+
+        Args:
+            initial_limit (int): Initial number of concurrent requests
+                (default: 16).
+            min_limit (int): Lower bound of the limit (default: 1).
+            max_limit (int): Upper bound of the limit (default: 1024).
+            decrease_factor (float): Factor applied to the limit on overload
+                (default: 0.5).
+            latency_tolerance (float): The limit only grows while latencies
+                stay below this multiple of the baseline latency
+                (default: 2.0).
+        """
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.overloads = 0
+
+        self._condition = asyncio.Condition()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._baseline: Optional[float] = None  # slow average of the latency
+        self._round_trip = 1.0  # recent request duration, in seconds
+        self._slow_start = True
+
+    async def acquire(self) -> None:
+        """Wait until a request can be sent."""
+        async with self._condition:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), pause)
+                    except asyncio.TimeoutError:
+                        pass
+                elif self.in_flight < int(self.limit):
+                    break
+                else:
+                    await self._condition.wait()
+            self.in_flight += 1
+
+    async def release(self) -> None:
+        """Signal that a request has finished."""
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self, duration: float, latency: Optional[float] = None) -> None:
+        """
+        Record a successful request, increasing the limit if latency is healthy.
+
+        Args:
+            duration (float): Duration of the request, in seconds.
+            latency (float, optional): Latency used to judge the health of the
+                provider, e.g. the duration per token so that long requests are
+                not mistaken for congestion. Defaults to ``duration``.
+        """
+        latency = duration if latency is None else latency
+        self._round_trip = 0.8 * self._round_trip + 0.2 * duration
+
+        if self._baseline is None:
+            self._baseline = latency
+        else:
+            self._baseline = 0.95 * self._baseline + 0.05 * latency
+
+        healthy = latency <= self.latency_tolerance * self._baseline
+        # Only grow while the limit is actually used
+        if healthy and self.in_flight >= int(self.limit) - 1:
+            increase = 1 if self._slow_start else 1 / self.limit
+            self.limit = min(self.max_limit, self.limit + increase)
+
+    def on_overload(self, retry_after: Optional[float] = None) -> None:
+        """
+        Record a rate limit or overload error, decreasing the limit.
+
+        Errors of requests sent in the same round trip only decrease the limit
+        once.
+
+        Args:
+            retry_after (float, optional): Seconds to wait before sending new
+                requests, as requested by the provider.
+        """
+        now = time.monotonic()
+        self.overloads += 1
+        self._slow_start = False
+        if now - self._last_decrease >= self._round_trip:
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+            self._last_decrease = now
+        if retry_after:
+            self.pause(retry_after)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Stop sending new requests for some time.
+
+        Args:
+            seconds (float): Length of the pause.
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def __aenter__(self) -> "AIMDLimiter":
+        """Acquire a slot for a request."""
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        """Release the slot of the request."""
+        await self.release()
+
+
+class TokenBudget:
+    """
+    Token bucket limiting the number of tokens sent per minute.
+
+    The bucket holds up to one minute of tokens and is refilled continuously.
+    Requests larger than the bucket wait until it is full.
+    """
+
+    def __init__(self, tokens_per_minute: int):
+        """
+        Create a budget whose bucket starts full.
+
+        Args:
+            tokens_per_minute (int): Tokens allowed per minute.
+        """
+        self.capacity = tokens_per_minute
+        self.tokens = float(tokens_per_minute)
+        self._rate = tokens_per_minute / 60
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int) -> None:
+        """
+        Wait until ``tokens`` tokens are available and take them.
+
+        Requests are served in order, so large requests are not starved.
+
+        Args:
+            tokens (int): Number of tokens of the request.
+        """
+        tokens = min(tokens, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self._updated) * self._rate
+                )
+                self._updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self._rate)
+
+
+def retry_delay(error: BaseException) -> Optional[float]:
+    """
+    Classify an error raised by the OpenAI client.
+
+    Args:
+        error (BaseException): The error.
+
+    Returns:
+        float, optional: None if the request should not be retried. Otherwise
+        the delay requested by the provider, or 0 if it did not request one.
+    """
+    if isinstance(error, openai.APIStatusError):
+        if error.status_code not in RETRYABLE_STATUS_CODES:
+            return None
+        return rate_limit_pause(error.response.headers, limited=True) or 0.0
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError)):
+        return 0.0
+    return None
+
+
+def is_overload(error: BaseException) -> bool:
+    """Whether an error means that the provider is overloaded."""
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in OVERLOAD_STATUS_CODES
+    return isinstance(error, (openai.APITimeoutError, httpx.TimeoutException))
+
+
+def rate_limit_pause(
+    headers: Mapping[str, str], limited: bool = False
+) -> Optional[float]:
+    """
+    Read how long to wait before the next request from rate limit headers.
+
+    Understands ``Retry-After`` (seconds or HTTP date), ``retry-after-ms`` and
+    the ``X-RateLimit-Remaining`` / ``X-RateLimit-Reset`` headers of OpenRouter
+    (reset as epoch milliseconds) and OpenAI (``x-ratelimit-*-requests`` and
+    ``-tokens``, reset as a duration such as ``6m0s``).
+
+    Args:
+        headers (Mapping[str, str]): Response headers (case insensitive).
+        limited (bool): Whether the response is a rate limit error, in which
+            case the reset time applies even if no remaining count is given.
+
+    Returns:
+        float, optional: Seconds to wait, or None if the headers do not ask for
+        a pause.
+    """
+    if "retry-after-ms" in headers:
+        return _to_float(headers["retry-after-ms"], 0.0) / 1000
+    if "retry-after" in headers:
+        value = headers["retry-after"]
+        seconds = _to_float(value, None)
+        if seconds is None:
+            try:
+                seconds = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+        return max(0.0, seconds)
+
+    pauses = []
+    for suffix in ("", "-requests", "-tokens"):
+        remaining = headers.get(f"x-ratelimit-remaining{suffix}")
+        reset = headers.get(f"x-ratelimit-reset{suffix}")
+        exhausted = remaining is not None and _to_float(remaining, 1) <= 0
+        if reset is not None and (exhausted or limited):
+            pauses.append(_parse_reset(reset))
+    pauses = [pause for pause in pauses if pause is not None]
+    return max(pauses) if pauses else None
+
+
+def _parse_reset(value: str) -> Optional[float]:
+    """Convert a rate limit reset header into seconds from now."""
+    number = _to_float(value, None)
+    if number is None:
+        # Duration such as "1s", "6m0s" or "20ms"
+        parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+        if not parts:
+            return None
+        units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+        return sum(float(amount) * units[unit] for amount, unit in parts)
+    if number > 1e11:  # epoch milliseconds
+        return max(0.0, number / 1000 - time.time())
+    if number > 1e9:  # epoch seconds
+        return max(0.0, number - time.time())
+    return number
+
+
+def _to_float(value: str, default: Optional[float]) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
@@ -0,0 +1,95 @@
+"""Retries and latency tracking of the API requests."""
+
+import random
+import threading
+from collections import deque
+from typing import Deque, Dict, NamedTuple, Optional
+
+
+class RetryPolicy(NamedTuple):
+    """Exponential backoff with jitter between the attempts of a request."""
+
+    max_attempts: int = 4
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+
+    def delay(self, attempt: int, requested: Optional[float] = None) -> float:
+        """
+        Seconds to wait after a failed attempt.
+
+        The delay is drawn uniformly between 0 and ``base_delay * 2 **
+        (attempt - 1)``, capped at ``max_delay`` ("full jitter"), so that the
+        requests that failed together are not retried together. It is never
+        shorter than the delay requested by the provider.
+
+        Args:
+            attempt (int): Number of the failed attempt, starting at 1.
+            requested (float, optional): Delay requested by the provider, e.g.
+                with a ``Retry-After`` header.
+
+        Returns:
+            float: The delay, in seconds.
+        """
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return max(random.uniform(0, ceiling), requested or 0.0)
+
+
+class LatencyTracker:
+    """
+    Recent latencies of the requests, to estimate their quantiles.
+
+    The latency of a request grows with the length of its output, so the
+    requests are grouped by size class (powers of two of the length of their
+    text) and the quantiles of a request are those of its class. Only the last
+    ``window`` latencies of each class are kept, so the estimates follow the
+    current state of the provider. The tracker is thread-safe.
+    """
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        """
+        Create a tracker without latencies.
+
+        Args:
+            window (int): Number of latencies kept per size class
+                (default: 200).
+            min_samples (int): Number of latencies a class needs before its
+                quantiles are estimated (default: 20).
+        """
+        self.window = window
+        self.min_samples = min_samples
+        self._latencies: Dict[int, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, size: int, seconds: float) -> None:
+        """
+        Record the latency of a request.
+
+        Args:
+            size (int): Length of the text of the request.
+            seconds (float): Latency of the request.
+        """
+        with self._lock:
+            latencies = self._latencies.get(size.bit_length())
+            if latencies is None:
+                latencies = self._latencies[size.bit_length()] = deque(
+                    maxlen=self.window
+                )
+            latencies.append(seconds)
+
+    def quantile(self, size: int, q: float) -> Optional[float]:
+        """
+        Estimate a quantile of the latency of the requests of a given size.
+
+        Args:
+            size (int): Length of the text of the request.
+            q (float): The quantile, between 0 and 1.
+
+        Returns:
+            float, optional: The estimate, or None if there are not enough
+            latencies of requests of this size yet.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies.get(size.bit_length(), ()))
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
@@ -0,0 +1,207 @@
+"""Scheduling of the conversion requests by their predicted latency."""
+
+import heapq
+import math
+import re
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+import pandas as pd
+
+from src.utils.tokenizer import TokenizerLike, count_tokens_batch
+
+# Level 1 headings, which start every article ("= Title =" becomes "# Title")
+_ARTICLE_HEADING = re.compile(r"^# ", re.MULTILINE)
+
+
+class WorkItem(NamedTuple):
+    """Articles converted together, with their total number of tokens."""
+
+    positions: List[int]
+    tokens: int
+
+
+class LatencyModel(NamedTuple):
+    """Linear model of the duration of a conversion request."""
+
+    base_seconds: float = 2.0
+    seconds_per_token: float = 1 / 50
+
+    def predict(self, tokens: int) -> float:
+        """Predict the duration, in seconds, of a request of ``tokens`` tokens."""
+        return self.base_seconds + self.seconds_per_token * tokens
+
+    @classmethod
+    def fit(cls, samples: Sequence[Tuple[int, float]]) -> "LatencyModel":
+        """
+        Fit the model by least squares.
+
+        Args:
+            samples (Sequence[Tuple[int, float]]): Number of tokens and
+                duration, in seconds, of completed requests.
+
+        Returns:
+            LatencyModel: The fitted model, or the default one if there are not
+            enough distinct samples.
+        """
+        n = len(samples)
+        if n < 2:
+            return cls()
+        mean_tokens = sum(tokens for tokens, _ in samples) / n
+        mean_seconds = sum(seconds for _, seconds in samples) / n
+        variance = sum((tokens - mean_tokens) ** 2 for tokens, _ in samples)
+        if variance == 0:
+            return cls(base_seconds=mean_seconds, seconds_per_token=0.0)
+        slope = (
+            sum(
+                (tokens - mean_tokens) * (seconds - mean_seconds)
+                for tokens, seconds in samples
+            )
+            / variance
+        )
+        slope = max(slope, 0.0)
+        return cls(
+            base_seconds=max(mean_seconds - slope * mean_tokens, 0.0),
+            seconds_per_token=slope,
+        )
+
+
+def get_token_counts(data: pd.DataFrame, tokenizer: TokenizerLike) -> List[int]:
+    """
+    Get the number of tokens of each article of a DataFrame.
+
+    Args:
+        data (pd.DataFrame): DataFrame with a 'text' field, and optionally the
+            'token_count' field of ``tokenize_wiki_text``.
+        tokenizer (TokenizerLike): Tokenizer for counting tokens.
+
+    Returns:
+        List[int]: The token counts, counted in a batch when not precomputed.
+    """
+    if "token_count" in data.columns and not data["token_count"].isna().any():
+        return data["token_count"].astype(int).tolist()
+    return count_tokens_batch(tokenizer, data["text"].tolist())
+
+
+def plan_work(
+    token_counts: Sequence[int],
+    stub_tokens: int = 0,
+    pack_tokens: int = 2000,
+    positions: Optional[Sequence[int]] = None,
+) -> List[WorkItem]:
+    """
+    Order the articles longest first and pack stub articles together.
+
+    Starting with the longest articles (longest processing time first) keeps
+    the largest ones from being the last to start, which would leave most
+    workers idle at the end of the run. Articles of at most ``stub_tokens``
+    tokens are packed into shared requests of up to ``pack_tokens`` tokens,
+    which are scheduled last, as they are the shortest.
+
+    Args:
+        token_counts (Sequence[int]): Number of tokens of each article.
+        stub_tokens (int): Maximum number of tokens of the articles that are
+            packed together. 0 disables packing (default: 0).
+        pack_tokens (int): Maximum number of tokens of a packed request
+            (default: 2000).
+        positions (Sequence[int], optional): Positions of the articles to
+            plan. Defaults to all of them.
+
+    Returns:
+        List[WorkItem]: Positions of the articles of each work item, in the
+        order they should be submitted.
+    """
+    if positions is None:
+        positions = range(len(token_counts))
+    order = sorted(positions, key=lambda i: -token_counts[i])
+
+    items = []
+    stubs: List[int] = []
+    stubs_tokens = 0
+    for position in order:
+        tokens = int(token_counts[position])
+        if tokens > stub_tokens:
+            items.append(WorkItem([position], tokens))
+            continue
+        if stubs and stubs_tokens + tokens > pack_tokens:
+            items.append(WorkItem(stubs, stubs_tokens))
+            stubs, stubs_tokens = [], 0
+        stubs.append(position)
+        stubs_tokens += tokens
+
+    if stubs:
+        items.append(WorkItem(stubs, stubs_tokens))
+    return items
+
+
+def predict_makespan(
+    items: Sequence[WorkItem],
+    num_workers: int,
+    max_tokens: int,
+    latency_model: Optional[LatencyModel] = None,
+) -> float:
+    """
+    Predict the time needed to process work items in order with a pool of workers.
+
+    Articles longer than ``max_tokens`` are converted as several concurrent
+    requests, which are simulated as separate jobs.
+
+    Args:
+        items (Sequence[WorkItem]): Work items, in submission order.
+        num_workers (int): Number of concurrent requests.
+        max_tokens (int): Maximum number of tokens per request.
+        latency_model (LatencyModel, optional): Duration of the requests.
+
+    Returns:
+        float: Predicted makespan, in seconds.
+    """
+    latency_model = latency_model or LatencyModel()
+    workers = [0.0] * max(1, num_workers)
+    for item in items:
+        requests = max(1, math.ceil(item.tokens / max_tokens))
+        duration = latency_model.predict(item.tokens / requests)
+        for _ in range(requests):
+            start = heapq.heappop(workers)
+            heapq.heappush(workers, start + duration)
+    return max(workers)
+
+
+def pack_texts(texts: Sequence[str]) -> str:
+    """
+    Join the texts of several articles into a single request.
+
+    Args:
+        texts (Sequence[str]): Article texts, each starting with its
+            ``= Title =`` heading.
+
+    Returns:
+        str: The packed text.
+    """
+    return "\n\n".join(text.strip() for text in texts)
+
+
+def unpack_markdown(markdown_text: str, num_articles: int) -> Optional[List[str]]:
+    """
+    Split the conversion of packed articles back into one text per article.
+
+    The conversion turns the ``= Title =`` heading that starts every article
+    into ``# Title``, which is where the output is split.
+
+    Args:
+        markdown_text (str): Markdown conversion of ``pack_texts``.
+        num_articles (int): Number of packed articles.
+
+    Returns:
+        List[str], optional: The Markdown text of each article, or None if the
+        output does not have one level 1 heading per article, in which case
+        the articles must be converted separately.
+    """
+    starts = [match.start() for match in _ARTICLE_HEADING.finditer(markdown_text)]
+    if len(starts) != num_articles:
+        return None
+    if markdown_text[: starts[0]].strip():
+        return None
+    ends = starts[1:] + [len(markdown_text)]
+    return [
+        markdown_text[start:end].strip()
+        for start, end in zip(starts, ends, strict=True)
+    ]
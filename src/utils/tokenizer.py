@@ -1,15 +1,118 @@
-from transformers import PreTrainedTokenizerFast
+from os import getenv
+from pathlib import Path
+from typing import TYPE_CHECKING, List, Optional, Sequence, Union
 
+from src.utils.metrics import METRICS
 
-def count_tokens(tokenizer: PreTrainedTokenizerFast, text: str) -> int:
+if TYPE_CHECKING:
+    from tokenizers import Tokenizer
+    from transformers import PreTrainedTokenizerFast
+
+# Tokenizers that can count tokens: a fast tokenizer of transformers, or the
+# Rust tokenizer of the tokenizers library it wraps
+TokenizerLike = Union["PreTrainedTokenizerFast", "Tokenizer"]
+
+TOKENIZER_FILE = "tokenizer.json"
+
+
+def load_tokenizer(
+    model_hf: str,
+    tokenizer_file: Optional[Union[str, Path]] = None,
+    token: Optional[str] = None,
+) -> TokenizerLike:
+    """
+    Load the tokenizer of a model, for counting tokens.
+
+    The ``tokenizer.json`` file of the model is loaded with the ``tokenizers``
+    library, which imports in milliseconds, unlike ``transformers`` (and torch).
+    The file is taken from ``tokenizer_file`` when given, or from the Hugging
+    Face cache, without any request. It is only downloaded when it is not
+    cached yet. Models without a ``tokenizer.json`` file are loaded with
+    ``AutoTokenizer``.
+
+    Example:
+        >>> tokenizer = load_tokenizer("deepseek-ai/DeepSeek-V3")
+        >>> count_tokens(tokenizer, "Hello world!")
+
+    Args:
+        model_hf (str): Hugging Face model identifier.
+        tokenizer_file (str | Path, optional): Path to a ``tokenizer.json``
+            file of the model.
+        token (str, optional): Hugging Face token, for gated models. Defaults
+            to the ``HUGGINGFACE_TOKEN`` environment variable.
+
+    Returns:
+        TokenizerLike: The tokenizer.
+    """
+    from tokenizers import Tokenizer
+
+    if tokenizer_file is not None:
+        return Tokenizer.from_file(str(tokenizer_file))
+
+    from huggingface_hub import hf_hub_download, try_to_load_from_cache
+    from huggingface_hub.utils import EntryNotFoundError
+
+    token = token or getenv("HUGGINGFACE_TOKEN")
+    cached_file = try_to_load_from_cache(model_hf, TOKENIZER_FILE)
+    if isinstance(cached_file, str):
+        return Tokenizer.from_file(cached_file)
+    try:
+        return Tokenizer.from_file(
+            hf_hub_download(model_hf, TOKENIZER_FILE, token=token)
+        )
+    except EntryNotFoundError:
+        from transformers import AutoTokenizer
+
+        return AutoTokenizer.from_pretrained(model_hf, token=token)
+
+
+def count_tokens(tokenizer: TokenizerLike, text: str) -> int:
     """
     Count the number of tokens in a given text using the provided tokenizer.
 
     Args:
-        tokenizer (PreTrainedTokenizerFast): The tokenizer to use for encoding the text.
+        tokenizer (TokenizerLike): The tokenizer to use for encoding the text.
         text (str): The input text to tokenize.
 
     Returns:
         int: The number of tokens in the tokenized text.
     """
-    return len(tokenizer.encode(text))
+    with METRICS.time("tokenize_seconds"):
+        n_tokens = len(_backend(tokenizer).encode(text).ids)
+    METRICS.inc("tokenized_texts_total")
+    METRICS.inc("tokens_total", n_tokens)
+    return n_tokens
+
+
+def count_tokens_batch(tokenizer: TokenizerLike, texts: Sequence[str]) -> List[int]:
+    """
+    Count the number of tokens of many texts at once.
+
+    The texts are encoded in a single call to the Rust backend of the fast
+    tokenizer, which spreads them across all the cores (unless the
+    ``TOKENIZERS_PARALLELISM`` environment variable disables it). The counts are
+    the same as those of ``count_tokens``.
+
+    Args:
+        tokenizer (TokenizerLike): The tokenizer to use for encoding.
+        texts (Sequence[str]): The input texts to tokenize.
+
+    Returns:
+        List[int]: The number of tokens of each text.
+    """
+    if not texts:
+        return []
+    backend = _backend(tokenizer)
+    # encode_batch_fast (tokenizers >= 0.21) skips computing the offsets
+    encode_batch = getattr(backend, "encode_batch_fast", backend.encode_batch)
+    with METRICS.time("tokenize_batch_seconds"):
+        encodings = encode_batch(list(texts))
+    token_counts = [len(encoding.ids) for encoding in encodings]
+    METRICS.inc("tokenized_texts_total", len(texts))
+    METRICS.inc("tokens_total", sum(token_counts))
+    return token_counts
+
+
+def _backend(tokenizer: TokenizerLike) -> "Tokenizer":
+    """Rust tokenizer of a fast tokenizer, or the tokenizer itself."""
+    return getattr(tokenizer, "backend_tokenizer", tokenizer)
@@ -0,0 +1,137 @@
+"""Streaming parser of the pages of the XML dumps."""
+
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from xml.parsers import expat
+
+
+class WikiPage(NamedTuple):
+    """A page extracted from a MediaWiki XML dump."""
+
+    title: str
+    id: int
+    ns: int
+    redirect: bool
+    text: str
+    revision_id: int
+    sha1: str
+
+
+# (parent tag, tag) pairs whose character data is collected for each page
+_CAPTURED_FIELDS = {
+    ("page", "title"): "title",
+    ("page", "ns"): "ns",
+    ("page", "id"): "id",
+    ("revision", "id"): "revision_id",
+    ("revision", "sha1"): "sha1",
+    ("revision", "text"): "text",
+}
+
+
+class _PageHandler:
+    """Expat handlers that assemble ``WikiPage`` objects from parser events."""
+
+    def __init__(self):
+        self.pages: List[WikiPage] = []
+        self._stack: List[str] = []
+        self._fields: Dict[str, str] = {}
+        self._redirect = False
+        self._field: Optional[str] = None
+        self._parts: List[str] = []
+
+    def start_element(self, name: str, attrs: Dict[str, str]) -> None:
+        parent = self._stack[-1] if self._stack else None
+        self._stack.append(name)
+
+        if name == "page":
+            self._fields = {}
+            self._redirect = False
+        elif name == "redirect" and parent == "page":
+            self._redirect = True
+        else:
+            self._field = _CAPTURED_FIELDS.get((parent, name))
+            self._parts = []
+
+    def end_element(self, name: str) -> None:
+        self._stack.pop()
+
+        if self._field is not None:
+            self._fields[self._field] = "".join(self._parts)
+            self._field = None
+            self._parts = []
+        elif name == "page":
+            self.pages.append(
+                WikiPage(
+                    title=self._fields.get("title", ""),
+                    id=int(self._fields["id"]),
+                    ns=int(self._fields.get("ns", 0)),
+                    redirect=self._redirect,
+                    text=self._fields.get("text", ""),
+                    revision_id=int(self._fields.get("revision_id", 0)),
+                    sha1=self._fields.get("sha1", ""),
+                )
+            )
+
+    def character_data(self, data: str) -> None:
+        if self._field is not None:
+            self._parts.append(data)
+
+
+def iter_wiki_pages(
+    chunks: Iterable[bytes], fragment: bool = False
+) -> Iterator[WikiPage]:
+    """
+    Incrementally extract the pages of a MediaWiki XML dump.
+
+    The XML is parsed with expat as it is fed, so pages are yielded as soon as
+    their closing tag is seen and no intermediate page strings are built.
+
+    Args:
+        chunks (Iterable[bytes]): Consecutive pieces of the UTF-8 encoded XML.
+        fragment (bool): If True, ``chunks`` hold a sequence of ``<page>``
+            elements without a single root element, as found in the bz2
+            streams of a multistream dump (default: False).
+
+    Yields:
+        WikiPage: The pages, in document order.
+    """
+    handler = _PageHandler()
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.buffer_size = 1024 * 1024
+    parser.StartElementHandler = handler.start_element
+    parser.EndElementHandler = handler.end_element
+    parser.CharacterDataHandler = handler.character_data
+
+    if fragment:
+        parser.Parse(b"<pages>")
+
+    for chunk in chunks:
+        parser.Parse(chunk)
+        if handler.pages:
+            yield from handler.pages
+            handler.pages.clear()
+
+    parser.Parse(b"</pages>" if fragment else b"", True)
+    yield from handler.pages
+
+
+def page_fragment_bounds(data: bytes) -> Tuple[int, int]:
+    """
+    Find the span of ``data`` that holds complete ``<page>`` elements.
+
+    The first and last streams of a multistream dump also hold the opening
+    ``<mediawiki>`` / ``<siteinfo>`` header and the closing ``</mediawiki>``
+    tag, which are left out of the span.
+
+    Args:
+        data (bytes): Decompressed content of one or more bz2 streams.
+
+    Returns:
+        Tuple[int, int]: Start and end offsets of the pages. Both are 0 when
+        ``data`` holds no page.
+    """
+    start = data.find(b"<page>")
+    if start < 0:
+        return 0, 0
+    end = data.rfind(b"</page>") + len(b"</page>")
+    return start, end
@@ -0,0 +1,213 @@
+"""Tests of the ranged and resumable download of the dump."""
+
+import json
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+import pytest
+
+from src.download_wiki_file import (
+    _split_segments,
+    download_simplewiki_dump,
+)
+
+FILE_NAME = "simplewiki-latest-pages-articles-multistream.xml.bz2"
+
+LAST_MODIFIED = "Mon, 02 Dec 2024 10:00:00 GMT"
+
+
+class DumpServer(ThreadingHTTPServer):
+    """HTTP server of a single file, honouring ``Range`` and ``If-Range``."""
+
+    daemon_threads = True
+
+    def __init__(self, content: bytes, etag: str = '"v1"'):
+        """
+        Serve a file on a free port of the local host.
+
+        Args:
+            content (bytes): Content of the file.
+            etag (str): ``ETag`` of the file.
+        """
+        super().__init__(("127.0.0.1", 0), _DumpHandler)
+        self.content = content
+        self.etag = etag
+        self.ranges: List[str] = []
+        self.gets = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        """URL of the file."""
+        return f"http://127.0.0.1:{self.server_address[1]}/{FILE_NAME}"
+
+
+class _DumpHandler(BaseHTTPRequestHandler):
+    server: DumpServer
+
+    def do_HEAD(self) -> None:
+        """Send the headers of the whole file."""
+        self._send_headers(200, len(self.server.content))
+
+    def do_GET(self) -> None:
+        """Send the whole file, or the requested range of it."""
+        content = self.server.content
+        byte_range = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        with self.server.lock:
+            self.server.gets += 1
+            if byte_range:
+                self.server.ranges.append(byte_range)
+
+        # Servers do not honour the range for a weak ETag validator
+        strong_etag = not self.server.etag.startswith("W/")
+        if byte_range and (
+            if_range in (None, LAST_MODIFIED)
+            or (if_range == self.server.etag and strong_etag)
+        ):
+            start, end = re.fullmatch(r"bytes=(\d+)-(\d+)", byte_range).groups()
+            body = content[int(start) : int(end) + 1]
+            self._send_headers(206, len(body))
+        else:
+            body = content
+            self._send_headers(200, len(body))
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        """Do not log the requests."""
+
+    def _send_headers(self, status: int, length: int) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.send_header("Last-Modified", LAST_MODIFIED)
+        self.send_header("ETag", self.server.etag)
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+
+@pytest.fixture
+def content() -> bytes:
+    """Content of the served file, larger than a download chunk."""
+    return os.urandom(3 * 1024 * 1024 + 12345)
+
+
+@pytest.fixture
+def server(content: bytes):
+    """Local server of the file."""
+    server = DumpServer(content)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize("num_connections", [1, 4, 7])
+def test_download_matches_content(tmp_path, server, content, num_connections):
+    """The downloaded file is the served file, whatever the connections."""
+    file_path, dump_date, metadata_file = download_simplewiki_dump(
+        tmp_path, num_connections=num_connections, url=server.url
+    )
+
+    with open(file_path, "rb") as file:
+        assert file.read() == content
+    assert dump_date == "2024-12-02"
+    assert len(server.ranges) == num_connections
+    assert not (tmp_path / f"{FILE_NAME}.part").exists()
+    assert not (tmp_path / f"{FILE_NAME}.part.json").exists()
+
+    with open(metadata_file, "r") as file:
+        metadata = json.load(file)
+    assert metadata["etag"] == server.etag
+    assert metadata["file_size"] == len(content)
+
+
+def test_download_skipped_when_up_to_date(tmp_path, server, content):
+    """An up-to-date copy is not downloaded again, unless forced."""
+    download_simplewiki_dump(tmp_path, num_connections=2, url=server.url)
+    gets = server.gets
+
+    download_simplewiki_dump(tmp_path, num_connections=2, url=server.url)
+    assert server.gets == gets
+
+    download_simplewiki_dump(tmp_path, num_connections=2, url=server.url, force=True)
+    assert server.gets > gets
+
+
+def test_download_not_skipped_when_remote_changed(tmp_path, server, content):
+    """A copy of a file whose ``ETag`` changed is downloaded again."""
+    download_simplewiki_dump(tmp_path, url=server.url)
+    server.content = content[::-1]
+    server.etag = '"v2"'
+
+    file_path, _, _ = download_simplewiki_dump(tmp_path, url=server.url)
+    with open(file_path, "rb") as file:
+        assert file.read() == content[::-1]
+
+
+def test_download_resumes_part_file(tmp_path, server, content):
+    """An interrupted download only fetches the bytes still missing."""
+    segments = _split_segments(len(content), 2)
+    # The first segment is done, the second one stopped half way
+    segments[0][2] = segments[0][1]
+    segments[1][2] = (segments[1][0] + segments[1][1]) // 2
+    with open(tmp_path / f"{FILE_NAME}.part", "wb") as file:
+        file.write(content[: segments[0][1]])
+        file.write(content[segments[1][0] : segments[1][2]])
+        file.truncate(len(content))
+    with open(tmp_path / f"{FILE_NAME}.part.json", "w") as file:
+        json.dump(
+            {
+                "last_modified": LAST_MODIFIED,
+                "etag": server.etag,
+                "file_size": len(content),
+                "segments": segments,
+            },
+            file,
+        )
+
+    file_path, _, _ = download_simplewiki_dump(
+        tmp_path, num_connections=2, url=server.url
+    )
+
+    with open(file_path, "rb") as file:
+        assert file.read() == content
+    assert server.ranges == [f"bytes={segments[1][2]}-{len(content) - 1}"]
+
+
+def test_download_restarts_part_file_of_other_version(tmp_path, server, content):
+    """A partial download of another version of the file is not resumed."""
+    with open(tmp_path / f"{FILE_NAME}.part", "wb") as file:
+        file.write(b"\0" * len(content))
+    with open(tmp_path / f"{FILE_NAME}.part.json", "w") as file:
+        json.dump(
+            {
+                "last_modified": LAST_MODIFIED,
+                "etag": '"v0"',
+                "file_size": len(content),
+                "segments": [[0, len(content), len(content) // 2]],
+            },
+            file,
+        )
+
+    file_path, _, _ = download_simplewiki_dump(tmp_path, url=server.url)
+
+    with open(file_path, "rb") as file:
+        assert file.read() == content
+    assert server.ranges == [f"bytes=0-{len(content) - 1}"]
+
+
+def test_download_with_weak_etag(tmp_path, server, content):
+    """Ranges are validated by the date when the ``ETag`` is weak."""
+    server.etag = 'W/"v1"'
+
+    file_path, _, _ = download_simplewiki_dump(
+        tmp_path, num_connections=3, url=server.url
+    )
+
+    with open(file_path, "rb") as file:
+        assert file.read() == content
+    assert len(server.ranges) == 3
@@ -0,0 +1,195 @@
+"""Tests of the sharded runs over several nodes."""
+
+import json
+import multiprocessing
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from benchmarks.synthetic_dump import generate_dump
+from src.format_wiki_text import format_wiki_text
+from src.sharding import (
+    PLAN_FILE,
+    SHARD_DB_FILE,
+    ShardClaims,
+    ShardPlan,
+    merge_shards,
+    plan_shards,
+    run_shard_worker,
+)
+from src.utils.database import initialize_db, insert_row
+
+
+@pytest.fixture(scope="module")
+def dump(tmp_path_factory) -> Tuple[Path, Path]:
+    """Small multistream dump, and its index."""
+    return generate_dump(
+        tmp_path_factory.mktemp("dump"),
+        num_articles=300,
+        mean_words=50,
+        pages_per_stream=20,
+    )
+
+
+@pytest.fixture(scope="module")
+def full_table(dump, tmp_path_factory) -> pa.Table:
+    """Articles of the dump, parsed in a single pass."""
+    path = tmp_path_factory.mktemp("full") / "full.parquet"
+    format_wiki_text(dump[0], path)
+    return pq.read_table(path)
+
+
+@pytest.mark.parametrize("num_shards", [1, 3, 7])
+def test_shards_concatenate_to_full_parse(dump, full_table, tmp_path, num_shards):
+    """The shards of a dump hold all its articles once, in dump order."""
+    dump_file, index_file = dump
+    plan = plan_shards(dump_file, num_shards, index_file)
+    assert plan.num_shards == num_shards
+    assert plan.ranges[0][0] == 0
+    assert plan.ranges[-1][1] == dump_file.stat().st_size
+    assert plan_shards(dump_file, num_shards) == plan
+
+    tables = []
+    for index, byte_range in enumerate(plan.ranges):
+        path = tmp_path / f"{index}.parquet"
+        format_wiki_text(dump_file, path, byte_range=byte_range)
+        tables.append(pq.read_table(path))
+
+    assert pa.concat_tables(tables).equals(full_table)
+
+
+def test_more_shards_than_streams(dump, full_table, tmp_path):
+    """Shards without streams are empty."""
+    dump_file, index_file = dump
+    plan = plan_shards(dump_file, 40, index_file)
+
+    num_rows = 0
+    for index, byte_range in enumerate(plan.ranges):
+        path = tmp_path / f"{index}.parquet"
+        format_wiki_text(dump_file, path, byte_range=byte_range)
+        num_rows += pq.read_metadata(path).num_rows
+
+    assert any(start == end for start, end in plan.ranges)
+    assert num_rows == full_table.num_rows
+
+
+def _run_worker(folder: str, num_shards: int, owner: str) -> List[int]:
+    """Process shards from another process, logging them in the folder."""
+    claims = ShardClaims(folder, num_shards, stale_after=5.0, owner=owner)
+
+    def process_shard(index: int) -> bool:
+        with open(Path(folder) / f"processed-{owner}.txt", "a") as file:
+            file.write(f"{index}\n")
+        time.sleep(0.05)
+        return True
+
+    return run_shard_worker(claims, process_shard, poll_interval=0.05)
+
+
+def _processed(folder: Path) -> List[int]:
+    """Shards processed by the workers, as logged by ``_run_worker``."""
+    return [
+        int(line)
+        for path in folder.glob("processed-*.txt")
+        for line in path.read_text().split()
+    ]
+
+
+def test_workers_claim_every_shard_once(tmp_path):
+    """Concurrent workers process every shard exactly once."""
+    num_shards = 24
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(4) as pool:
+        completed = pool.starmap(
+            _run_worker,
+            [(str(tmp_path), num_shards, f"worker-{index}") for index in range(4)],
+        )
+
+    assert sorted(sum(completed, [])) == list(range(num_shards))
+    assert sorted(_processed(tmp_path)) == list(range(num_shards))
+    assert not ShardClaims(tmp_path, num_shards).pending()
+
+
+def test_stale_claim_is_taken_over(tmp_path):
+    """The claim of a dead worker is taken over, and its completion refused."""
+    claims = ShardClaims(tmp_path, 2, stale_after=5.0, owner="dead")
+    claim = claims.claim()
+    assert claim.index == 0 and claim.generation == 1
+    # A claim refreshed recently is not taken over
+    assert ShardClaims(tmp_path, 2, owner="other").claim(exclude={1}) is None
+    # The worker stopped refreshing its claim a long time ago
+    os.utime(claim.path, (0, 0))
+
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        completed = pool.apply(_run_worker, (str(tmp_path), 2, "alive"))
+
+    assert completed == [0, 1]
+    assert not claims.is_current(claim)
+    assert not claims.complete(claim)
+    done = json.loads((claims.folder / "00000.done").read_text())
+    assert done == {"owner": "alive", "generation": 2}
+
+
+def _make_shards(folder: Path, shards: List[List[Tuple]]) -> None:
+    """Create the plan and the completed shard databases of a shared folder."""
+    plan = ShardPlan(
+        "dump.xml.bz2", 100, [(index, index + 1) for index in range(len(shards))]
+    )
+    (folder / PLAN_FILE).write_text(json.dumps(plan._asdict()))
+    claims = ShardClaims(folder, plan.num_shards)
+    for index, rows in enumerate(shards):
+        db_path = plan.shard_folder(folder, index) / SHARD_DB_FILE
+        db_path.parent.mkdir(parents=True)
+        initialize_db(str(db_path))
+        for row in rows:
+            insert_row(db_path, *row)
+        assert claims.complete(claims.claim())
+
+
+def _row(id: int, markdown_text: str = "# Text") -> Tuple:
+    return (id, f"Title {id}", "Text", markdown_text, 1, 2, "model")
+
+
+def _merged_ids(db_path: Path) -> List[int]:
+    with sqlite3.connect(db_path) as conn:
+        return [id for (id,) in conn.execute("SELECT id FROM articles ORDER BY id")]
+
+
+def test_merge_shards(tmp_path):
+    """Shards are merged, skipping the rows identical to merged ones."""
+    _make_shards(tmp_path, [[_row(1), _row(2)], [_row(2), _row(3)]])
+    db_path = tmp_path / "merged.db"
+
+    assert merge_shards(tmp_path, db_path) == {"shards": 2, "inserted": 3}
+    assert _merged_ids(db_path) == [1, 2, 3]
+    # Merging again inserts nothing
+    assert merge_shards(tmp_path, db_path) == {"shards": 2, "inserted": 0}
+
+
+def test_merge_shards_detects_conflicts(tmp_path):
+    """A shard conflicting with merged rows is not merged at all."""
+    _make_shards(tmp_path, [[_row(1), _row(2)], [_row(2, "# Other"), _row(3)]])
+    db_path = tmp_path / "merged.db"
+
+    with pytest.raises(ValueError, match=r"conflict.*\[2\]"):
+        merge_shards(tmp_path, db_path)
+    assert _merged_ids(db_path) == [1, 2]
+
+
+def test_merge_shards_requires_every_shard(tmp_path):
+    """Incomplete shards are only merged when allowed."""
+    _make_shards(tmp_path, [[_row(1)], [_row(2)]])
+    os.remove(tmp_path / "claims" / "00001.done")
+    db_path = tmp_path / "merged.db"
+
+    with pytest.raises(RuntimeError, match="not done"):
+        merge_shards(tmp_path, db_path)
+    assert merge_shards(tmp_path, db_path, allow_incomplete=True)["inserted"] == 1
+    assert _merged_ids(db_path) == [1]